@@ -1,99 +1,383 @@
+"""Dash front end for running commands on STBs and browsing the run history.
+
+Run it with ``python app.py``, or under a WSGI server with a single worker:
+
+    gunicorn --workers 1 --threads 8 app:server
+
+Commands run on engine workers inside the serving process and their results
+wait in its memory for the page to poll them, so the app must be served by
+ONE process (threads are fine). The first process to serve takes the
+DASH_LOCK_FILE lock; any other process answers every request with a 503.
+"""
+import atexit
 import dash
-    import dash_bootstrap_components as dbc
-    from dash import dcc, html
-    from dash.dependencies import Input, Output, State
-    from ssh_client import SSHClient, CommandRunner
-    from config import CONFIG
-    import logging
-
-    # Configure logging
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler('stb_tool.log'),
-            logging.StreamHandler()
-        ]
-    )
+import dash_bootstrap_components as dbc
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+from dash import dash_table, dcc, html
+from dash.dependencies import Input, Output, State
+from config import CONFIG, get_command_list
+from connection_registry import REGISTRY, ConnectionKey
+from engine import ExecutionEngine, Job
+from history import get_history
+from parsers import format_parsed, parse_outputs
+import logging
+
+try:
+    import fcntl
+except ImportError:  # Windows: no flock, and no pre-forking servers either
+    fcntl = None
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler('stb_tool.log'),
+        logging.StreamHandler()
+    ]
+)
+logger = logging.getLogger(__name__)
 
-    app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
-
-    app.layout = dbc.Container([
-        dbc.Row([
-            dbc.Col([
-                dbc.Input(id="host", placeholder="Host", type="text", value=CONFIG['DEFAULT_PROXY_HOST']),
-                dbc.Input(id="username", placeholder="Username", type="text", value=CONFIG['DEFAULT_PROXY_USER']),
-                dbc.Input(id="key_path", placeholder="Key Path", type="text", value=CONFIG['DEFAULT_KEY_PATH']),
-                dbc.Input(id="passphrase", placeholder="Passphrase", type="password"),
-                dbc.Button("Connect", id="connect-button", color="primary", className="mr-1"),
-                dbc.Button("Disconnect", id="disconnect-button", color="danger", className="mr-1"),
-                html.Div(id="connection-status")
-            ], width=6),
-            dbc.Col([
-                dbc.Input(id="client_ip", placeholder="Client IP", type="text"),
-                dcc.Dropdown(
-                    id="command",
-                    options=[{"label": cmd['name'], "value": cmd_key} for cmd_key, cmd in CONFIG['AVAILABLE_COMMANDS'].items()],
-                    value=list(CONFIG['AVAILABLE_COMMANDS'].keys())[0]
-                ),
-                dbc.Button("Execute", id="execute-button", color="success", className="mr-1"),
-                dcc.Textarea(id="output", style={'width': '100%', 'height': 300})
-            ], width=6)
-        ])
+CLOSE_WAIT_S = 10  # seconds cancelled jobs get to stop before their runner is closed
+LIVE_OUTPUT_STYLE = {'display': 'block', 'maxHeight': 300, 'overflowY': 'auto'}
+HIDDEN_STYLE = {'display': 'none'}
+
+# Commands run on engine workers in this process, so they share the
+# registry's proxy connections; pages poll for progress with a dcc.Interval.
+ENGINE = ExecutionEngine(CONFIG['DASH_MAX_WORKERS'])
+
+app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
+server = app.server
+
+SERVING_LOCK = threading.Lock()
+_serving_pid: Optional[int] = None  # process holding DASH_LOCK_FILE
+_serving_file = None
+_refusal_logged = False
+
+
+def claim_serving_process() -> bool:
+    """Take DASH_LOCK_FILE for this process; False while another process holds it."""
+    global _serving_pid, _serving_file, _refusal_logged
+    if fcntl is None or _serving_pid == os.getpid():
+        return True
+    with SERVING_LOCK:
+        if _serving_pid == os.getpid():
+            return True
+        path = CONFIG['DASH_LOCK_FILE']
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        lock_file = open(path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            if not _refusal_logged:
+                _refusal_logged = True
+                logger.error(f"Another process is serving this dashboard ({path} is locked); "
+                             f"run it with a single worker, e.g. gunicorn --workers 1")
+            return False
+        _serving_pid, _serving_file = os.getpid(), lock_file
+        return True
+
+
+@server.before_request
+def single_process_only():
+    """Answer 503 in every process but the one serving: jobs live in its memory."""
+    if not claim_serving_process():
+        return ("This dashboard must be served by a single process "
+                "(e.g. gunicorn --workers 1 --threads 8 app:server).", 503)
+    return None
+
+app.layout = dbc.Container([
+    dbc.Row([
+        dbc.Col([
+            dbc.Input(id="host", placeholder="Host", type="text", value=CONFIG['DEFAULT_PROXY_HOST']),
+            dbc.Input(id="username", placeholder="Username", type="text", value=CONFIG['DEFAULT_PROXY_USER']),
+            dbc.Input(id="key_path", placeholder="Key Path", type="text", value=CONFIG['DEFAULT_KEY_PATH']),
+            dbc.Input(id="passphrase", placeholder="Passphrase", type="password"),
+            dbc.Button("Connect", id="connect-button", color="primary", className="mr-1"),
+            dbc.Button("Disconnect", id="disconnect-button", color="danger", className="mr-1"),
+            html.Div(id="connection-status")
+        ], width=6),
+        dbc.Col([
+            dbc.Input(id="client_ip", placeholder="Client IP", type="text"),
+            dcc.Dropdown(
+                id="command",
+                options=[{"label": cmd['name'], "value": cmd_key} for cmd_key, cmd in CONFIG['AVAILABLE_COMMANDS'].items()],
+                value=list(CONFIG['AVAILABLE_COMMANDS'].keys())[0]
+            ),
+            dbc.Button("Execute", id="execute-button", color="success", className="mr-1"),
+            dbc.Button("Cancel", id="cancel-button", color="secondary", className="mr-1", disabled=True),
+            html.Div(id="job-status"),
+            html.Pre(id="live-output", style=HIDDEN_STYLE),
+            # Engine job id of the command this page is running, polled while set
+            dcc.Store(id="job-id", data=None),
+            dcc.Interval(id="job-poll", interval=CONFIG['DASH_PROGRESS_INTERVAL'] * 1000, disabled=True),
+            dcc.Textarea(id="output", style={'width': '100%', 'height': 300})
+        ], width=6)
+    ]),
+    dbc.Row([
+        dbc.Col([
+            html.H5("History"),
+            dbc.Input(id="history-ip", placeholder="Client IP (all)", type="text"),
+            dcc.Dropdown(
+                id="history-command",
+                options=[{"label": cmd['name'], "value": cmd_key} for cmd_key, cmd in CONFIG['AVAILABLE_COMMANDS'].items()],
+                placeholder="Command (all)"
+            ),
+            dbc.Button("Search", id="history-search", color="primary", className="mr-1"),
+            dbc.Button("Newer", id="history-newer", color="secondary", className="mr-1", disabled=True),
+            dbc.Button("Older", id="history-older", color="secondary", className="mr-1", disabled=True),
+            # Cursors of the pages visited so far, for keyset paging in both directions
+            dcc.Store(id="history-cursors", data={'cursors': [None], 'next': None}),
+            dash_table.DataTable(
+                id="history-table",
+                columns=[{"name": name, "id": key} for key, name in (
+                    ('time', "Time"), ('client_ip', "Client IP"), ('command_key', "Command"),
+                    ('status', "Status"), ('elapsed', "Elapsed s"), ('summary', "Result")
+                )],
+                data=[],
+                style_cell={'textAlign': 'left', 'whiteSpace': 'normal'}
+            ),
+            html.Pre(id="history-detail", style={'maxHeight': 300, 'overflowY': 'auto'})
+        ], width=12)
     ])
+])
 
-    @app.callback(
-        Output("connection-status", "children"),
-        [Input("connect-button", "n_clicks"), Input("disconnect-button", "n_clicks")],
-        [State("host", "value"), State("username", "value"), State("key_path", "value"), State("passphrase", "value")]
-    )
-    def connect_disconnect(connect_clicks, disconnect_clicks, host, username, key_path, passphrase):
-        ctx = dash.callback_context
-        if not ctx.triggered:
-            return ""
-
-        button_id = ctx.triggered[0]['prop_id'].split('.')[0]
-
-        if button_id == "connect-button":
-            try:
-                ssh_client = SSHClient(host, username, key_path, passphrase)
-                ssh_client.connect()
-                return f"Connected to {host}"
-            except Exception as e:
-                return f"Connection Error: {str(e)}"
-
-        elif button_id == "disconnect-button":
-            try:
-                ssh_client.disconnect()
-                return "Disconnected"
-            except Exception as e:
-                return f"Disconnection Error: {str(e)}"
-
-    @app.callback(
-        Output("output", "value"),
-        [Input("execute-button", "n_clicks")],
-        [State("client_ip", "value"), State("command", "value")]
-    )
-    def execute_command(n_clicks, client_ip, command):
-        if n_clicks is None:
-            return ""
+@app.callback(
+    Output("connection-status", "children"),
+    [Input("connect-button", "n_clicks"), Input("disconnect-button", "n_clicks")],
+    [State("host", "value"), State("username", "value"), State("key_path", "value"), State("passphrase", "value")]
+)
+def connect_disconnect(connect_clicks, disconnect_clicks, host, username, key_path, passphrase):
+    ctx = dash.callback_context
+    if not ctx.triggered:
+        return ""
+
+    button_id = ctx.triggered[0]['prop_id'].split('.')[0]
 
+    if button_id == "connect-button":
         try:
-            command_config = CONFIG['AVAILABLE_COMMANDS'].get(command)
-            if not command_config:
-                raise ValueError(f"Unknown command: {command}")
+            REGISTRY.connect(host, username, key_path, passphrase or None)
+            return f"Connected to {host}"
+        except Exception as e:
+            return f"Connection Error: {str(e)}"
+
+    elif button_id == "disconnect-button":
+        try:
+            # Let the commands using this connection stop before closing it
+            jobs = cancel_jobs((host, username, key_path))
+            if not ENGINE.wait(jobs, CLOSE_WAIT_S):
+                logger.warning(f"Jobs still running after {CLOSE_WAIT_S}s, disconnecting anyway")
+            if not REGISTRY.disconnect(host, username, key_path):
+                return "Not connected"
+            return "Disconnected"
+        except Exception as e:
+            return f"Disconnection Error: {str(e)}"
+
+class ProgressStream:
+    """Collects command and logclient output while a job runs; the poll callback reads it."""
+    def __init__(self):
+        self._outputs = []
+        self._log_lines = []
+        self._lock = threading.Lock()
 
-            if isinstance(command_config.get('command'), str):
-                commands = [command_config['command']]
+    def on_output(self, index: int, output: str):
+        with self._lock:
+            self._outputs.append(output)
+
+    def on_log_line(self, line: str):
+        with self._lock:
+            self._log_lines.append(line)
+
+    def text(self) -> str:
+        with self._lock:
+            return "\n".join(self._outputs) + "\n--- logclient ---\n" + "\n".join(self._log_lines)
+
+class DashJob:
+    """Server-side state of one Execute click, kept until its page collects the result."""
+    def __init__(self, key: ConnectionKey, command_key: str):
+        self.key = key
+        self.command_key = command_key
+        self.progress = ProgressStream()
+        self.job: Optional[Job] = None
+        self.started = time.monotonic()
+        self.finished: Optional[float] = None
+        self.result = None
+        self.error: Optional[str] = None
+
+JOBS: Dict[int, DashJob] = {}
+JOBS_LOCK = threading.Lock()
+
+def start_job(host: str, username: str, key_path: str, passphrase: Optional[str],
+              client_ip: str, command_key: str, commands: List[str]) -> int:
+    record = DashJob((host, username, key_path), command_key)
+    # Held across submit so the job's events are never drained before it is known
+    with JOBS_LOCK:
+        record.job = ENGINE.submit(f"{command_key} on {client_ip}", run_job, record,
+                                   passphrase, client_ip, commands)
+        JOBS[record.job.job_id] = record
+    return record.job.job_id
+
+def run_job(job: Job, emit: Callable, record: DashJob, passphrase: Optional[str], client_ip: str, commands: List[str]):
+    command_runner = REGISTRY.get(*record.key) or REGISTRY.connect(*record.key, passphrase)
+    return command_runner.run_command_sequence(
+        client_ip,
+        commands,
+        on_log_line=record.progress.on_log_line,
+        on_output=record.progress.on_output,
+        cancel_event=job.cancel_event,
+        command_key=record.command_key
+    )
+
+def collect_events():
+    """Record finished jobs from the engine's events and forget results nobody collected."""
+    now = time.monotonic()
+    with JOBS_LOCK:
+        for event in ENGINE.drain():
+            record = JOBS.get(event.job_id)
+            if record is None or event.kind not in ('done', 'error', 'cancelled'):
+                continue
+            if event.kind == 'done':
+                record.result = event.payload
             else:
-                commands = command_config.get('commands', [])
+                record.error = "Cancelled" if event.kind == 'cancelled' else str(event.payload)
+            record.finished = now
+        for job_id in [job_id for job_id, record in JOBS.items()
+                       if record.finished is not None and now - record.finished > CONFIG['DASH_JOB_RETENTION']]:
+            del JOBS[job_id]
 
-            command_runner = CommandRunner(ssh_client)
-            outputs, logclient_output = command_runner.run_command_sequence(client_ip, commands)
+def cancel_jobs(key: ConnectionKey) -> List[Job]:
+    """Cancel the running jobs on one connection and return them."""
+    with JOBS_LOCK:
+        jobs = [record.job for record in JOBS.values() if record.key == key and record.finished is None]
+    for job in jobs:
+        ENGINE.cancel(job.job_id)
+    return jobs
 
-            return "\n".join(outputs) + "\n" + logclient_output
-        except Exception as e:
-            return f"Command Error: {str(e)}"
+def finished_view(record: DashJob):
+    """Output text and status line for a finished job."""
+    if record.error == "Cancelled":
+        return record.progress.text(), "Cancelled"
+    if record.error is not None:
+        return f"Command Error: {record.error}", "Failed"
+    outputs, logclient_output = record.result
+    status = f"Done in {record.finished - record.started:.1f}s"
+    parsed = parse_outputs(record.command_key, outputs)
+    if parsed:
+        status += f": {format_parsed(parsed)}"
+    return "\n".join(outputs) + "\n" + logclient_output, status
+
+# Outputs for a page with no job: polling off, Execute on, Cancel off, live pane hidden
+IDLE = (None, True, False, True, HIDDEN_STYLE, "")
+
+@app.callback(
+    [Output("job-id", "data"), Output("job-poll", "disabled"), Output("execute-button", "disabled"),
+     Output("cancel-button", "disabled"), Output("live-output", "style"), Output("live-output", "children"),
+     Output("output", "value"), Output("job-status", "children")],
+    [Input("execute-button", "n_clicks"), Input("cancel-button", "n_clicks"), Input("job-poll", "n_intervals")],
+    [State("job-id", "data"), State("client_ip", "value"), State("command", "value"),
+     State("host", "value"), State("username", "value"), State("key_path", "value"), State("passphrase", "value")],
+    prevent_initial_call=True
+)
+def execute_command(execute_clicks, cancel_clicks, n_intervals, job_id, client_ip, command,
+                    host, username, key_path, passphrase):
+    unchanged = (dash.no_update,) * 8
+    button_id = dash.callback_context.triggered[0]['prop_id'].split('.')[0]
+
+    if button_id == "execute-button":
+        if job_id is not None:
+            return unchanged
+        try:
+            commands = get_command_list(command)
+        except ValueError as e:
+            return IDLE + (f"Command Error: {str(e)}", "Failed")
+        job_id = start_job(host, username, key_path, passphrase or None, client_ip, command, commands)
+        return (job_id, False, True, False, LIVE_OUTPUT_STYLE, "", dash.no_update, "Running")
+
+    if button_id == "cancel-button":
+        if job_id is None:
+            return unchanged
+        ENGINE.cancel(job_id)
+        return unchanged[:7] + ("Cancelling",)
+
+    if job_id is None:
+        return unchanged
+    collect_events()
+    with JOBS_LOCK:
+        record = JOBS.get(job_id)
+        if record is not None and record.finished is not None:
+            del JOBS[job_id]
+    if record is None:
+        return IDLE + (dash.no_update, "Result no longer available")
+    if record.finished is None:
+        return unchanged[:5] + (record.progress.text(),) + unchanged[6:]
+    return IDLE + finished_view(record)
+
+def shutdown():
+    """Cancel running commands, let them stop, then close every proxy connection."""
+    jobs = ENGINE.active_jobs()
+    ENGINE.shutdown()
+    ENGINE.wait(jobs, CLOSE_WAIT_S)
+    REGISTRY.close_all()
+
+atexit.register(shutdown)
+
+def history_row(run) -> dict:
+    """Table row for a run's metadata."""
+    return {
+        'id': run['id'],
+        'time': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run['ts'])),
+        'client_ip': run['client_ip'],
+        'command_key': run['command_key'],
+        'status': "OK" if run['ok'] else run['error'],
+        'elapsed': run['elapsed'],
+        'summary': format_parsed(run['parsed']) if run['parsed'] else "",
+    }
+
+@app.callback(
+    [Output("history-table", "data"), Output("history-cursors", "data"),
+     Output("history-newer", "disabled"), Output("history-older", "disabled")],
+    [Input("history-search", "n_clicks"), Input("history-older", "n_clicks"), Input("history-newer", "n_clicks")],
+    [State("history-ip", "value"), State("history-command", "value"), State("history-cursors", "data")],
+    prevent_initial_call=True
+)
+def page_history(search_clicks, older_clicks, newer_clicks, client_ip, command_key, state):
+    history = get_history()
+    if history is None:
+        return [], {'cursors': [None], 'next': None}, True, True
+
+    button_id = dash.callback_context.triggered[0]['prop_id'].split('.')[0]
+    cursors = state['cursors']
+    if button_id == "history-older" and state['next']:
+        cursors = cursors + [state['next']]
+    elif button_id == "history-newer" and len(cursors) > 1:
+        cursors = cursors[:-1]
+    elif button_id == "history-search":
+        cursors = [None]
+
+    cursor = tuple(cursors[-1]) if cursors[-1] else None
+    page = history.page(client_ip=(client_ip or "").strip() or None, command_key=command_key, cursor=cursor)
+    return ([history_row(run) for run in page.rows], {'cursors': cursors, 'next': page.next_cursor},
+            len(cursors) == 1, page.next_cursor is None)
+
+@app.callback(
+    Output("history-detail", "children"),
+    [Input("history-table", "active_cell")],
+    [State("history-table", "data")],
+    prevent_initial_call=True
+)
+def show_history_detail(active_cell, rows):
+    history = get_history()
+    if not active_cell or history is None:
+        return ""
+    run = history.get(rows[active_cell['row']]['id'])
+    if run is None:
+        return "Run no longer in history"
+    outputs = "\n".join(run.get('outputs') or [])
+    return f"{outputs}\n--- logclient ---\n{run.get('logclient') or ''}"
 
-    if __name__ == "__main__":
-        app.run_server(debug=True)
+if __name__ == "__main__":
+    app.run_server(debug=True)
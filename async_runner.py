@@ -0,0 +1,697 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import CancelledError
+from typing import Any, Awaitable, Callable, Iterable, Iterator, List, Match, Optional, Pattern, Tuple, TypeVar
+
+try:
+    import asyncssh
+except ImportError:  # in requirements.txt, but only the asyncio runner needs it
+    asyncssh = None
+
+from cache import ResultCache
+from config import CONFIG
+from history import RunHistory
+from logstream import LogclientStream
+from metrics import METRICS
+from plans import Plan, Stage
+from recvbuf import CHUNK_SIZE, BufferMatch, Output, ReceiveBuffer
+from resilience import CircuitOpenError, retry_async
+from rolling import RebootResult, RollingReboot
+from runner_core import (AUTH_PROMPT_PATTERN, CommandResult, CommandTimeoutError, FleetResult, NestedLogin,
+                         PlanProgress, RunnerBase, SequenceRun, batch_end_pattern, batch_script, bytes_pattern,
+                         combined_output, command_end_pattern, command_script, fleet_member_async, kill_command,
+                         logclient_command, output_buffer, ready_script, skipped_member, split_command,
+                         split_exec_batch, split_shell_batch)
+from ssh_client import CommandRunner, SSHClient
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+def _is_transient(error: BaseException) -> bool:
+    """Like resilience.is_transient, for asyncssh's errors."""
+    if isinstance(error, (TimeoutError, CircuitOpenError, asyncssh.PermissionDenied, asyncssh.ChannelOpenError)):
+        return False
+    return isinstance(error, (ConnectionResetError, ConnectionAbortedError, EOFError,
+                              asyncssh.ConnectionLost, asyncssh.ProtocolError))
+
+def create_runner(ssh_client: SSHClient, hop_mode: Optional[str] = None, kind: Optional[str] = None,
+                  **kwargs) -> Any:
+    """Connected runner for the proxy: a CommandRunner or, with ``kind`` (default CONFIG['RUNNER']) 'async', an AsyncCommandRunner.
+
+    Both take the same calls and return the same results. Only the
+    connection the runner uses is opened: ``ssh_client`` itself for the
+    threaded runner, the runner's own asyncssh connection for the async
+    one (``ssh_client`` then only carries the connection settings).
+    Raises if the connection fails.
+    """
+    kind = kind or CONFIG['RUNNER']
+    if kind == 'thread':
+        if not ssh_client.connected:
+            ssh_client.connect()
+        return CommandRunner(ssh_client, hop_mode=hop_mode, **kwargs)
+    if kind != 'async':
+        raise ValueError(f"Unknown runner: {kind}")
+    runner = AsyncCommandRunner(ssh_client, hop_mode=hop_mode, **kwargs)
+    try:
+        runner.connect()
+    except Exception:
+        runner.close()
+        raise
+    return runner
+
+class AsyncClientSession:
+    """Session to a single client on the runner's event loop.
+
+    In direct mode ``conn`` is the client's own SSH connection, tunnelled
+    through the proxy connection. In shell mode ``conn`` is a separate proxy
+    connection and ``shell`` the interactive process the nested ``ssh``
+    runs in.
+    """
+    def __init__(self, client_ip: str, conn: "asyncssh.SSHClientConnection",
+                 shell: Optional["asyncssh.SSHClientProcess"] = None):
+        self.client_ip = client_ip
+        self.conn = conn
+        self.shell = shell
+        self.alive = True
+        self.last_result: Optional[CommandResult] = None
+
+    @property
+    def interactive(self) -> bool:
+        return self.shell is not None
+
+    def close(self):
+        self.alive = False
+        self.conn.close()
+
+class AsyncLogclientStream(LogclientStream):
+    """LogclientStream fed by a task on the event loop instead of a reader thread.
+
+    ``channel`` is the asyncssh process running logclient (bytes streams,
+    with a PTY so Ctrl-C reaches it).
+    """
+    def start(self) -> "AsyncLogclientStream":
+        self._closing = False
+        self._task = asyncio.ensure_future(self._read_task())
+        return self
+
+    @property
+    def running(self) -> bool:
+        return not self._task.done()
+
+    def stop(self, timeout: float) -> Output:
+        raise RuntimeError("AsyncLogclientStream is stopped with stop_async")
+
+    async def stop_async(self, timeout: float) -> Output:
+        """Interrupt logclient, wait up to ``timeout`` for it to exit and return the output."""
+        try:
+            self.channel.stdin.write(b"\x03")  # Ctrl-C
+        except Exception as e:
+            logger.debug(f"Could not interrupt logclient for {self.client_ip}: {str(e)}")
+
+        done, _ = await asyncio.wait([self._task], timeout=timeout)
+        if not done:
+            logger.warning(f"Logclient for {self.client_ip} did not exit within {timeout}s")
+        self._closing = True
+        self.channel.close()
+        await asyncio.wait([self._task], timeout=1)
+        if self._task.done():
+            self._seal_spill()
+        return self.text()
+
+    async def _read_task(self):
+        try:
+            while True:
+                chunk = await self.channel.stdout.read(CHUNK_SIZE)
+                if not chunk:
+                    self.exited = not self._closing
+                    break
+                self.bytes_received += len(chunk)
+                if METRICS.enabled:
+                    METRICS.incr('logclient_recv_calls')
+                    METRICS.incr('logclient_bytes_received', len(chunk))
+                self._feed(self._decoder.decode(chunk))
+        except Exception as e:
+            if not self._closing:
+                logger.error(f"Error reading logclient output for {self.client_ip}: {str(e)}")
+        finally:
+            self._feed(self._decoder.decode(b"", final=True), final=True)
+
+class AsyncCommandRunner(RunnerBase):
+    """CommandRunner counterpart that multiplexes client sessions on one asyncio event loop.
+
+    Every session is a handful of coroutines instead of threads, so
+    thousands of boxes can be in flight at once: at most
+    ASYNC_MAX_SESSIONS sessions and ASYNC_MAX_CONNECTS handshakes, bounded
+    by semaphores. Reads wait on the event loop with deadlines rather than
+    polling. The loop runs in a thread of its own and the public methods
+    are blocking, with the signatures and results of CommandRunner's, so
+    callers switch runners without other changes. ``on_log_line`` and
+    ``on_output`` are called on the loop thread and must not block.
+
+    Unlike CommandRunner there is no session pool (each sequence opens its
+    own session) and no ``client_session``.
+    """
+    def __init__(self, ssh_client: SSHClient, hop_mode: Optional[str] = None,
+                 result_cache: Optional[ResultCache] = None,
+                 history: Optional[RunHistory] = None):
+        if asyncssh is None:
+            raise RuntimeError("The async runner (RUNNER='async', --runner async) needs asyncssh: "
+                               "pip install -r requirements.txt")
+        super().__init__(ssh_client, hop_mode, result_cache, history)
+        self._proxy: Optional["asyncssh.SSHClientConnection"] = None
+        self._proxy_lock: Optional[asyncio.Lock] = None
+        self._session_slots: Optional[asyncio.Semaphore] = None
+        self._connect_slots: Optional[asyncio.Semaphore] = None
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="async-runner", daemon=True)
+        self._thread.start()
+        self._call(self._setup())
+
+    async def _setup(self):
+        # Created on the loop they are used on
+        self._proxy_lock = asyncio.Lock()
+        self._session_slots = asyncio.Semaphore(CONFIG['ASYNC_MAX_SESSIONS'])
+        self._connect_slots = asyncio.Semaphore(CONFIG['ASYNC_MAX_CONNECTS'])
+
+    def _call(self, coro: Awaitable[T]) -> T:
+        """Run a coroutine on the runner's loop and wait for its result."""
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("Blocking AsyncCommandRunner call made from its own event loop")
+        try:
+            return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+        except asyncio.CancelledError as e:
+            # The hand-over converts a CancelledError raised by the coroutine to asyncio's
+            raise CancelledError(*e.args) from None
+
+    @property
+    def connected(self) -> bool:
+        """Whether the runner's own proxy connection is open."""
+        return self._proxy is not None and not self._loop.is_closed()
+
+    def connect(self):
+        """Connect to the proxy and reap logclients orphaned by crashed runs."""
+        self._call(self._proxy_connection())
+        self.reap_orphaned_logclients()
+
+    def close(self):
+        """Kill logclients still running, close the proxy connection and stop the loop."""
+        if self._loop.is_closed():
+            return
+        try:
+            self._call(self._shutdown())
+        except Exception as e:
+            logger.error(f"Error closing async runner: {str(e)}")
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+
+    async def _shutdown(self):
+        await self._kill_logclients(self.logclients.pids())
+        proxy, self._proxy = self._proxy, None
+        if proxy is not None:
+            proxy.close()
+            await proxy.wait_closed()
+
+    def run_fleet(self, client_ips: Iterable[str], commands: List[str],
+                  max_workers: Optional[int] = None,
+                  timeout: Optional[float] = None,
+                  command_key: Optional[str] = None,
+                  throttle: Optional[Callable[[], None]] = None) -> Iterator[FleetResult]:
+        """Run the same command sequence on many clients concurrently (see CommandRunner.run_fleet).
+
+        ``max_workers`` defaults to ASYNC_FLEET_MAX_WORKERS, deliberately
+        far below what the runner can multiplex: every box costs the proxy
+        a logclient and a forwarded connection. Pass a larger value (up to
+        ASYNC_MAX_SESSIONS, which caps it anyway) for proxies known to cope.
+        """
+        self._call(self._proxy_connection())
+        ips = list(dict.fromkeys(client_ips))
+        workers = max(1, min(max_workers or CONFIG['ASYNC_FLEET_MAX_WORKERS'], len(ips) or 1))
+        logger.info(f"Running fleet sweep on {len(ips)} clients with {workers} concurrent sessions")
+
+        results: "queue.Queue[Optional[FleetResult]]" = queue.Queue()
+        started, finished = threading.Event(), threading.Event()
+        future = asyncio.run_coroutine_threadsafe(
+            self._fleet(ips, commands, workers, timeout, command_key, throttle, results.put, started, finished),
+            self._loop
+        )
+        # A task cancelled before it starts would never run its cleanup
+        started.wait()
+        try:
+            while True:
+                result = results.get()
+                if result is None:
+                    break
+                yield result
+            future.result()
+        finally:
+            # Stop clients still running if the consumer abandons the iterator early
+            future.cancel()
+            finished.wait()
+            self.kill_tracked_logclients()
+
+    async def _fleet(self, client_ips: List[str], commands: List[str], workers: int,
+                     timeout: Optional[float], command_key: Optional[str],
+                     throttle: Optional[Callable[[], None]],
+                     emit: Callable[[Optional[FleetResult]], None],
+                     started: threading.Event, finished: threading.Event):
+        started.set()
+        slots = asyncio.Semaphore(workers)
+        tasks = set()
+
+        def run(client_ip: str):
+            return self._run_command_sequence(client_ip, commands, timeout, command_key=command_key)
+
+        async def member(client_ip: str):
+            try:
+                emit(await fleet_member_async(client_ip, run))
+            finally:
+                slots.release()
+
+        try:
+            for position, client_ip in enumerate(client_ips):
+                await slots.acquire()
+                try:
+                    if throttle is not None:
+                        # Rate limiters block; keep them off the loop
+                        await asyncio.get_running_loop().run_in_executor(None, throttle)
+                except Exception as e:
+                    # The sweep is being stopped: the rest are never started
+                    slots.release()
+                    logger.debug(f"Skipping {len(client_ips) - position} fleet members: {str(e)}")
+                    for skipped_ip in client_ips[position:]:
+                        emit(skipped_member(skipped_ip, e))
+                    break
+                task = asyncio.ensure_future(member(client_ip))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(set(tasks))
+        finally:
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.wait(set(tasks))
+            emit(None)
+            finished.set()
+
+    def rolling_reboot(self, client_ips: Iterable[str], command_key: str = 'reboot',
+                       wave_size: Optional[int] = None, max_outage: Optional[float] = None,
+                       stop_event: Optional[threading.Event] = None) -> Iterator[RebootResult]:
+        """Reboot the clients in waves (see CommandRunner.rolling_reboot)."""
+        return RollingReboot(self, command_key, wave_size=wave_size, max_outage=max_outage,
+                             stop_event=stop_event).run(client_ips)
+
+    def probe_reachable(self, client_ip: str, timeout: float) -> bool:
+        """Whether the client's sshd answers through the proxy (see CommandRunner.probe_reachable)."""
+        return self._call(self._probe_reachable(client_ip, timeout))
+
+    async def _probe_reachable(self, client_ip: str, timeout: float) -> bool:
+        if self.hop_mode == 'shell':
+            try:
+                # As in CommandRunner, ``timeout`` bounds the nested login; the
+                # proxy connection has CONNECTION_TIMEOUT of its own
+                session = await self._connect_via_shell(client_ip, timeout)
+            except Exception:
+                return False
+            self._finish_client_session(session)
+            return True
+
+        proxy = await self._proxy_connection()
+        try:
+            reader, writer = await asyncio.wait_for(
+                proxy.open_connection(client_ip, CONFIG['CLIENT_PORT']), timeout
+            )
+        except Exception as e:
+            logger.debug(f"Probe of {client_ip} failed: {str(e)}")
+            return False
+        try:
+            return (await asyncio.wait_for(reader.read(64), timeout)).startswith(b"SSH-")
+        except Exception as e:
+            logger.debug(f"Probe of {client_ip} failed: {str(e)}")
+            return False
+        finally:
+            writer.close()
+
+    def run_command_sequence(self, client_ip: str, commands: List[str],
+                             timeout: Optional[float] = None,
+                             on_log_line: Optional[Callable[[str], None]] = None,
+                             on_output: Optional[Callable[[int, str], None]] = None,
+                             cancel_event: Optional[threading.Event] = None,
+                             batch: Optional[bool] = None,
+                             command_key: Optional[str] = None) -> Tuple[List[str], str]:
+        """Run a sequence of commands on the client through the proxy (see CommandRunner.run_command_sequence)."""
+        return self._call(self._run_command_sequence(
+            client_ip, commands, timeout, on_log_line, on_output, cancel_event, batch, command_key
+        ))
+
+    async def _run_command_sequence(self, client_ip: str, commands: List[str],
+                                    timeout: Optional[float] = None,
+                                    on_log_line: Optional[Callable[[str], None]] = None,
+                                    on_output: Optional[Callable[[int, str], None]] = None,
+                                    cancel_event: Optional[threading.Event] = None,
+                                    batch: Optional[bool] = None,
+                                    command_key: Optional[str] = None) -> Tuple[List[str], str]:
+        sequence = SequenceRun(self, client_ip, commands, command_key, batch)
+        with METRICS.context(client_ip=client_ip):
+            cached = sequence.cached(on_output)
+            if cached is not None:
+                return cached
+            with sequence.attempt(), METRICS.span('sequence'):
+                async with self._session_slots:
+                    outputs, logclient_output = await self._run_sequence(
+                        client_ip, sequence.plan, timeout, on_log_line, on_output, cancel_event, sequence.batch
+                    )
+            return sequence.finished(outputs, logclient_output)
+
+    async def _run_sequence(self, client_ip: str, plan: Plan, timeout: Optional[float],
+                            on_log_line: Optional[Callable[[str], None]],
+                            on_output: Optional[Callable[[int, str], None]],
+                            cancel_event: Optional[threading.Event],
+                            batch: bool) -> Tuple[List[str], str]:
+        with self._breaker_guard(self.proxy_breaker, self.ssh_client.host):
+            logclient_stream = await self._start_logclient(client_ip)
+        if on_log_line:
+            logclient_stream.subscribe(on_log_line, replay=True)
+
+        progress = PlanProgress(plan, client_ip, batch, on_output, cancel_event)
+        try:
+            with self._breaker_guard(self.client_breaker, client_ip):
+                session = await self._connect_to_client(client_ip)
+                try:
+                    for stage in progress.stages():
+                        progress.record(stage, await self._run_stage(session, stage, timeout))
+                finally:
+                    self._finish_client_session(session)
+        except BaseException as e:
+            # Also stop logclient when the task is cancelled
+            if isinstance(e, Exception):
+                logger.error(f"Error during command execution: {str(e)}")
+            await self._get_logclient_output(logclient_stream)
+            raise
+
+        logclient_output = await self._get_logclient_output(logclient_stream)
+        return progress.outputs(), logclient_output
+
+    async def _run_stage(self, session: AsyncClientSession, stage: Stage,
+                         timeout: Optional[float]) -> List[Output]:
+        """Run a plan stage's steps in one round trip (see CommandRunner._run_stage)."""
+        commands = [step.command for step in stage.steps]
+        if len(commands) == 1:
+            return [await self._run_client_command(session, commands[0], timeout)]
+        if stage.concurrent and not session.interactive:
+            channels = asyncio.Semaphore(CONFIG['PLAN_GROUP_MAX_CHANNELS'])
+
+            async def run(command: str) -> Output:
+                async with channels:
+                    return await self._run_client_command(session, command, timeout)
+
+            with METRICS.span('group', commands=len(commands)):
+                return list(await asyncio.gather(*(run(command) for command in commands)))
+        return [combined_output(result) for result in await self._run_client_batch(session, commands, timeout)]
+
+    async def _proxy_connection(self) -> "asyncssh.SSHClientConnection":
+        """The shared proxy connection, (re)connecting if it is not open."""
+        async with self._proxy_lock:
+            if self._proxy is None:
+                with METRICS.span('proxy_connect', host=self.ssh_client.host):
+                    self._proxy = await retry_async(
+                        self._open_proxy_connection,
+                        CONFIG['RETRY_ATTEMPTS'], CONFIG['RETRY_BASE_DELAY'], CONFIG['RETRY_MAX_DELAY'],
+                        description=f"Connecting to {self.ssh_client.host}", should_retry=_is_transient
+                    )
+                asyncio.ensure_future(self._watch_proxy(self._proxy))
+                logger.info(f"Successfully connected to {self.ssh_client.host}")
+            return self._proxy
+
+    async def _watch_proxy(self, connection: "asyncssh.SSHClientConnection"):
+        await connection.wait_closed()
+        if self._proxy is connection:
+            logger.warning(f"Connection to {self.ssh_client.host} was lost")
+            self._proxy = None
+
+    async def _open_proxy_connection(self) -> "asyncssh.SSHClientConnection":
+        timeout = CONFIG['CONNECTION_TIMEOUT']
+        return await asyncio.wait_for(asyncssh.connect(
+            self.ssh_client.host,
+            port=self.ssh_client.port,
+            username=self.ssh_client.username,
+            client_keys=[self.ssh_client.key_path],
+            passphrase=self.ssh_client.passphrase,
+            known_hosts=None
+        ), timeout)
+
+    async def _start_logclient(self, client_ip: str) -> AsyncLogclientStream:
+        """Start logclient for the client and stream its output (see CommandRunner._start_logclient)."""
+        proxy = await self._proxy_connection()
+        cmd = logclient_command(client_ip)
+        with METRICS.span('logclient_start'):
+            process = await retry_async(
+                lambda: asyncio.wait_for(proxy.create_process(cmd, term_type='xterm', encoding=None),
+                                         CONFIG['CONNECTION_TIMEOUT']),
+                CONFIG['RETRY_ATTEMPTS'], CONFIG['RETRY_BASE_DELAY'], CONFIG['RETRY_MAX_DELAY'],
+                description=f"Starting logclient for {client_ip}", should_retry=_is_transient
+            )
+        return self._logclient_stream(AsyncLogclientStream, process, client_ip)
+
+    async def _get_logclient_output(self, stream: AsyncLogclientStream) -> Output:
+        """Stop logclient and return its buffered output (see CommandRunner._get_logclient_output)."""
+        started = time.monotonic()
+        with METRICS.span('logclient_drain'):
+            try:
+                output = await stream.stop_async(self._drain_timeout())
+            except Exception as e:
+                logger.error(f"Error collecting logclient output: {str(e)}")
+                output = stream.text()
+
+        pid = self._logclient_drained(stream, started)
+        if pid is not None:
+            await self._kill_logclients([pid])
+            self.logclients.remove(pid)
+        return output
+
+    async def _connect_to_client(self, client_ip: str) -> AsyncClientSession:
+        """Connect to the client through the proxy, retrying transient failures."""
+        if self.hop_mode == 'direct':
+            connect = self._connect_direct
+        elif self.hop_mode == 'shell':
+            connect = self._connect_via_shell
+        else:
+            raise ValueError(f"Unknown client hop mode: {self.hop_mode}")
+
+        timeout = self.latency.timeout((client_ip, 'connect'), CONFIG['CONNECTION_TIMEOUT'])
+        async with self._connect_slots:
+            with METRICS.span('client_connect', hop_mode=self.hop_mode):
+                started = time.monotonic()
+                session = await retry_async(
+                    lambda: asyncio.wait_for(connect(client_ip, timeout), timeout),
+                    CONFIG['RETRY_ATTEMPTS'], CONFIG['RETRY_BASE_DELAY'], CONFIG['RETRY_MAX_DELAY'],
+                    description=f"Connecting to client {client_ip}", should_retry=_is_transient
+                )
+                self.latency.observe((client_ip, 'connect'), time.monotonic() - started)
+                return session
+
+    async def _connect_direct(self, client_ip: str, timeout: float) -> AsyncClientSession:
+        """Open an SSH connection to the client tunnelled through the proxy connection."""
+        proxy = await self._proxy_connection()
+        try:
+            conn = await asyncssh.connect(
+                client_ip,
+                port=CONFIG['CLIENT_PORT'],
+                tunnel=proxy,
+                username=CONFIG['CLIENT_USER'],
+                password=CONFIG['CLIENT_PASSWORD'],
+                known_hosts=None,
+                client_keys=None,
+                agent_path=None
+            )
+            return AsyncClientSession(client_ip, conn)
+        except Exception as e:
+            logger.error(f"Failed to connect to client {client_ip}: {str(e)}")
+            raise
+
+    async def _connect_via_shell(self, client_ip: str, timeout: float) -> AsyncClientSession:
+        """Connect to the client with a nested interactive ssh on a proxy connection of its own."""
+        conn = await self._open_proxy_connection()
+        try:
+            shell = await conn.create_process(term_type='xterm', encoding=None)
+            await self._sync_shell(shell, CONFIG['CONNECTION_TIMEOUT'])
+            shell.stdin.write(f"ssh -o StrictHostKeyChecking=no {CONFIG['CLIENT_USER']}@{client_ip}\n".encode())
+            await self._handle_authentication(shell, timeout)
+            return AsyncClientSession(client_ip, conn, shell)
+        except BaseException as e:
+            conn.close()
+            if isinstance(e, Exception):
+                logger.error(f"Failed to connect to client {client_ip}: {str(e)}")
+            raise
+
+    async def _handle_authentication(self, shell: "asyncssh.SSHClientProcess", timeout: float):
+        """Answer the nested ssh prompts until the client shell is ready (see CommandRunner)."""
+        with METRICS.span('authenticate'):
+            deadline = time.monotonic() + timeout
+            login = NestedLogin(CONFIG['CLIENT_PASSWORD'], asyncssh.PermissionDenied)
+            while not login.done:
+                _, match = await self._read_until(shell, AUTH_PROMPT_PATTERN, deadline - time.monotonic())
+                reply = login.answer(match)
+                if reply:
+                    shell.stdin.write(reply.encode())
+
+            await self._sync_shell(shell, deadline - time.monotonic())
+
+    async def _sync_shell(self, shell: "asyncssh.SSHClientProcess", timeout: float):
+        """Wait until the shell has processed everything sent so far."""
+        script, pattern = ready_script(uuid.uuid4().hex)
+        shell.stdin.write(script.encode())
+        await self._read_until(shell, pattern, timeout)
+
+    async def _read_until(self, shell: "asyncssh.SSHClientProcess", pattern: Pattern,
+                          timeout: float) -> Tuple[str, Optional[Match]]:
+        buffer = ReceiveBuffer()
+        await self._receive_until(shell.stdout, buffer, bytes_pattern(pattern), timeout)
+        output = buffer.text()
+        return output, pattern.search(output)
+
+    async def _receive_until(self, stream: "asyncssh.SSHReader", buffer: ReceiveBuffer,
+                             pattern: Pattern, timeout: float) -> BufferMatch:
+        """Read into buffer until the bytes pattern matches.
+
+        Raises CommandTimeoutError with the partial output when the deadline
+        passes first.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            found = buffer.search_new(pattern)
+            if found:
+                return found
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                METRICS.incr('timeouts')
+                raise CommandTimeoutError(f"Timed out after {timeout:.1f}s waiting for output", buffer.text())
+            try:
+                chunk = await asyncio.wait_for(stream.read(CHUNK_SIZE), remaining)
+            except asyncio.TimeoutError:
+                continue
+            if METRICS.enabled:
+                METRICS.incr('recv_calls')
+                METRICS.incr('bytes_received', len(chunk))
+            if not chunk:
+                raise ConnectionError("Channel closed before expected output arrived")
+            buffer.append(chunk)
+
+    async def _read_to_eof(self, stream: "asyncssh.SSHReader", buffer: ReceiveBuffer):
+        while True:
+            chunk = await stream.read(CHUNK_SIZE)
+            if METRICS.enabled:
+                METRICS.incr('recv_calls')
+                METRICS.incr('bytes_received', len(chunk))
+            if not chunk:
+                return
+            buffer.append(chunk)
+
+    async def _exec(self, session: AsyncClientSession, command: str,
+                    timeout: float) -> Tuple[ReceiveBuffer, ReceiveBuffer, int]:
+        """Run command on a directly connected client; returns capped stdout and stderr buffers and the exit status."""
+        process = await session.conn.create_process(command, encoding=None)
+        buffers = output_buffer(), output_buffer()
+        try:
+            await asyncio.wait_for(asyncio.gather(
+                self._read_to_eof(process.stdout, buffers[0]),
+                self._read_to_eof(process.stderr, buffers[1]),
+            ), timeout)
+            if process.exit_status is None:
+                # sshd may send the status after EOF, but always before closing
+                await asyncio.wait_for(process.wait_closed(), timeout)
+        except asyncio.TimeoutError:
+            METRICS.incr('timeouts')
+            raise CommandTimeoutError(f"Timed out after {timeout:.1f}s waiting for output", buffers[0].text())
+        finally:
+            process.close()
+        return buffers[0], buffers[1], -1 if process.exit_status is None else process.exit_status
+
+    async def _run_client_command(self, session: AsyncClientSession, command: str,
+                                  timeout: Optional[float] = None) -> Output:
+        """Execute command on client and return output (see CommandRunner._run_client_command)."""
+        if not session.alive:
+            raise ConnectionError(f"Session to {session.client_ip} has been closed")
+
+        latency_key = (session.client_ip, command)
+        timeout = self.latency.timeout(latency_key, timeout or CONFIG['COMMAND_TIMEOUT'])
+        started = time.monotonic()
+        with METRICS.span('command', command=command):
+            if not session.interactive:
+                out, err, status = await self._exec(session, command, timeout)
+                self.latency.observe(latency_key, time.monotonic() - started)
+                session.last_result = CommandResult(out.text(), err.text(), status)
+                return combined_output(session.last_result)
+
+            token = uuid.uuid4().hex
+            buffer = output_buffer()
+            session.shell.stdin.write(command_script(token, command).encode())
+            end = await self._receive_until(session.shell.stdout, buffer, command_end_pattern(token), timeout)
+            self.latency.observe(latency_key, time.monotonic() - started)
+
+            output, status = split_command(buffer, token, end)
+            if status is None:
+                # The client dropped the connection; the shell belongs to the proxy again
+                session.alive = False
+                status = -1
+            session.last_result = CommandResult(output, "", status)
+            return output
+
+    async def _run_client_batch(self, session: AsyncClientSession, commands: List[str],
+                                timeout: Optional[float] = None) -> List[CommandResult]:
+        """Run all commands on the client in one round trip (see CommandRunner._run_client_batch)."""
+        if not session.alive:
+            raise ConnectionError(f"Session to {session.client_ip} has been closed")
+
+        token = uuid.uuid4().hex
+        latency_key = (session.client_ip, tuple(commands))
+        budget = self.latency.timeout(latency_key, (timeout or CONFIG['COMMAND_TIMEOUT']) * len(commands))
+        started = time.monotonic()
+        with METRICS.span('batch', commands=len(commands)):
+            if not session.interactive:
+                out, err, _ = await self._exec(session, batch_script(token, commands, stderr_markers=True), budget)
+                results = split_exec_batch(out, err, token)
+            else:
+                buffer = output_buffer()
+                session.shell.stdin.write(batch_script(token, commands).encode())
+                end = await self._receive_until(session.shell.stdout, buffer,
+                                                batch_end_pattern(token, len(commands)), budget)
+                results, attached = split_shell_batch(buffer, token, end)
+                if not attached:
+                    session.alive = False
+
+        if len(results) == len(commands):
+            self.latency.observe(latency_key, time.monotonic() - started)
+        if results:
+            session.last_result = results[-1]
+        return results
+
+    def _finish_client_session(self, session: AsyncClientSession):
+        if session.interactive and session.alive:
+            try:
+                session.shell.stdin.write(b"exit\n")
+            except Exception as e:
+                logger.debug(f"Could not exit shell on {session.client_ip}: {str(e)}")
+        session.close()
+
+    def kill_logclients(self, pids: List[int]) -> Tuple[str, str]:
+        """Kill the given logclient PIDs on the proxy with one exec (see CommandRunner.kill_logclients)."""
+        return self._call(self._kill_logclients(pids))
+
+    async def _kill_logclients(self, pids: List[int]) -> Tuple[str, str]:
+        if not pids or self._proxy is None:
+            return "", ""
+        with METRICS.span('logclient_kill', pids=len(pids)):
+            try:
+                result = await self._proxy.run(kill_command(pids), check=False, timeout=CONFIG['COMMAND_TIMEOUT'])
+            except Exception as e:
+                logger.error(f"Could not kill logclient processes {pids}: {str(e)}")
+                return "", str(e)
+            return self._logclients_killed(pids, result.stdout or "", result.stderr or "")
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""Latency benchmark for CommandRunner against the local SSH simulator.
+
+Runs a command sequence against 1, 10, 100 and 1000 simulated boxes in each
+execution mode and reports wall-clock time, per-phase time and memory, so
+performance changes in ssh_client.py can be measured without production
+hardware:
+
+    python benchmark.py --sizes 1 10 100 --modes sequential fleet pooled
+    python benchmark.py --latency 0.02 --json results.json
+    python benchmark.py --runner async --modes fleet --workers 500 --sizes 1000
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+os.environ.setdefault('KAL_TOOLS_SKIP_DOTENV', '1')
+
+from config import CONFIG, get_command_list
+from metrics import METRICS
+from simulator import SimulatorConfig, SshSimulator
+from async_runner import create_runner
+from ssh_client import SSHClient
+
+logger = logging.getLogger(__name__)
+
+MODES = ('sequential', 'fleet', 'pooled')
+
+# Spans reported as phases of a run, in pipeline order
+PHASES = ('logclient_start', 'client_connect', 'command', 'batch', 'logclient_kill', 'logclient_drain')
+
+def phase_summary() -> Dict[str, Dict[str, float]]:
+    """Per-phase totals from the spans recorded since the last METRICS.reset()."""
+    totals = METRICS.span_totals()
+    return {
+        phase: {
+            'total_s': round(totals[phase][1], 4),
+            'mean_ms': round(1000 * totals[phase][1] / totals[phase][0], 3),
+            'calls': totals[phase][0],
+        }
+        for phase in PHASES if phase in totals
+    }
+
+def simulated_ips(count: int) -> List[str]:
+    return [f"10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}" for i in range(1, count + 1)]
+
+def run_case(simulator: SshSimulator, mode: str, size: int, commands: List[str],
+             workers: int, hop_mode: str, trace_memory: bool, runner_kind: str = 'thread') -> Dict:
+    """Benchmark one mode at one fleet size on a fresh proxy connection."""
+    ssh_client = SSHClient(simulator.host, 'bench', simulator.key_path, port=simulator.port)
+    runner = create_runner(ssh_client, hop_mode=hop_mode, kind=runner_kind)
+    if mode != 'pooled':
+        runner.session_pool = None
+    ips = simulated_ips(size)
+    failures = 0
+
+    if mode == 'pooled':
+        # Warm the pool first; the measured pass should reuse sessions
+        failures += sum(not r.ok for r in runner.run_fleet(ips, commands, max_workers=workers))
+    METRICS.reset()
+
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        if mode == 'sequential':
+            for ip in ips:
+                try:
+                    runner.run_command_sequence(ip, commands)
+                except Exception:
+                    failures += 1
+        else:
+            failures += sum(not r.ok for r in runner.run_fleet(ips, commands, max_workers=workers))
+        wall = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+        runner.close()
+        ssh_client.disconnect()
+
+    return {
+        'mode': mode,
+        'hop_mode': hop_mode,
+        'runner': runner_kind,
+        'boxes': size,
+        'workers': 1 if mode == 'sequential' else workers,
+        'wall_s': round(wall, 4),
+        'per_box_ms': round(1000 * wall / size, 3),
+        'boxes_per_s': round(size / wall, 2),
+        'failures': failures,
+        'phases': phase_summary(),
+        'counters': METRICS.counter_totals(),
+        'peak_traced_bytes': peak,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+TABLE_HEADER = f"{'mode':<11}{'boxes':>7}{'wall s':>10}{'box/s':>10}{'fail':>6}  phases (mean ms)"
+
+def format_row(result: Dict) -> str:
+    phases = " ".join(f"{name}={p['mean_ms']:.1f}" for name, p in result['phases'].items())
+    return (f"{result['mode']:<11}{result['boxes']:>7}{result['wall_s']:>10.3f}"
+            f"{result['boxes_per_s']:>10.1f}{result['failures']:>6}  {phases}")
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark CommandRunner against the SSH simulator.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 100, 1000])
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--command', default='standby', help="AVAILABLE_COMMANDS key to run")
+    parser.add_argument('--hop-mode', choices=['direct', 'shell'], default=CONFIG['CLIENT_HOP_MODE'])
+    parser.add_argument('--workers', type=int, default=CONFIG['FLEET_MAX_WORKERS'])
+    parser.add_argument('--runner', choices=['thread', 'async'], default='thread',
+                        help="CommandRunner or AsyncCommandRunner (no session pool) (default: %(default)s)")
+    parser.add_argument('--sequential-max', type=int, default=100,
+                        help="skip sequential runs above this many boxes (default: %(default)s)")
+    parser.add_argument('--latency', type=float, default=0.0, help="simulated per-command latency (s)")
+    parser.add_argument('--round-trip', type=float, default=0.0, help="simulated network round trip to an STB (s)")
+    parser.add_argument('--connect-latency', type=float, default=0.0, help="simulated STB connect latency (s)")
+    parser.add_argument('--output-lines', type=int, default=4, help="lines of output per simulated command")
+    parser.add_argument('--log-interval', type=float, default=0.05, help="seconds between logclient lines")
+    parser.add_argument('--no-batch', action='store_true', help="send multi-command entries one at a time")
+    parser.add_argument('--memory', action='store_true', help="trace Python allocations (slower)")
+    parser.add_argument('--json', metavar='FILE', help="also write the results as JSON")
+    args = parser.parse_args(argv)
+
+    # ssh_client configures INFO logging on import; keep the table readable
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+    logging.getLogger('asyncssh').setLevel(logging.CRITICAL)
+
+    config = SimulatorConfig(
+        latency=args.latency,
+        connect_latency=args.connect_latency,
+        round_trip=args.round_trip,
+        output_lines=args.output_lines,
+        log_interval=args.log_interval,
+    )
+    commands = get_command_list(args.command)
+    METRICS.enabled = True
+    CONFIG['BATCH_COMMANDS'] = not args.no_batch
+    # Keep simulated runs out of the operator's run history
+    CONFIG['HISTORY_DB'] = ''
+    results = []
+    print(TABLE_HEADER + "\n" + "-" * len(TABLE_HEADER), flush=True)
+    with SshSimulator(config) as simulator:
+        for size in args.sizes:
+            for mode in args.modes:
+                if mode == 'sequential' and size > args.sequential_max:
+                    continue
+                result = run_case(simulator, mode, size, commands, args.workers,
+                                  args.hop_mode, args.memory, args.runner)
+                results.append(result)
+                print(format_row(result), flush=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
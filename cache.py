@@ -0,0 +1,92 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class ResultCache:
+    """LRU cache of command results keyed by (client IP, command key) with per-entry TTLs.
+
+    ``invalidate_ip`` drops every entry for a box and bumps its generation.
+    A caller that reads ``generation(ip)`` before running a query and passes
+    it to ``put`` never stores a result that a concurrent mutating command
+    may already have made stale.
+
+    Generations come from one counter that only grows. A box keeps the
+    generation of its last invalidation until it is pruned, which happens
+    to boxes without entries once more than twice ``max_size`` are
+    tracked. Other boxes read ``_floor``, which is raised past every pruned
+    generation so a stale ``put`` is still refused.
+    """
+    def __init__(self, max_size: int, default_ttl: float):
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self._entries: "OrderedDict[Tuple[str, Hashable], Tuple[Any, float]]" = OrderedDict()
+        self._generations: Dict[str, int] = {}
+        self._counter = 0
+        self._floor = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, client_ip: str, key: Hashable) -> Optional[Any]:
+        """Return the cached value, or None if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get((client_ip, key))
+            if entry is not None and entry[1] <= time.monotonic():
+                del self._entries[(client_ip, key)]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((client_ip, key))
+            self.hits += 1
+            return entry[0]
+
+    def put(self, client_ip: str, key: Hashable, value: Any, ttl: Optional[float] = None,
+            generation: Optional[int] = None):
+        """Store a value, unless the IP was invalidated since ``generation`` was read."""
+        expires = time.monotonic() + (self.default_ttl if ttl is None else ttl)
+        with self._lock:
+            if generation is not None and generation != self._generations.get(client_ip, self._floor):
+                logger.debug(f"Not caching {key} for {client_ip}: invalidated while running")
+                return
+            self._entries[(client_ip, key)] = (value, expires)
+            self._entries.move_to_end((client_ip, key))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def generation(self, client_ip: str) -> int:
+        with self._lock:
+            return self._generations.get(client_ip, self._floor)
+
+    def invalidate_ip(self, client_ip: str):
+        """Drop all entries for a client, e.g. after a command changed its state."""
+        with self._lock:
+            self._counter += 1
+            self._generations[client_ip] = self._counter
+            for cache_key in [cache_key for cache_key in self._entries if cache_key[0] == client_ip]:
+                del self._entries[cache_key]
+            if len(self._generations) > 2 * self.max_size:
+                self._prune_generations()
+
+    def clear(self):
+        with self._lock:
+            self._counter += 1
+            self._floor = self._counter
+            self._generations.clear()
+            self._entries.clear()
+
+    def _prune_generations(self):
+        """Forget the generations of boxes without entries (lock held)."""
+        cached_ips = {client_ip for client_ip, _ in self._entries}
+        for client_ip in [client_ip for client_ip in self._generations if client_ip not in cached_ips]:
+            self._floor = max(self._floor, self._generations.pop(client_ip))
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""Headless command-line runner for scripted bulk runs.
+
+Reads client IPs from files or stdin, runs one AVAILABLE_COMMANDS entry on
+all of them through the proxy and writes one JSON object per box to stdout
+as soon as that box finishes. Logging goes to stderr.
+
+This path deliberately avoids tkinter, dash and python-dotenv, and only
+imports paramiko (via ssh_client) once there is work to do.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+from typing import Any, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+
+os.environ.setdefault('KAL_TOOLS_SKIP_DOTENV', '1')
+
+from config import CONFIG, get_command_list
+from parsers import get_parser, parse_outputs
+
+logger = logging.getLogger(__name__)
+
+def read_ips(sources: Iterable[TextIO]) -> Iterator[str]:
+    """Yield IPs from whitespace-separated text, skipping blank lines and # comments."""
+    for source in sources:
+        for line in source:
+            line = line.split('#', 1)[0]
+            yield from line.split()
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Run an STB command on many boxes and stream JSON lines to stdout."
+    )
+    parser.add_argument('command', nargs='?', help="AVAILABLE_COMMANDS key to run")
+    parser.add_argument('-f', '--ip-file', action='append', default=[],
+                        help="file with client IPs ('-' for stdin, default: stdin); may be repeated")
+    parser.add_argument('-j', '--concurrency', type=int,
+                        help=f"boxes to run concurrently (default: {CONFIG['FLEET_MAX_WORKERS']} per proxy, "
+                             f"{CONFIG['ASYNC_FLEET_MAX_WORKERS']} with --runner async)")
+    add_connection_arguments(parser)
+    parser.add_argument('--timeout', type=float, default=CONFIG['COMMAND_TIMEOUT'],
+                        help="per-command timeout in seconds (default: %(default)s)")
+    parser.add_argument('--no-logclient', action='store_true',
+                        help="omit logclient output from the JSON records")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="always query the boxes, even for cacheable commands")
+    parser.add_argument('--rolling', action='store_true',
+                        help="run a rebooting command in waves of -j boxes and wait for each box to come "
+                             "back (default wave size: REBOOT_WAVE_SIZE)")
+    parser.add_argument('--max-outage', type=float, default=CONFIG['REBOOT_MAX_OUTAGE'], metavar='PERCENT',
+                        help="with --rolling, most boxes offline at once (default: %(default)s%%)")
+    parser.add_argument('--summary', metavar='FILE',
+                        help="write fleet statistics (percentiles, outliers, per-/24 rollups) to FILE as JSON")
+    parser.add_argument('--metrics-jsonl', metavar='FILE',
+                        help="append timing spans and counters to FILE as JSON lines")
+    parser.add_argument('--metrics-prom', metavar='FILE',
+                        help="write timing and counter metrics to FILE in Prometheus text format")
+    parser.add_argument('--list-commands', action='store_true',
+                        help="print the available command keys and exit")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="log progress to stderr (-vv for debug)")
+    return parser
+
+def add_connection_arguments(parser: argparse.ArgumentParser, runners: bool = True):
+    """Proxy connection options shared with the monitoring scheduler and collector.
+
+    Without ``runners`` there is no --runner option and the threaded runner is used.
+    """
+    parser.add_argument('--host', default=CONFIG['DEFAULT_PROXY_HOST'], help="proxy host")
+    parser.add_argument('--proxy', action='append', default=[], metavar='HOST[=CIDR,...]',
+                        help="spread the sweep over a pool of proxies, preferring each for the given "
+                             "client subnets; may be repeated (default: PROXY_POOL, else --host only)")
+    parser.add_argument('--user', default=CONFIG['DEFAULT_PROXY_USER'], help="proxy user")
+    parser.add_argument('--key', default=CONFIG['DEFAULT_KEY_PATH'], help="private key for the proxy")
+    parser.add_argument('--passphrase-env', default='SSH_KEY_PASSPHRASE', metavar='VAR',
+                        help="environment variable holding the key passphrase (default: %(default)s)")
+    parser.add_argument('--hop-mode', choices=['direct', 'shell'], default=CONFIG['CLIENT_HOP_MODE'],
+                        help="how to reach the boxes from the proxy (default: %(default)s)")
+    parser.add_argument('--history', action='store_true',
+                        help="record every box's run in the run history (HISTORY_DB); off by default "
+                             "so sweeps do not fill it")
+    if runners:
+        parser.add_argument('--runner', choices=['thread', 'async'], default=CONFIG['RUNNER'],
+                            help="'async' multiplexes all sessions on one event loop (needs asyncssh, "
+                                 "single proxy only; default: %(default)s)")
+
+def connect_runner(args: argparse.Namespace, use_cache: bool = True) -> Tuple[Any, Optional[Any]]:
+    """Connect as the connection options say; returns (runner, SSHClient or None for a pool).
+
+    The runner is a ProxyPool when proxies are given, else a CommandRunner
+    or, with ``--runner async``, an AsyncCommandRunner. Runs are kept out of
+    the run history unless ``--history`` is given. Raises on connection
+    failure.
+    """
+    from async_runner import create_runner
+    from ssh_client import SSHClient
+
+    if not args.history:
+        CONFIG['HISTORY_DB'] = ''
+
+    passphrase = os.getenv(args.passphrase_env) or None
+    pool_spec = " ".join(args.proxy) or CONFIG['PROXY_POOL']
+    kind = getattr(args, 'runner', 'thread')
+    if pool_spec and kind == 'async':
+        raise ValueError("the async runner does not support proxy pools")
+    if pool_spec:
+        from proxy_pool import ProxyPool, parse_proxy_specs
+
+        pool = ProxyPool(parse_proxy_specs(pool_spec), args.user, args.key, passphrase,
+                         hop_mode=args.hop_mode, use_cache=use_cache)
+        pool.connect()
+        return pool, None
+
+    ssh_client = SSHClient(args.host, args.user, args.key, passphrase)
+    # The async runner keeps its own connection; ssh_client then stays unconnected
+    command_runner = create_runner(ssh_client, hop_mode=args.hop_mode, kind=kind)
+    if not use_cache:
+        command_runner.result_cache = None
+    return command_runner, ssh_client
+
+def fleet_record(result: Any, command_key: str, include_logclient: bool = True) -> Dict[str, Any]:
+    """The JSON record written for one box's FleetResult."""
+    record = {
+        'ip': result.client_ip,
+        'command': command_key,
+        'ok': result.ok,
+        'elapsed': round(result.elapsed, 3),
+        'outputs': result.outputs,
+        'error': None if result.ok else f"{type(result.error).__name__}: {result.error}"
+    }
+    if result.ok and get_parser(command_key) is not None:
+        record['parsed'] = parse_outputs(command_key, result.outputs)
+    if include_logclient:
+        record['logclient'] = result.logclient_output
+    return record
+
+def reboot_record(result: Any, command_key: str) -> Dict[str, Any]:
+    """The JSON record written for one box's RebootResult."""
+    return {
+        'ip': result.client_ip,
+        'command': command_key,
+        'ok': result.ok,
+        'status': result.status,
+        'wave': result.wave,
+        'elapsed': round(result.elapsed, 3),
+        'downtime': None if result.downtime is None else round(result.downtime, 3),
+        'error': None if result.error is None else f"{type(result.error).__name__}: {result.error}"
+    }
+
+def list_commands(out: TextIO):
+    for key, command_config in CONFIG['AVAILABLE_COMMANDS'].items():
+        out.write(json.dumps({
+            'command': key,
+            'name': command_config.get('name'),
+            'description': command_config.get('description'),
+            'commands': get_command_list(key)
+        }) + "\n")
+
+def run(args: argparse.Namespace, ips: List[str], out: TextIO) -> int:
+    """Connect to the proxy, sweep the boxes and write JSON lines; returns an exit code."""
+    # Deferred so --help and --list-commands never load paramiko
+    from metrics import METRICS
+
+    if args.metrics_jsonl or args.metrics_prom:
+        METRICS.enabled = True
+
+    commands = get_command_list(args.command)
+    try:
+        command_runner, ssh_client = connect_runner(args, use_cache=not args.no_cache)
+    except Exception as e:
+        logger.error(f"Could not connect to proxy {' '.join(args.proxy) or args.host}: {str(e)}")
+        return 2
+    failures = 0
+    results = []
+    try:
+        with METRICS.context(command_key=args.command):
+            if args.rolling:
+                for result in command_runner.rolling_reboot(ips, args.command, wave_size=args.concurrency,
+                                                            max_outage=args.max_outage):
+                    out.write(json.dumps(reboot_record(result, args.command)) + "\n")
+                    out.flush()
+                    failures += not result.ok
+            else:
+                for result in command_runner.run_fleet(ips, commands, max_workers=args.concurrency,
+                                                       timeout=args.timeout, command_key=args.command):
+                    record = fleet_record(result, args.command, include_logclient=not args.no_logclient)
+                    out.write(json.dumps(record) + "\n")
+                    out.flush()
+                    failures += not result.ok
+                    if args.summary:
+                        results.append(result._replace(logclient_output=""))
+    finally:
+        command_runner.close()
+        if ssh_client is not None:
+            ssh_client.disconnect()
+        try:
+            METRICS.write_files(args.metrics_jsonl, args.metrics_prom)
+        except OSError as e:
+            logger.error(f"Could not write metrics: {str(e)}")
+
+    if args.summary:
+        write_summary(args.summary, args.command, results)
+
+    logger.info(f"Finished {len(ips)} boxes, {failures} failed")
+    return 1 if failures else 0
+
+def write_summary(path: str, command_key: str, results: List) -> None:
+    """Aggregate the sweep with FleetTable and write the statistics as JSON."""
+    # NumPy is only needed for summaries
+    from fleet_table import FleetTable
+
+    table = FleetTable.from_results(results, command_key)
+    columns = [name for name in table.names if name != 'elapsed']
+    summary = {
+        'command': command_key,
+        'boxes': len(table),
+        'failed': int((~table.ok).sum()),
+        'columns': table.summary(),
+        'outliers': {name: table.outliers(name) for name in ['elapsed'] + columns},
+        'subnets': table.subnet_rollup(),
+    }
+    with open(path, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=[logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbose, 2)],
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        stream=sys.stderr
+    )
+    if args.verbose < 2:
+        logging.getLogger('paramiko').setLevel(logging.WARNING)
+        logging.getLogger('asyncssh').setLevel(logging.WARNING)
+
+    if args.list_commands:
+        list_commands(sys.stdout)
+        return 0
+    if not args.command:
+        parser.error("a command is required (see --list-commands)")
+    if args.command not in CONFIG['AVAILABLE_COMMANDS']:
+        parser.error(f"unknown command '{args.command}' (see --list-commands)")
+    if args.rolling and not CONFIG['AVAILABLE_COMMANDS'][args.command].get('reboots'):
+        parser.error(f"--rolling needs a rebooting command (marked 'reboots'), not '{args.command}'")
+    if args.rolling and args.summary:
+        parser.error("--summary is not available with --rolling")
+
+    sources = [sys.stdin if name == '-' else open(name) for name in args.ip_file or ['-']]
+    try:
+        ips = list(read_ips(sources))
+    finally:
+        for source in sources:
+            if source is not sys.stdin:
+                source.close()
+    if not ips:
+        parser.error("no client IPs given")
+
+    return run(args, ips, sys.stdout)
+
+if __name__ == "__main__":
+    sys.exit(main())
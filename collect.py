@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+"""Bulk file collection from STBs through the proxy.
+
+Files and directory trees are copied into ``<output>/<client ip>/<remote
+path>``, from many boxes in parallel:
+
+    python collect.py -f segment.txt -o dumps /var/log/messages /tmp/crash
+
+In direct hop mode files come over SFTP on the box's own SSH session, with
+pipelined (prefetched) reads so a transfer is limited by bandwidth rather
+than round trips. Boxes without sftp-server, and every box in shell hop
+mode, stream a ``tar | gzip`` archive instead (base64 encoded through the
+nested shell). Either way data goes straight to disk, never whole files
+in memory. One JSON line per box is written to stdout.
+"""
+import argparse
+import base64
+import contextvars
+import io
+import json
+import logging
+import os
+import posixpath
+import re
+import shlex
+import socket
+import stat
+import sys
+import tarfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+os.environ.setdefault('KAL_TOOLS_SKIP_DOTENV', '1')
+
+from config import CONFIG
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+COLLECT_METHODS = ('auto', 'sftp', 'tar')
+
+class CollectResult(NamedTuple):
+    """Files copied from one box; ``missing`` lists requested paths it does not have."""
+    client_ip: str
+    method: Optional[str]
+    files: int
+    bytes: int
+    missing: List[str]
+    error: Optional[Exception]
+    elapsed: float
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and not self.missing
+
+class _NoSftp(Exception):
+    """The box has no sftp-server."""
+
+def _remote_relpath(path: str) -> str:
+    """Normalized remote path relative to /, refusing paths that climb out of it."""
+    relative = posixpath.normpath("/" + path).lstrip("/")
+    if not relative or relative == "." or ".." in relative.split("/"):
+        raise ValueError(f"Cannot collect '{path}'")
+    return relative
+
+def _is_under(name: str, relative: str) -> bool:
+    return name == relative or name.startswith(relative + "/")
+
+class _ShellArchiveStream(io.RawIOBase):
+    """Base64 text printed by the nested shell between two markers, decoded as a byte stream.
+
+    Only undecoded text of the current read is buffered. ``status`` is the
+    exit status in the END marker once the stream is exhausted.
+    """
+    def __init__(self, channel, begin: bytes, end_pattern: "re.Pattern", idle_timeout: float):
+        self.channel = channel
+        self.begin = begin
+        self.end_pattern = end_pattern
+        self.idle_timeout = idle_timeout
+        self.status: Optional[int] = None
+        self.bytes_received = 0
+        self._raw = b""
+        self._carry = b""
+        self._decoded = bytearray()
+        self._started = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._decoded and self.status is None:
+            self._fill()
+        size = min(len(buffer), len(self._decoded))
+        buffer[:size] = self._decoded[:size]
+        del self._decoded[:size]
+        return size
+
+    def drain(self):
+        """Read and discard the rest of the stream, up to the END marker."""
+        while self.status is None:
+            self._fill()
+            self._decoded.clear()
+
+    def _fill(self):
+        self.channel.settimeout(self.idle_timeout)
+        try:
+            chunk = self.channel.recv(CONFIG['COLLECT_CHUNK_SIZE'])
+        except socket.timeout:
+            METRICS.incr('timeouts')
+            raise TimeoutError(f"No archive data for {self.idle_timeout}s")
+        if not chunk:
+            raise ConnectionError("Shell closed before the archive ended")
+        self.bytes_received += len(chunk)
+        self._raw += chunk
+
+        if not self._started:
+            begin = self._raw.find(self.begin)
+            line_end = self._raw.find(b"\n", begin) if begin >= 0 else -1
+            if line_end < 0:
+                return
+            self._raw = self._raw[line_end + 1:]
+            self._started = True
+
+        end = self.end_pattern.search(self._raw)
+        if end is not None:
+            text, self._raw = self._raw[:end.start()], b""
+            self.status = int(end.group("status"))
+        else:
+            # Keep a possibly incomplete last line (it may be the END marker)
+            cut = self._raw.rfind(b"\n") + 1
+            text, self._raw = self._raw[:cut], self._raw[cut:]
+        data = self._carry + b"".join(text.split())
+        usable = len(data) // 4 * 4
+        self._decoded += base64.b64decode(data[:usable])
+        self._carry = data[usable:]
+
+class FileCollector:
+    """Copies files and directory trees from many boxes into a local directory.
+
+    ``runner`` is a CommandRunner or ProxyPool (anything with
+    ``client_session``). ``method`` is 'sftp', 'tar' or 'auto' (SFTP where
+    possible, tar otherwise).
+    """
+    def __init__(self, runner: Any, output_dir: str, max_workers: Optional[int] = None,
+                 method: str = 'auto'):
+        if method not in COLLECT_METHODS:
+            raise ValueError(f"Unknown collect method: {method}")
+        self.runner = runner
+        self.output_dir = output_dir
+        self.max_workers = max_workers or CONFIG['COLLECT_MAX_WORKERS']
+        self.method = method
+
+    def collect(self, client_ips: Iterable[str], paths: List[str]) -> Iterator[CollectResult]:
+        """Collect ``paths`` from every box, yielding each box's result as soon as it is done."""
+        relpaths = [_remote_relpath(path) for path in paths]
+        ips = list(dict.fromkeys(client_ips))
+        workers = max(1, min(self.max_workers, len(ips) or 1))
+        logger.info(f"Collecting {len(relpaths)} paths from {len(ips)} clients with {workers} workers")
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="collect")
+        try:
+            futures = [executor.submit(contextvars.copy_context().run, self._collect_one, ip, relpaths)
+                       for ip in ips]
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _collect_one(self, client_ip: str, relpaths: List[str]) -> CollectResult:
+        started = time.monotonic()
+        root = os.path.join(self.output_dir, client_ip)
+        method = None
+        written = {'files': 0, 'bytes': 0}
+        try:
+            with METRICS.context(client_ip=client_ip), METRICS.span('collect'), \
+                    self.runner.client_session(client_ip) as session:
+                method = self._method_for(session)
+                if method == 'sftp':
+                    try:
+                        missing = self._collect_sftp(session, relpaths, root, written)
+                    except _NoSftp as e:
+                        if self.method == 'sftp':
+                            raise ConnectionError(f"No SFTP on {client_ip}: {str(e)}")
+                        logger.info(f"No SFTP on {client_ip}, falling back to tar")
+                        method = 'tar'
+                if method == 'tar':
+                    missing = self._collect_tar(session, relpaths, root, written)
+            METRICS.incr('collect_bytes', written['bytes'])
+            return CollectResult(client_ip, method, written['files'], written['bytes'], missing, None,
+                                 time.monotonic() - started)
+        except Exception as e:
+            logger.error(f"Collecting from {client_ip} failed: {str(e)}")
+            return CollectResult(client_ip, method, written['files'], written['bytes'], [], e,
+                                 time.monotonic() - started)
+
+    def _method_for(self, session) -> str:
+        if session.interactive:
+            # Only a terminal to the box: no SFTP, no binary data
+            if self.method == 'sftp':
+                raise ValueError("SFTP needs the direct hop mode")
+            return 'tar'
+        return 'tar' if self.method == 'tar' else 'sftp'
+
+    def _collect_sftp(self, session, relpaths: List[str], root: str, written: Dict[str, int]) -> List[str]:
+        import paramiko
+
+        channel = session.client_ssh.get_transport().open_session(window_size=CONFIG['COLLECT_WINDOW_SIZE'])
+        # Also bounds every SFTP request, so a stalled box cannot hang a worker
+        channel.settimeout(CONFIG['COLLECT_IDLE_TIMEOUT'])
+        try:
+            channel.invoke_subsystem('sftp')
+        except paramiko.SSHException as e:
+            channel.close()
+            raise _NoSftp(str(e))
+        sftp = paramiko.SFTPClient(channel)
+        missing = []
+        try:
+            for relative in relpaths:
+                try:
+                    attributes = sftp.stat("/" + relative)
+                except FileNotFoundError:
+                    missing.append("/" + relative)
+                    continue
+                self._sftp_get(sftp, relative, attributes, root, written)
+        finally:
+            sftp.close()
+        return missing
+
+    def _sftp_get(self, sftp, relative: str, attributes, root: str, written: Dict[str, int]):
+        """Copy a file, or a directory recursively, reusing the listing's attributes."""
+        remote = "/" + relative
+        if stat.S_ISDIR(attributes.st_mode or 0):
+            for entry in sftp.listdir_attr(remote):
+                self._sftp_get(sftp, posixpath.join(relative, entry.filename), entry, root, written)
+            return
+        if not stat.S_ISREG(attributes.st_mode or 0):
+            return
+        local = os.path.join(root, *relative.split("/"))
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        partial = local + ".part"
+        with open(partial, 'wb') as f:
+            # Prefetch keeps many read requests in flight instead of one per round trip
+            size = sftp.getfo(remote, f, prefetch=True,
+                              max_concurrent_prefetch_requests=CONFIG['COLLECT_PREFETCH_REQUESTS'])
+        os.replace(partial, local)
+        written['files'] += 1
+        written['bytes'] += size
+
+    def _collect_tar(self, session, relpaths: List[str], root: str, written: Dict[str, int]) -> List[str]:
+        quoted = " ".join(shlex.quote(relative) for relative in relpaths)
+        command = f"tar czf - -C / {quoted}"
+        if not session.interactive:
+            _, stdout, stderr = session.client_ssh.exec_command(command, bufsize=CONFIG['COLLECT_CHUNK_SIZE'])
+            stdout.channel.settimeout(CONFIG['COLLECT_IDLE_TIMEOUT'])
+            try:
+                names = self._extract(stdout, root, written)
+            finally:
+                # Whatever tar still writes after the archive ended
+                while stdout.read(CONFIG['COLLECT_CHUNK_SIZE']):
+                    pass
+            errors = stderr.read().decode(errors='replace').strip()
+            if errors:
+                logger.debug(f"tar on {session.client_ip}: {errors}")
+        else:
+            from runner_core import SENTINEL
+
+            token = uuid.uuid4().hex
+            session.shell.send(
+                f'echo "{SENTINEL}""BEGIN_{token}"; {command} 2>/dev/null | base64; '
+                f'echo "{SENTINEL}""END_{token}:$?"\n'
+            )
+            stream = _ShellArchiveStream(
+                session.shell, f"{SENTINEL}BEGIN_{token}".encode(),
+                re.compile(rf"{SENTINEL}END_{token}:(?P<status>\d+)".encode()),
+                CONFIG['COLLECT_IDLE_TIMEOUT']
+            )
+            try:
+                names = self._extract(io.BufferedReader(stream, CONFIG['COLLECT_CHUNK_SIZE']), root, written)
+            finally:
+                stream.drain()
+        return ["/" + relative for relative in relpaths
+                if not any(_is_under(name, relative) for name in names)]
+
+    @staticmethod
+    def _extract(fileobj, root: str, written: Dict[str, int]) -> List[str]:
+        """Unpack a streamed tar.gz member by member; returns the member names."""
+        names = []
+        os.makedirs(root, exist_ok=True)
+        try:
+            with tarfile.open(fileobj=fileobj, mode='r|gz') as archive:
+                for member in archive:
+                    name = posixpath.normpath(member.name).lstrip("/")
+                    if ".." in name.split("/") or not (member.isfile() or member.isdir()):
+                        continue
+                    member.name = name
+                    if hasattr(tarfile, 'data_filter'):
+                        archive.extract(member, root, filter='data')
+                    else:
+                        archive.extract(member, root)
+                    names.append(name)
+                    if member.isfile():
+                        written['files'] += 1
+                        written['bytes'] += member.size
+        except tarfile.ReadError:
+            if names:
+                raise
+            # tar wrote no archive at all: none of the paths exist
+        return names
+
+def collect_record(result: CollectResult) -> Dict[str, Any]:
+    """The JSON record written for one box's CollectResult."""
+    return {
+        'ip': result.client_ip,
+        'ok': result.ok,
+        'method': result.method,
+        'files': result.files,
+        'bytes': result.bytes,
+        'missing': result.missing,
+        'elapsed': round(result.elapsed, 3),
+        'error': None if result.error is None else f"{type(result.error).__name__}: {result.error}"
+    }
+
+def build_parser() -> argparse.ArgumentParser:
+    from cli import add_connection_arguments
+
+    parser = argparse.ArgumentParser(description="Copy files from many STBs into a local directory tree.")
+    parser.add_argument('paths', nargs='+', help="remote files or directories to collect")
+    parser.add_argument('-f', '--ip-file', action='append', default=[],
+                        help="file with client IPs ('-' for stdin, default: stdin); may be repeated")
+    parser.add_argument('-o', '--output', default='.', help="local directory (default: current directory)")
+    parser.add_argument('-j', '--concurrency', type=int, default=CONFIG['COLLECT_MAX_WORKERS'],
+                        help="boxes to collect from concurrently (default: %(default)s)")
+    parser.add_argument('--method', choices=COLLECT_METHODS, default='auto',
+                        help="transfer method (default: %(default)s)")
+    # Transfers need paramiko sessions (SFTP)
+    add_connection_arguments(parser, runners=False)
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="log progress to stderr (-vv for debug)")
+    return parser
+
+def main(argv: Optional[List[str]] = None) -> int:
+    from cli import connect_runner, read_ips
+
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=[logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbose, 2)],
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        stream=sys.stderr
+    )
+    if args.verbose < 2:
+        logging.getLogger('paramiko').setLevel(logging.WARNING)
+
+    try:
+        for path in args.paths:
+            _remote_relpath(path)
+    except ValueError as e:
+        parser.error(str(e))
+    sources = [sys.stdin if name == '-' else open(name) for name in args.ip_file or ['-']]
+    try:
+        ips = list(read_ips(sources))
+    finally:
+        for source in sources:
+            if source is not sys.stdin:
+                source.close()
+    if not ips:
+        parser.error("no client IPs given")
+
+    try:
+        runner, ssh_client = connect_runner(args, use_cache=False)
+    except Exception as e:
+        logger.error(f"Could not connect to proxy {' '.join(args.proxy) or args.host}: {str(e)}")
+        return 2
+    failures = 0
+    try:
+        collector = FileCollector(runner, args.output, args.concurrency, args.method)
+        for result in collector.collect(ips, args.paths):
+            sys.stdout.write(json.dumps(collect_record(result)) + "\n")
+            sys.stdout.flush()
+            failures += not result.ok
+    finally:
+        runner.close()
+        if ssh_client is not None:
+            ssh_client.disconnect()
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,39 +1,141 @@
 import os
-from dotenv import load_dotenv
+from typing import List
 
-# Load environment variables
-load_dotenv()
+# Load environment variables. The headless CLI sets KAL_TOOLS_SKIP_DOTENV to
+# keep python-dotenv off its start-up path and uses the real environment.
+if not os.getenv('KAL_TOOLS_SKIP_DOTENV'):
+    from dotenv import load_dotenv
+    load_dotenv()
 
 # Default configuration
 CONFIG = {
     'DEFAULT_PROXY_HOST': os.getenv('PROXY_HOST', 'proxy-se1.alcom.ax'),
     'DEFAULT_PROXY_USER': os.getenv('PROXY_USER', 'kalejdo'),
     'DEFAULT_KEY_PATH': os.getenv('SSH_KEY_PATH', os.path.expanduser('~/.ssh/id_rsa')),
+    'PROXY_POOL': os.getenv('PROXY_POOL', ''),  # 'host[=cidr,...] ...' for multi-proxy fleet runs, empty = DEFAULT_PROXY_HOST only
+    'PROXY_RECONNECT_INTERVAL': 30,  # seconds before a lost pool proxy is reconnected
     'COMMAND_TIMEOUT': 30,  # seconds
     'CONNECTION_TIMEOUT': 10,  # seconds
+    'LOGCLIENT_DRAIN_TIMEOUT': 5,  # seconds to wait for logclient to exit after Ctrl-C
+    'LOGCLIENT_MAX_LINES': 100000,  # ring buffer bound on captured logclient lines
+    'LOGCLIENT_MAX_BYTES': 16 * 1024 * 1024,  # ring buffer bound on captured logclient bytes
+    'LOGCLIENT_SPILL': True,  # write lines evicted from the ring buffer to a temp file instead of dropping them
+    'OUTPUT_MAX_BYTES': 8 * 1024 * 1024,  # per command output kept in memory, the rest spills to a temp file (0 = no cap)
+    'OUTPUT_PREVIEW_BYTES': 64 * 1024,  # head and tail of a spilled output shown in its place
+    'OUTPUT_SPILL_DIR': os.getenv('OUTPUT_SPILL_DIR') or None,  # directory for spill files (default: system temp)
+    'LOGCLIENT_JOURNAL': os.getenv(
+        'LOGCLIENT_JOURNAL', os.path.expanduser('~/.kal-tools/logclients.jsonl')
+    ),  # started logclient PIDs, used to reap orphans of crashed runs
+    'FLEET_MAX_WORKERS': 16,  # concurrent client sessions in fleet mode
+    'GUI_MAX_WORKERS': 8,  # concurrent jobs (tabs) the GUI runs in the background
+    'RUNNER': os.getenv('KAL_TOOLS_RUNNER', 'thread'),  # 'thread' (paramiko, a thread per box) or 'async' (asyncssh, one event loop)
+    'ASYNC_MAX_SESSIONS': 2000,  # client sessions the async runner keeps open at once
+    'ASYNC_MAX_CONNECTS': 64,  # client handshakes the async runner has in flight at once
+    'ASYNC_FLEET_MAX_WORKERS': 64,  # boxes an async fleet sweep runs at once unless -j is given; raise towards ASYNC_MAX_SESSIONS once the proxy is known to cope
+    'CLIENT_HOP_MODE': os.getenv('CLIENT_HOP_MODE', 'direct'),  # 'direct' (direct-tcpip) or 'shell' (nested ssh)
+    'CLIENT_USER': 'root',
+    'CLIENT_PASSWORD': os.getenv('CLIENT_PASSWORD', 'kreatv'),
+    'CLIENT_PORT': 22,
+    'SESSION_POOL_SIZE': 64,  # authenticated client sessions kept warm, 0 disables pooling
+    'SESSION_IDLE_TTL': 300,  # seconds an idle pooled session is kept
+    'SESSION_PROBE_TIMEOUT': 2,  # seconds for the health probe before reusing a session
+    'RESULT_CACHE_SIZE': 10000,  # cached results of read-only commands, 0 disables caching
+    'RESULT_CACHE_TTL': 30,  # default seconds a cached result stays valid ('cache_ttl' overrides)
+    'BATCH_COMMANDS': True,  # send multi-command entries to the client in one round trip
+    'PLAN_GROUP_MAX_CHANNELS': 4,  # exec channels per box for a plan group's concurrent steps
+    'REBOOT_WAVE_SIZE': 20,  # boxes rebooted together in a rolling reboot wave
+    'REBOOT_MAX_OUTAGE': 10,  # percent of the boxes allowed offline at once during a rolling reboot
+    'REBOOT_HEALTHY_FRACTION': 0.9,  # share of a wave back up before the next wave starts
+    'REBOOT_POLL_INTERVAL': 5,  # seconds between reachability probes; keep below a box's boot time
+    'REBOOT_PROBE_TIMEOUT': 5,  # seconds a reachability probe may take
+    'REBOOT_PROBE_WORKERS': 32,  # concurrent reachability probes over the proxy connection
+    'REBOOT_DOWN_TIMEOUT': 120,  # seconds for a box to go down after the reboot command
+    'REBOOT_UP_TIMEOUT': 900,  # seconds for a rebooted box to answer again
+    'COLLECT_MAX_WORKERS': 8,  # boxes collected from concurrently
+    'COLLECT_PREFETCH_REQUESTS': 64,  # SFTP read requests kept in flight per file
+    'COLLECT_WINDOW_SIZE': 8 * 1024 * 1024,  # SFTP channel window in bytes
+    'COLLECT_CHUNK_SIZE': 65536,  # read size for streamed tar archives
+    'COLLECT_IDLE_TIMEOUT': 60,  # seconds without data before a transfer is abandoned
+    'ADAPTIVE_TIMEOUT_MIN': 2,  # seconds, lower bound of latency-based timeouts
+    'ADAPTIVE_TIMEOUT_HEADROOM': 2.0,  # multiplier on the smoothed latency estimate
+    'RETRY_ATTEMPTS': 3,  # attempts for connects that fail transiently
+    'RETRY_BASE_DELAY': 0.2,  # seconds, backoff before the first retry (jittered, doubles)
+    'RETRY_MAX_DELAY': 2,  # seconds, cap on the backoff between retries
+    'CLIENT_BREAKER_THRESHOLD': 3,  # consecutive failures before a box is skipped
+    'PROXY_BREAKER_THRESHOLD': 5,  # consecutive logclient start failures before the proxy is skipped
+    'BREAKER_COOLDOWN': 30,  # seconds a tripped box/proxy is skipped before a trial run
+    'BREAKER_MAX_COOLDOWN': 600,  # seconds, cap on the cooldown after repeated failed trials
+    'HISTORY_DB': os.getenv(
+        'HISTORY_DB', os.path.expanduser('~/.kal-tools/history.sqlite3')
+    ),  # SQLite run history, empty disables recording
+    'HISTORY_BATCH_SIZE': 200,  # runs written per transaction
+    'HISTORY_FLUSH_INTERVAL': 1.0,  # seconds a recorded run may wait before it is written
+    'HISTORY_QUEUE_SIZE': 10000,  # runs waiting to be written before new ones are dropped
+    'HISTORY_PAGE_SIZE': 50,  # runs per page in the history views
+    'HISTORY_RETENTION_DAYS': 90,  # runs older than this are purged on start-up, 0 keeps everything
+    'HISTORY_COMPRESS_LEVEL': 6,  # zlib level for stored outputs and logclient text
+    'SCHEDULER_SESSION_RATE': 10,  # box sessions per second the monitoring scheduler starts, across all sweeps
+    'SCHEDULER_SESSION_BURST': 0,  # sessions that may start at once after an idle period (0 = one second's worth)
+    'SCHEDULER_JITTER': 0.1,  # sweep start is delayed by up to this fraction of its interval
+    'DASH_MAX_WORKERS': 8,  # commands the Dash app runs at once, across all browser sessions
+    'DASH_PROGRESS_INTERVAL': 0.5,  # seconds between polls for a running command's output
+    'DASH_JOB_RETENTION': 300,  # seconds a finished command's result waits for its page to collect it
+    'DASH_LOCK_FILE': os.getenv(
+        'DASH_LOCK_FILE', os.path.expanduser('~/.kal-tools/dash.lock')
+    ),  # held by the one process serving the Dash app; use one file per dashboard on a host
+    'METRICS_ENABLED': os.getenv('KAL_TOOLS_METRICS', '') == '1',  # record timing spans and counters
+    'METRICS_MAX_SPANS': 100000,  # individual spans kept for JSON-lines export
     'AVAILABLE_COMMANDS': {
         'ping': {
             'name': 'Ping Test',
             'description': 'Test connectivity to STB',
-            'command': 'ping -c 4 {ip}'
+            'command': 'ping -c 4 {ip}',
+            'parser': 'ping'  # key in parsers.PARSERS
         },
         'multicast': {
             'name': 'Multicast Test',
             'description': 'Test multicast streaming',
-            'command': 'toish ms playuri udp://224.0.225.154:1234'
+            'command': 'toish ms playuri udp://224.0.225.154:1234',
+            'parser': 'multicast'
         },
         'reboot': {
             'name': 'Reboot STB',
             'description': 'Restart the STB',
-            'command': 'reboot'
+            'command': 'reboot',
+            'mutating': True,  # invalidates cached results for the box
+            'reboots': True  # takes the box offline; allowed with cli.py --rolling
         },
         'standby': {
             'name': 'Standby Control',
             'description': 'Check and control standby mode',
-            'commands': [
-                'toish is getobject var.standby.mode',
-                'toish ps setstandby false'
-            ]
+            # Only wake the box if the mode read back does not already say it is awake
+            'steps': [
+                {'id': 'mode', 'command': 'toish is getobject var.standby.mode'},
+                {'command': 'toish ps setstandby false',
+                 'unless': {'step': 'mode', 'match': r'(?i)\b(false|0|off)\s*$'}}
+            ],
+            'mutating': True
+        },
+        'standby_status': {
+            'name': 'Standby Status',
+            'description': 'Read the current standby mode',
+            'command': 'toish is getobject var.standby.mode',
+            'cacheable': True,  # read-only, served from the result cache
+            'cache_ttl': 30  # seconds
         }
     }
 }
+
+
+def get_command_list(command_key: str) -> List[str]:
+    """Return the shell commands configured for an AVAILABLE_COMMANDS entry."""
+    command_config = CONFIG['AVAILABLE_COMMANDS'].get(command_key)
+    if not command_config:
+        raise ValueError(f"Unknown command: {command_key}")
+
+    if isinstance(command_config.get('command'), str):
+        return [command_config['command']]
+    if 'steps' in command_config:
+        # Plan entries (see plans.Plan): every step, groups flattened in order
+        return [step['command'] for entry in command_config['steps'] for step in entry.get('group', [entry])]
+    return list(command_config.get('commands', []))
@@ -0,0 +1,107 @@
+import logging
+import os
+import threading
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from async_runner import create_runner
+from ssh_client import CommandRunner, SSHClient
+
+logger = logging.getLogger(__name__)
+
+ConnectionKey = Tuple[str, str, str]
+
+class _Connection(NamedTuple):
+    ssh_client: SSHClient
+    runner: CommandRunner
+
+class ConnectionRegistry:
+    """Process-wide proxy connections keyed by (host, user, key path).
+
+    Callbacks serving different operators share one authenticated proxy
+    connection, and its runner (session pool and result cache), per key;
+    CONFIG['RUNNER'] picks CommandRunner or AsyncCommandRunner. Connecting
+    is serialized per key so concurrent callers never handshake twice.
+    Connections inherited through fork() belong to the parent's transport
+    threads; a child process drops them without closing and opens its own.
+    """
+    def __init__(self):
+        self._connections: Dict[ConnectionKey, _Connection] = {}
+        self._key_locks: Dict[ConnectionKey, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def connect(self, host: str, username: str, key_path: str,
+                passphrase: Optional[str] = None) -> CommandRunner:
+        """Return the runner for a live connection, connecting if needed."""
+        key = (host, username, key_path)
+        with self._key_lock(key):
+            connection = self._live(key)
+            if connection is None:
+                ssh_client = SSHClient(host, username, key_path, passphrase)
+                # Opens only the connection the runner uses
+                connection = _Connection(ssh_client, create_runner(ssh_client))
+                with self._lock:
+                    self._connections[key] = connection
+            return connection.runner
+
+    def get(self, host: str, username: str, key_path: str) -> Optional[CommandRunner]:
+        """Return the runner for a live connection, or None."""
+        connection = self._live((host, username, key_path))
+        return connection.runner if connection else None
+
+    def disconnect(self, host: str, username: str, key_path: str) -> bool:
+        """Close and forget a connection; returns False if there was none."""
+        self._check_fork()
+        with self._lock:
+            connection = self._connections.pop((host, username, key_path), None)
+        if connection is None:
+            return False
+        self._close(connection)
+        return True
+
+    def close_all(self):
+        self._check_fork()
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for connection in connections:
+            self._close(connection)
+
+    def _live(self, key: ConnectionKey) -> Optional[_Connection]:
+        self._check_fork()
+        with self._lock:
+            connection = self._connections.get(key)
+        if connection is None:
+            return None
+        if connection.runner.connected:
+            return connection
+
+        logger.info(f"Connection to {key[0]} as {key[1]} was lost")
+        with self._lock:
+            if self._connections.get(key) is connection:
+                del self._connections[key]
+        self._close(connection)
+        return None
+
+    def _key_lock(self, key: ConnectionKey) -> threading.Lock:
+        self._check_fork()
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _check_fork(self):
+        if os.getpid() != self._pid:
+            # Never close inherited connections: the socket is shared with the parent
+            self._connections = {}
+            self._key_locks = {}
+            self._lock = threading.Lock()
+            self._pid = os.getpid()
+
+    @staticmethod
+    def _close(connection: _Connection):
+        try:
+            connection.runner.close()
+            connection.ssh_client.disconnect()
+        except Exception as e:
+            logger.error(f"Error closing connection: {str(e)}")
+
+REGISTRY = ConnectionRegistry()
@@ -0,0 +1,125 @@
+import itertools
+import logging
+import queue
+import threading
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+class JobEvent(NamedTuple):
+    """Progress notification from a job, consumed on the UI thread."""
+    job_id: int
+    kind: str  # 'started', 'output', 'log', 'done', 'error' or 'cancelled'
+    payload: Any
+
+class Job:
+    """Handle for a unit of work submitted to the ExecutionEngine."""
+    def __init__(self, job_id: int, label: str):
+        self.job_id = job_id
+        self.label = label
+        self.cancel_event = threading.Event()
+        self.future: Optional[Future] = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    @property
+    def running(self) -> bool:
+        return self.future is not None and not self.future.done()
+
+    def cancel(self):
+        """Ask the job to stop; queued jobs never start, running ones stop at the next check."""
+        self.cancel_event.set()
+        if self.future is not None:
+            self.future.cancel()
+
+class ExecutionEngine:
+    """Runs blocking jobs on a worker pool and reports progress through a queue.
+
+    Workers never touch the UI. A job function is called as
+    ``fn(job, emit, *args)`` and reports progress with ``emit(kind, payload)``;
+    the UI thread collects events with ``drain()``, for example from a Tk
+    ``after()`` loop.
+    """
+    def __init__(self, max_workers: int):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="engine")
+        self._events: "queue.Queue[JobEvent]" = queue.Queue()
+        self._jobs: Dict[int, Job] = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def submit(self, label: str, fn: Callable[..., Any], *args) -> Job:
+        """Queue fn to run on a worker and return its Job handle."""
+        job = Job(next(self._ids), label)
+        with self._lock:
+            self._jobs[job.job_id] = job
+        job.future = self._executor.submit(self._run, job, fn, args)
+        job.future.add_done_callback(lambda _: self._forget(job))
+        return job
+
+    def cancel(self, job_id: int):
+        """Cancel a job by id, if it is still known."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job:
+            job.cancel()
+            if job.future is not None and job.future.cancelled():
+                self._events.put(JobEvent(job.job_id, 'cancelled', None))
+
+    def cancel_all(self):
+        """Cancel every queued and running job."""
+        with self._lock:
+            job_ids = list(self._jobs)
+        for job_id in job_ids:
+            self.cancel(job_id)
+
+    def active_jobs(self) -> List[Job]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def wait(self, jobs: List[Job], timeout: Optional[float] = None) -> bool:
+        """Wait for the given jobs to finish; returns False if any still runs after timeout."""
+        futures = [job.future for job in jobs if job.future is not None]
+        return not wait(futures, timeout=timeout).not_done
+
+    def drain(self, max_events: int = 500) -> List[JobEvent]:
+        """Return up to max_events pending events without blocking."""
+        events = []
+        try:
+            while len(events) < max_events:
+                events.append(self._events.get_nowait())
+        except queue.Empty:
+            pass
+        return events
+
+    def shutdown(self):
+        """Cancel outstanding work and stop the worker pool without waiting."""
+        self.cancel_all()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, job: Job, fn: Callable[..., Any], args: tuple):
+        def emit(kind: str, payload: Any = None):
+            self._events.put(JobEvent(job.job_id, kind, payload))
+
+        if job.cancelled:
+            emit('cancelled')
+            return None
+
+        emit('started')
+        try:
+            result = fn(job, emit, *args)
+        except CancelledError:
+            emit('cancelled')
+            return None
+        except Exception as e:
+            logger.error(f"Job '{job.label}' failed: {str(e)}")
+            emit('cancelled' if job.cancelled else 'error', e)
+            return None
+        emit('done', result)
+        return result
+
+    def _forget(self, job: Job):
+        with self._lock:
+            self._jobs.pop(job.job_id, None)
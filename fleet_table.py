@@ -0,0 +1,142 @@
+import socket
+import warnings
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+from parsers import parse_outputs
+
+# Standard constants of the modified z-score (Iglewicz and Hoaglin)
+MAD_SCALE = 0.6745
+MEAN_AD_SCALE = 0.7979
+
+def ip_to_int(ip: str) -> int:
+    try:
+        return int.from_bytes(socket.inet_aton(ip), 'big')
+    except OSError:
+        return 0
+
+def int_to_ip(value: int) -> str:
+    return socket.inet_ntoa(int(value).to_bytes(4, 'big'))
+
+class FleetTable:
+    """Columnar, NumPy-backed view of a fleet sweep.
+
+    Every numeric field produced by the command's parser becomes a float64
+    column (NaN where a box did not report it; booleans become 0/1), stored
+    together with ``elapsed`` in one ``len(table) x len(names)`` matrix so
+    statistics over all columns are computed in a single vectorized call.
+    """
+    def __init__(self, ips: Sequence[str], ok: Sequence[bool], names: List[str], values: np.ndarray):
+        self.ips = np.asarray(ips, dtype=object)
+        self.ip_ints = np.fromiter((ip_to_int(ip) for ip in ips), dtype=np.uint32, count=len(ips))
+        self.ok = np.asarray(ok, dtype=bool)
+        self.names = names
+        self.values = values
+
+    @classmethod
+    def from_results(cls, results: Iterable[Any], command_key: Optional[str] = None) -> "FleetTable":
+        """Build a table from FleetResults, parsing outputs with the command's parser."""
+        ips: List[str] = []
+        ok: List[bool] = []
+        rows: List[Dict[str, float]] = []
+        names: Dict[str, None] = {'elapsed': None}
+        for result in results:
+            row = {'elapsed': float(result.elapsed)}
+            parsed = parse_outputs(command_key, result.outputs) if command_key and result.ok else None
+            for key, value in (parsed or {}).items():
+                if isinstance(value, (bool, int, float)):
+                    row[key] = float(value)
+                    names.setdefault(key, None)
+            ips.append(result.client_ip)
+            ok.append(result.ok)
+            rows.append(row)
+
+        columns = list(names)
+        values = np.full((len(rows), len(columns)), np.nan)
+        for row_index, row in enumerate(rows):
+            for column_index, name in enumerate(columns):
+                if name in row:
+                    values[row_index, column_index] = row[name]
+        return cls(ips, ok, columns, values)
+
+    def __len__(self) -> int:
+        return len(self.ips)
+
+    def column(self, name: str) -> np.ndarray:
+        return self.values[:, self.names.index(name)]
+
+    def summary(self, percentiles: Sequence[float] = (50, 90, 99)) -> Dict[str, Dict[str, float]]:
+        """Count, mean, min, max and percentiles of every numeric column."""
+        if not len(self):
+            return {}
+        counts = np.count_nonzero(~np.isnan(self.values), axis=0)
+        with warnings.catch_warnings():
+            # Columns nobody reported are all-NaN; they show up as count 0
+            warnings.simplefilter('ignore', RuntimeWarning)
+            means = np.nanmean(self.values, axis=0)
+            minimums = np.nanmin(self.values, axis=0)
+            maximums = np.nanmax(self.values, axis=0)
+            quantiles = np.nanpercentile(self.values, percentiles, axis=0)
+
+        summary = {}
+        for index, name in enumerate(self.names):
+            stats = {'count': int(counts[index])}
+            if counts[index]:
+                stats.update(mean=float(means[index]), min=float(minimums[index]), max=float(maximums[index]))
+                stats.update((f'p{q:g}', float(quantiles[q_index, index])) for q_index, q in enumerate(percentiles))
+            summary[name] = stats
+        return summary
+
+    def outliers(self, name: str, threshold: float = 3.5) -> List[str]:
+        """IPs whose value has a modified z-score above threshold (median/MAD based)."""
+        values = self.column(name)
+        present = ~np.isnan(values)
+        if np.count_nonzero(present) < 3:
+            return []
+        median = np.median(values[present])
+        deviation = np.abs(values - median)
+        mad = np.median(deviation[present])
+        if mad:
+            scores = MAD_SCALE * deviation / mad
+        else:
+            # More than half the boxes agree exactly; fall back to the mean deviation
+            mean_ad = np.mean(deviation[present])
+            if not mean_ad:
+                return []
+            scores = MEAN_AD_SCALE * deviation / mean_ad
+        return self.ips[present & (scores > threshold)].tolist()
+
+    def subnet_rollup(self, names: Optional[Sequence[str]] = None, prefix: int = 24) -> List[Dict[str, Any]]:
+        """Per-subnet box and failure counts, plus mean and max of each column in ``names``.
+
+        ``names`` defaults to every column.
+        """
+        if not len(self):
+            return []
+        names = self.names if names is None else list(names)
+        mask = np.uint32((0xFFFFFFFF << (32 - prefix)) & 0xFFFFFFFF)
+        subnets, inverse = np.unique(self.ip_ints & mask, return_inverse=True)
+        boxes = np.bincount(inverse, minlength=len(subnets))
+        failed = np.bincount(inverse, weights=~self.ok, minlength=len(subnets))
+
+        values = self.values[:, [self.names.index(name) for name in names]]
+        present = ~np.isnan(values)
+        # Sums per (subnet, column) for all columns at once
+        reported = np.zeros((len(subnets), len(names)))
+        totals = np.zeros((len(subnets), len(names)))
+        maximums = np.full((len(subnets), len(names)), -np.inf)
+        np.add.at(reported, inverse, present)
+        np.add.at(totals, inverse, np.where(present, values, 0.0))
+        np.fmax.at(maximums, inverse, values)
+
+        rollup = []
+        for index, subnet in enumerate(subnets):
+            entry = {'subnet': f"{int_to_ip(subnet)}/{prefix}", 'boxes': int(boxes[index]),
+                     'failed': int(failed[index])}
+            for column, name in enumerate(names):
+                count = reported[index, column]
+                entry[f'{name}_mean'] = float(totals[index, column] / count) if count else None
+                entry[f'{name}_max'] = float(maximums[index, column]) if count else None
+            rollup.append(entry)
+        return rollup
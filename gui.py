@@ -1,13 +1,28 @@
 import tkinter as tk
-from tkinter import ttk, scrolledtext, messagebox
+from tkinter import ttk, messagebox
+from tkinter import font as tkfont
 import logging
-from typing import Optional
+import re
+import threading
+import time
+from concurrent.futures import CancelledError
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from ssh_client import SSHClient, CommandRunner
-from config import CONFIG
+from async_runner import create_runner
+from engine import ExecutionEngine, Job
+from config import CONFIG, get_command_list
+from history import Cursor, get_history
+from linestore import LEVELS, LineFilter, LineStore
+from parsers import format_parsed, parse_outputs
+from recvbuf import SpilledOutput
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+POLL_INTERVAL_MS = 50  # how often the Tk loop collects engine events
+APPEND_BATCH_MS = 100  # output appends are coalesced over this window
+CLOSE_WAIT_S = 10  # seconds cancelled jobs get to stop before their runner is closed
+
 class SSHApp(tk.Tk):
     def __init__(self):
         super().__init__()
@@ -16,6 +31,12 @@ class SSHApp(tk.Tk):
         self.ssh_client: Optional[SSHClient] = None
         self.command_runner: Optional[CommandRunner] = None
         
+        # Blocking SSH work runs on the engine's workers; results come back
+        # through its event queue, polled from the Tk loop
+        self.engine = ExecutionEngine(CONFIG['GUI_MAX_WORKERS'])
+        self._job_handlers: Dict[int, Dict[str, Callable[[Any], None]]] = {}
+        self._connect_job: Optional[Job] = None
+        
         # Configure window
         self.geometry("800x600")
         self.minsize(600, 400)
@@ -27,6 +48,9 @@ class SSHApp(tk.Tk):
         # Configure grid weights
         self.grid_rowconfigure(1, weight=1)
         self.grid_columnconfigure(0, weight=1)
+        
+        self.protocol("WM_DELETE_WINDOW", self._on_close)
+        self.after(POLL_INTERVAL_MS, self._poll_engine)
 
     def _setup_frames(self):
         """Initialize and configure all frames."""
@@ -35,7 +59,7 @@ class SSHApp(tk.Tk):
         self.connection_frame.grid(row=0, column=0, padx=10, pady=10, sticky="ew")
 
         # Control Frame
-        self.control_frame = ControlFrame(self, self._on_command)
+        self.control_frame = ControlFrame(self, self._on_command, self._on_cancel)
         self.control_frame.grid(row=1, column=0, padx=10, pady=10, sticky="nsew")
         self.control_frame.grid_remove()  # Hidden until connected
 
@@ -50,51 +74,122 @@ class SSHApp(tk.Tk):
         file_menu.add_command(label="Connect", command=self._on_connect)
         file_menu.add_command(label="Disconnect", command=self._on_disconnect)
         file_menu.add_separator()
-        file_menu.add_command(label="Exit", command=self.quit)
+        file_menu.add_command(label="Exit", command=self._on_close)
+        
+        # View menu
+        view_menu = tk.Menu(menubar, tearoff=0)
+        menubar.add_cascade(label="View", menu=view_menu)
+        view_menu.add_command(label="History", command=self._show_history)
         
         # Help menu
         help_menu = tk.Menu(menubar, tearoff=0)
         menubar.add_cascade(label="Help", menu=help_menu)
         help_menu.add_command(label="About", command=self._show_about)
 
+    def _submit(self, label: str, fn: Callable[..., Any], *args,
+                **handlers: Callable[[Any], None]) -> Job:
+        """Run fn on the engine and route its events to the given handlers."""
+        job = self.engine.submit(label, fn, *args)
+        self._job_handlers[job.job_id] = handlers
+        return job
+
+    def _poll_engine(self):
+        """Dispatch pending engine events on the Tk thread."""
+        for event in self.engine.drain():
+            handlers = self._job_handlers.get(event.job_id, {})
+            handler = handlers.get(event.kind)
+            if handler:
+                try:
+                    handler(event.payload)
+                except Exception as e:
+                    logger.error(f"Error handling {event.kind} event: {str(e)}")
+            if event.kind in ('done', 'error', 'cancelled'):
+                self._job_handlers.pop(event.job_id, None)
+        self.after(POLL_INTERVAL_MS, self._poll_engine)
+
     def _on_connect(self):
         """Handle connection to proxy server."""
-        try:
-            host = self.connection_frame.host_entry.get().strip()
-            username = self.connection_frame.username_entry.get().strip()
-            key_path = self.connection_frame.key_path_entry.get().strip()
-            passphrase = self.connection_frame.passphrase_entry.get().strip() or None
+        if self._connect_job and self._connect_job.running:
+            return
+        
+        host = self.connection_frame.host_entry.get().strip()
+        username = self.connection_frame.username_entry.get().strip()
+        key_path = self.connection_frame.key_path_entry.get().strip()
+        passphrase = self.connection_frame.passphrase_entry.get().strip() or None
 
-            self.ssh_client = SSHClient(host, username, key_path, passphrase)
-            self.ssh_client.connect()
-            
-            self.command_runner = CommandRunner(self.ssh_client)
-            
-            # Update UI
-            self.connection_frame.grid_remove()
-            self.control_frame.grid()
-            
-            messagebox.showinfo("Success", f"Connected to proxy server: {host}")
-        except Exception as e:
-            messagebox.showerror("Connection Error", str(e))
-            logger.error(f"Connection error: {str(e)}")
+        self.connection_frame.set_busy(True)
+        self._connect_job = self._submit(
+            f"connect {host}",
+            self._connect_worker,
+            host, username, key_path, passphrase,
+            done=self._on_connected,
+            error=self._on_connect_failed,
+            cancelled=lambda _: self.connection_frame.set_busy(False)
+        )
+
+    @staticmethod
+    def _connect_worker(job: Job, emit: Callable, host: str, username: str,
+                        key_path: str, passphrase: Optional[str]) -> Tuple[SSHClient, CommandRunner]:
+        ssh_client = SSHClient(host, username, key_path, passphrase)
+        # CONFIG['RUNNER'] picks the threaded or the asyncio runner; only
+        # the connection that runner uses is opened
+        return ssh_client, create_runner(ssh_client)
+
+    def _on_connected(self, connection: Tuple[SSHClient, CommandRunner]):
+        self.connection_frame.set_busy(False)
+        ssh_client, self.command_runner = connection
+        self.ssh_client = ssh_client
+        
+        # Update UI
+        self.connection_frame.grid_remove()
+        self.control_frame.grid()
+        
+        messagebox.showinfo("Success", f"Connected to proxy server: {ssh_client.host}")
+
+    def _on_connect_failed(self, error: Exception):
+        self.connection_frame.set_busy(False)
+        messagebox.showerror("Connection Error", str(error))
+        logger.error(f"Connection error: {str(error)}")
 
     def _on_disconnect(self):
         """Handle disconnection from proxy server."""
         if self.ssh_client:
-            try:
-                self.ssh_client.disconnect()
-                self.ssh_client = None
-                self.command_runner = None
-                
-                # Update UI
-                self.control_frame.grid_remove()
-                self.connection_frame.grid()
-                
-                messagebox.showinfo("Disconnected", "Successfully disconnected from proxy server")
-            except Exception as e:
-                messagebox.showerror("Disconnection Error", str(e))
-                logger.error(f"Disconnection error: {str(e)}")
+            # Running jobs may still hold the runner: cancel them and close
+            # it on a worker once they have stopped
+            jobs = self.engine.active_jobs()
+            self.engine.cancel_all()
+            self._submit(
+                "Disconnect",
+                self._disconnect_worker,
+                jobs, self.command_runner, self.ssh_client,
+                error=self._on_disconnect_failed
+            )
+            self.ssh_client = None
+            self.command_runner = None
+            
+            # Update UI
+            self.control_frame.grid_remove()
+            self.connection_frame.grid()
+            
+            messagebox.showinfo("Disconnected", "Disconnected from proxy server")
+
+    def _on_disconnect_failed(self, error: Exception):
+        messagebox.showerror("Disconnection Error", str(error))
+        logger.error(f"Disconnection error: {str(error)}")
+
+    def _disconnect_worker(self, job: Job, emit: Callable, jobs: List[Job],
+                           command_runner: Optional[CommandRunner], ssh_client: SSHClient):
+        self._close_connection(jobs, command_runner, ssh_client)
+
+    def _close_connection(self, jobs: List[Job], command_runner: Optional[CommandRunner],
+                          ssh_client: Optional[SSHClient]):
+        """Close a runner and its client once the given (cancelled) jobs have stopped."""
+        if not self.engine.wait(jobs, CLOSE_WAIT_S):
+            logger.warning(f"Jobs still running after {CLOSE_WAIT_S}s, closing the connection anyway")
+        if command_runner:
+            command_runner.close()
+        if ssh_client:
+            ssh_client.disconnect()
 
     def _on_command(self, client_ip: str, command: str):
         """Handle command execution."""
@@ -103,22 +198,80 @@ class SSHApp(tk.Tk):
             return
             
         try:
-            command_config = CONFIG['AVAILABLE_COMMANDS'].get(command)
-            if not command_config:
-                raise ValueError(f"Unknown command: {command}")
-                
-            if isinstance(command_config.get('command'), str):
-                commands = [command_config['command']]
-            else:
-                commands = command_config.get('commands', [])
-                
-            outputs, logclient_output = self.command_runner.run_command_sequence(client_ip, commands)
-            
-            # Update output display
-            self.control_frame.display_output(outputs, logclient_output)
+            commands = get_command_list(command)
+            if not self.ssh_client.validate_ip(client_ip):
+                raise ValueError(f"Invalid IP address: {client_ip}")
         except Exception as e:
             messagebox.showerror("Command Error", str(e))
             logger.error(f"Command execution error: {str(e)}")
+            return
+        
+        tab = self.control_frame.open_tab(client_ip, command)
+        tab.job = self._submit(
+            f"{command} on {client_ip}",
+            self._command_worker,
+            self.command_runner, client_ip, command, commands,
+            started=lambda _: tab.set_status("Running"),
+            output=tab.append_command_output,
+            log=tab.append_log_line,
+            done=lambda result: tab.set_status(self._done_status(command, result)),
+            error=lambda e: self._on_command_failed(tab, e),
+            cancelled=lambda _: tab.set_status("Cancelled")
+        )
+
+    @staticmethod
+    def _command_worker(job: Job, emit: Callable, command_runner: CommandRunner,
+                        client_ip: str, command_key: str, commands: List[str]):
+        return command_runner.run_command_sequence(
+            client_ip,
+            commands,
+            on_log_line=lambda line: emit('log', line),
+            on_output=lambda index, output: emit('output', (index, output)),
+            cancel_event=job.cancel_event,
+            command_key=command_key
+        )
+
+    @staticmethod
+    def _done_status(command_key: str, result: Tuple[List[str], str]) -> str:
+        parsed = parse_outputs(command_key, result[0]) if result else None
+        return f"Done: {format_parsed(parsed)}" if parsed else "Done"
+
+    def _on_command_failed(self, tab: "OutputTab", error: Exception):
+        tab.set_status(f"Failed: {error}")
+        messagebox.showerror("Command Error", str(error))
+        logger.error(f"Command execution error: {str(error)}")
+
+    def _on_cancel(self):
+        """Cancel the job shown in the selected output tab."""
+        tab = self.control_frame.current_tab()
+        if tab and tab.job and tab.job.running:
+            tab.set_status("Cancelling")
+            self.engine.cancel(tab.job.job_id)
+
+    def _on_close(self):
+        """Stop background work and close the window once the runner is closed."""
+        # Hide at once; cancelled jobs may take a while to let go of the runner
+        self.withdraw()
+        jobs = self.engine.active_jobs()
+        self.engine.shutdown()
+        closer = threading.Thread(target=self._close_connection, name="gui-close", daemon=True,
+                                  args=(jobs, self.command_runner, self.ssh_client))
+        closer.start()
+        self._destroy_when_closed(closer)
+
+    def _destroy_when_closed(self, closer: threading.Thread):
+        if closer.is_alive():
+            self.after(POLL_INTERVAL_MS, self._destroy_when_closed, closer)
+        else:
+            self.destroy()
+
+    def _show_history(self):
+        """Open the run history browser."""
+        history = get_history()
+        if history is None:
+            messagebox.showinfo("History", "Run history is disabled (HISTORY_DB is not set)")
+            return
+        HistoryWindow(self, history, self._submit)
 
     def _show_about(self):
         """Show about dialog."""
@@ -166,12 +319,20 @@ class ConnectionFrame(ttk.LabelFrame):
         self.connect_button = ttk.Button(self, text="Connect", command=self.connect_callback)
         self.connect_button.grid(row=4, column=0, columnspan=2, pady=10)
 
+    def set_busy(self, busy: bool):
+        """Disable the connect button while a connection attempt runs."""
+        self.connect_button.configure(
+            state="disabled" if busy else "normal",
+            text="Connecting..." if busy else "Connect"
+        )
+
 
 class ControlFrame(ttk.LabelFrame):
     """Frame for controlling STB operations."""
-    def __init__(self, parent, command_callback):
+    def __init__(self, parent, command_callback, cancel_callback):
         super().__init__(parent, text="STB Control")
         self.command_callback = command_callback
+        self.cancel_callback = cancel_callback
         self._setup_ui()
 
     def _setup_ui(self):
@@ -179,7 +340,7 @@ class ControlFrame(ttk.LabelFrame):
         # Client IP
         ttk.Label(self, text="Client IP:").grid(row=0, column=0, padx=5, pady=5, sticky="e")
         self.client_ip_entry = ttk.Entry(self, width=30)
-        self.client_ip_entry.grid(row=0, column=1, padx=5, pady=5)
+        self.client_ip_entry.grid(row=0, column=1, padx=5, pady=5, sticky="w")
 
         # Command Selection
         ttk.Label(self, text="Command:").grid(row=1, column=0, padx=5, pady=5, sticky="e")
@@ -190,44 +351,422 @@ class ControlFrame(ttk.LabelFrame):
             values=list(CONFIG['AVAILABLE_COMMANDS'].keys()),
             state="readonly"
         )
-        self.command_dropdown.grid(row=1, column=1, padx=5, pady=5)
+        self.command_dropdown.grid(row=1, column=1, padx=5, pady=5, sticky="w")
         self.command_dropdown.current(0)
 
-        # Execute Button
+        # Buttons
+        button_frame = ttk.Frame(self)
+        button_frame.grid(row=2, column=0, columnspan=2, pady=10)
         self.execute_button = ttk.Button(
-            self,
+            button_frame,
             text="Execute",
             command=lambda: self.command_callback(
                 self.client_ip_entry.get().strip(),
                 self.command_var.get()
             )
         )
-        self.execute_button.grid(row=2, column=0, columnspan=2, pady=10)
+        self.execute_button.pack(side="left", padx=5)
+        self.cancel_button = ttk.Button(button_frame, text="Cancel", command=self.cancel_callback)
+        self.cancel_button.pack(side="left", padx=5)
+        self.close_tab_button = ttk.Button(button_frame, text="Close Tab", command=self.close_current_tab)
+        self.close_tab_button.pack(side="left", padx=5)
 
-        # Output Display
-        self.output_text = scrolledtext.ScrolledText(self, width=70, height=20)
-        self.output_text.grid(row=3, column=0, columnspan=2, padx=5, pady=5, sticky="nsew")
+        # One output tab per run, so several boxes can run side by side
+        self.notebook = ttk.Notebook(self)
+        self.notebook.grid(row=3, column=0, columnspan=2, padx=5, pady=5, sticky="nsew")
 
         # Configure grid weights
         self.grid_rowconfigure(3, weight=1)
         self.grid_columnconfigure(1, weight=1)
 
+    def open_tab(self, client_ip: str, command: str) -> "OutputTab":
+        """Add and select a new output tab for a run."""
+        tab = OutputTab(self.notebook)
+        self.notebook.add(tab, text=f"{client_ip} - {command}")
+        self.notebook.select(tab)
+        return tab
+
+    def current_tab(self) -> Optional["OutputTab"]:
+        """Return the selected output tab, if any."""
+        selected = self.notebook.select()
+        return self.nametowidget(selected) if selected else None
+
+    def close_current_tab(self):
+        """Close the selected tab, cancelling its job if still running."""
+        tab = self.current_tab()
+        if tab:
+            if tab.job and tab.job.running:
+                self.cancel_callback()
+            tab.destroy()
+
     def display_output(self, command_outputs, logclient_output):
-        """Display command outputs in the text widget."""
-        self.output_text.delete(1.0, tk.END)
-        
-        # Display command outputs
-        self.output_text.insert(tk.END, "=== Command Outputs ===\n\n")
-        for i, output in enumerate(command_outputs, 1):
-            self.output_text.insert(tk.END, f"Command {i} Output:\n{output}\n\n")
-        
-        # Display logclient output
-        self.output_text.insert(tk.END, "=== Logclient Output ===\n\n")
-        self.output_text.insert(tk.END, logclient_output)
-        
-        # Scroll to top
-        self.output_text.see("1.0")
+        """Display command outputs in the selected tab."""
+        tab = self.current_tab() or self.open_tab("-", "output")
+        tab.display_output(command_outputs, logclient_output)
+
+
+class LineView(ttk.Frame):
+    """Read-only text view over a LineStore that only ever holds the visible lines.
+
+    The text lives in the store's temp file; the Tk widget is refilled with
+    the rows in view on every scroll, resize or batch of appends, so its
+    cost does not grow with the output. The toolbar filters rows by regex
+    and, with ``levels``, by log level.
+    """
+    LEVEL_COLORS = {'ERROR': "red", 'WARNING': "darkorange"}
+
+    def __init__(self, parent, levels: bool = False, width: int = 70, height: int = 10):
+        super().__init__(parent)
+        self.store = LineStore(CONFIG['OUTPUT_SPILL_DIR'])
+        self._filter: Optional[LineFilter] = None
+        self._highlight: Optional[re.Pattern] = None
+        self._top = 0
+        self._follow = True
+        self._render_scheduled = False
+        self._setup_ui(levels, width, height)
+
+    def _setup_ui(self, levels: bool, width: int, height: int):
+        toolbar = ttk.Frame(self)
+        toolbar.pack(fill="x")
+        ttk.Label(toolbar, text="Filter:").pack(side="left")
+        self.pattern_var = tk.StringVar()
+        pattern_entry = ttk.Entry(toolbar, textvariable=self.pattern_var, width=24)
+        pattern_entry.pack(side="left", padx=5)
+        pattern_entry.bind("<Return>", lambda _: self._apply_filter())
+        self.level_var = tk.StringVar(value="All")
+        if levels:
+            level_box = ttk.Combobox(toolbar, textvariable=self.level_var, state="readonly", width=9,
+                                     values=["All"] + list(reversed(LEVELS)))
+            level_box.pack(side="left")
+            level_box.bind("<<ComboboxSelected>>", lambda _: self._apply_filter())
+        ttk.Button(toolbar, text="Find", command=self._apply_filter).pack(side="left", padx=5)
+        ttk.Button(toolbar, text="Clear", command=self._clear_filter).pack(side="left")
+        self.count_var = tk.StringVar()
+        ttk.Label(toolbar, textvariable=self.count_var).pack(side="right")
+
+        body = ttk.Frame(self)
+        body.pack(fill="both", expand=True)
+        self.text = tk.Text(body, width=width, height=height, wrap="none", state="disabled")
+        self.yscroll = ttk.Scrollbar(body, orient=tk.VERTICAL, command=self._on_scrollbar)
+        xscroll = ttk.Scrollbar(body, orient=tk.HORIZONTAL, command=self.text.xview)
+        self.text.configure(xscrollcommand=xscroll.set)
+        self.text.grid(row=0, column=0, sticky="nsew")
+        self.yscroll.grid(row=0, column=1, sticky="ns")
+        xscroll.grid(row=1, column=0, sticky="ew")
+        body.grid_rowconfigure(0, weight=1)
+        body.grid_columnconfigure(0, weight=1)
+
+        self.text.tag_configure("match", background="yellow")
+        for level, color in self.LEVEL_COLORS.items():
+            self.text.tag_configure(level, foreground=color)
+        self.text.bind("<Configure>", lambda _: self._render())
+        self.text.bind("<MouseWheel>", lambda e: self._scroll_by(-3 if e.delta > 0 else 3))
+        self.text.bind("<Button-4>", lambda _: self._scroll_by(-3))
+        self.text.bind("<Button-5>", lambda _: self._scroll_by(3))
+        self.text.bind("<Prior>", lambda _: self._scroll_by(-self._visible_rows()))
+        self.text.bind("<Next>", lambda _: self._scroll_by(self._visible_rows()))
+        self.text.bind("<Control-Home>", lambda _: self._scroll_to(0))
+        self.text.bind("<Control-End>", lambda _: self._scroll_to(self._row_count()))
+
+    def append(self, text: str):
+        """Add text; the view catches up on the next render."""
+        self.store.append(text)
+        self._schedule_render()
+
+    def append_output(self, output: str):
+        """Add a command output, streaming a spilled one from its file rather than its preview."""
+        if isinstance(output, SpilledOutput):
+            self.store.append_bytes(output.iter_chunks())
+        else:
+            self.store.append(output)
+        self._schedule_render()
+
+    def clear(self):
+        """Drop all text, keeping the current filter."""
+        self.show(LineStore(CONFIG['OUTPUT_SPILL_DIR']))
+
+    def show(self, store: LineStore):
+        """Replace the text with a store filled elsewhere, e.g. on a worker."""
+        self.store = store
+        if self._filter is not None:
+            self._filter = LineFilter(self.store, self.pattern_var.get() or None, self._filter.level)
+        self._top = 0
+        self._follow = True
+        self._schedule_render()
+
+    def _apply_filter(self):
+        pattern = self.pattern_var.get()
+        level = self.level_var.get()
+        level = None if level == "All" else level
+        if not pattern and level is None:
+            self._clear_filter()
+            return
+        try:
+            self._filter = LineFilter(self.store, pattern or None, level)
+            self._highlight = re.compile(pattern, re.IGNORECASE) if pattern else None
+        except re.error as e:
+            self.count_var.set(f"Bad regex: {str(e)}")
+            return
+        self._filter.refresh()
+        self._top = 0
+        self._follow = False
+        self._render()
+
+    def _clear_filter(self):
+        self.pattern_var.set("")
+        self.level_var.set("All")
+        self._filter = None
+        self._highlight = None
+        self._follow = True
+        self._render()
+
+    def _row_count(self) -> int:
+        return len(self._filter) if self._filter is not None else len(self.store)
+
+    def _visible_rows(self) -> int:
+        linespace = tkfont.Font(font=self.text.cget("font")).metrics("linespace")
+        return max(1, self.text.winfo_height() // max(1, linespace))
+
+    def _scroll_to(self, top: int):
+        visible = self._visible_rows()
+        last_top = max(0, self._row_count() - visible)
+        self._top = max(0, min(top, last_top))
+        # Scrolling back to the bottom resumes following the tail
+        self._follow = self._top >= last_top
+        self._render()
+        return "break"
+
+    def _scroll_by(self, rows: int):
+        return self._scroll_to(self._top + rows)
+
+    def _on_scrollbar(self, action: str, amount: str, unit: Optional[str] = None):
+        if action == "moveto":
+            self._scroll_to(int(float(amount) * self._row_count()))
+        elif action == "scroll":
+            step = self._visible_rows() if unit == "pages" else 1
+            self._scroll_by(int(amount) * step)
+
+    def _schedule_render(self):
+        # Coalesce appends so a burst of log lines costs one render
+        if not self._render_scheduled:
+            self._render_scheduled = True
+            self.after(APPEND_BATCH_MS, self._render)
+
+    def _render(self):
+        self._render_scheduled = False
+        if not self.winfo_exists():
+            return
+        if self._filter is not None:
+            self._filter.refresh()
+        rows = self._row_count()
+        visible = self._visible_rows()
+        if self._follow:
+            self._top = max(0, rows - visible)
+        self._top = min(self._top, max(0, rows - 1))
+        end = min(rows, self._top + visible)
+        if self._filter is None:
+            numbers = range(self._top, end)
+            lines = self.store.lines(self._top, end)
+        else:
+            numbers = self._filter.lines[self._top:end]
+            lines = [self.store.line(number) for number in numbers]
+
+        self.text.configure(state="normal")
+        self.text.delete(1.0, tk.END)
+        self.text.insert(tk.END, "\n".join(lines))
+        for row, (number, line) in enumerate(zip(numbers, lines), start=1):
+            level = self.store.level(number)
+            if level in self.LEVEL_COLORS:
+                self.text.tag_add(level, f"{row}.0", f"{row}.end")
+            if self._highlight is not None:
+                for match in self._highlight.finditer(line):
+                    self.text.tag_add("match", f"{row}.{match.start()}", f"{row}.{match.end()}")
+        self.text.configure(state="disabled")
+
+        if rows:
+            self.yscroll.set(self._top / rows, end / rows)
+        else:
+            self.yscroll.set(0.0, 1.0)
+        if self._filter is not None:
+            self.count_var.set(f"{rows} of {self.store.complete_lines} lines")
+        else:
+            self.count_var.set(f"{rows} lines")
+
+
+class OutputTab(ttk.Frame):
+    """Output of one run: command results and the live logclient stream."""
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.job: Optional[Job] = None
+        self._setup_ui()
+
+    def _setup_ui(self):
+        self.status_var = tk.StringVar(value="Queued")
+        ttk.Label(self, textvariable=self.status_var).pack(anchor="w", padx=5, pady=(5, 0))
+
+        panes = ttk.PanedWindow(self, orient=tk.VERTICAL)
+        panes.pack(fill="both", expand=True, padx=5, pady=5)
+
+        output_frame = ttk.LabelFrame(panes, text="Command Outputs")
+        self.output_view = LineView(output_frame)
+        self.output_view.pack(fill="both", expand=True)
+        panes.add(output_frame, weight=1)
+
+        log_frame = ttk.LabelFrame(panes, text="Logclient Output")
+        self.log_view = LineView(log_frame, levels=True)
+        self.log_view.pack(fill="both", expand=True)
+        panes.add(log_frame, weight=1)
+
+    def set_status(self, status: str):
+        self.status_var.set(status)
+
+    def append_command_output(self, index_output: Tuple[int, str]):
+        index, output = index_output
+        self.output_view.append(f"Command {index + 1} Output:\n")
+        self.output_view.append_output(output)
+        self.output_view.append("\n\n")
+
+    def append_log_line(self, line: str):
+        self.log_view.append(line + "\n")
+
+    def display_output(self, command_outputs, logclient_output):
+        """Replace the tab contents with a finished run's outputs."""
+        self.output_view.clear()
+        self.log_view.clear()
+        for index, output in enumerate(command_outputs):
+            self.append_command_output((index, output))
+        self.log_view.append_output(logclient_output)
+
+
+class HistoryWindow(tk.Toplevel):
+    """Browse recorded runs one page at a time, newest first."""
+    COLUMNS = (("time", "Time", 140), ("client_ip", "Client IP", 110), ("command", "Command", 120),
+               ("status", "Status", 160), ("elapsed", "Elapsed s", 70))
+
+    def __init__(self, parent, history, submit: Callable[..., Job]):
+        super().__init__(parent)
+        self.title("Run History")
+        self.geometry("800x600")
+        self.history = history
+        # Runs are decompressed on the engine, never on the Tk thread
+        self._submit = submit
+        self._detail_job: Optional[Job] = None
+        # Cursors of the pages visited so far; the last one is the page shown
+        self._cursors: List[Optional[Cursor]] = [None]
+        self._next_cursor: Optional[Cursor] = None
+        self._setup_ui()
+        self._load_page()
+
+    def _setup_ui(self):
+        filters = ttk.Frame(self)
+        filters.pack(fill="x", padx=5, pady=5)
+        ttk.Label(filters, text="Client IP:").pack(side="left")
+        self.ip_var = tk.StringVar()
+        ip_entry = ttk.Entry(filters, textvariable=self.ip_var, width=16)
+        ip_entry.pack(side="left", padx=5)
+        ip_entry.bind("<Return>", lambda _: self._search())
+        ttk.Label(filters, text="Command:").pack(side="left")
+        self.command_var = tk.StringVar(value="")
+        ttk.Combobox(filters, textvariable=self.command_var, state="readonly", width=18,
+                     values=[""] + list(CONFIG['AVAILABLE_COMMANDS'])).pack(side="left", padx=5)
+        ttk.Button(filters, text="Search", command=self._search).pack(side="left", padx=5)
+        self.older_button = ttk.Button(filters, text="Older", command=self._older)
+        self.older_button.pack(side="right")
+        self.newer_button = ttk.Button(filters, text="Newer", command=self._newer)
+        self.newer_button.pack(side="right", padx=5)
+
+        panes = ttk.PanedWindow(self, orient=tk.VERTICAL)
+        panes.pack(fill="both", expand=True, padx=5, pady=5)
+
+        self.tree = ttk.Treeview(panes, columns=[key for key, _, _ in self.COLUMNS], show="headings", height=12)
+        for key, heading, width in self.COLUMNS:
+            self.tree.heading(key, text=heading)
+            self.tree.column(key, width=width, anchor="w")
+        self.tree.bind("<<TreeviewSelect>>", self._on_select)
+        panes.add(self.tree, weight=1)
+
+        self.detail_view = LineView(panes, levels=True, height=12)
+        panes.add(self.detail_view, weight=1)
+
+    def _search(self):
+        self._cursors = [None]
+        self._load_page()
+
+    def _older(self):
+        if self._next_cursor is not None:
+            self._cursors.append(self._next_cursor)
+            self._load_page()
+
+    def _newer(self):
+        if len(self._cursors) > 1:
+            self._cursors.pop()
+            self._load_page()
+
+    def _load_page(self):
+        try:
+            page = self.history.page(client_ip=self.ip_var.get().strip() or None,
+                                     command_key=self.command_var.get() or None,
+                                     cursor=self._cursors[-1])
+        except Exception as e:
+            logger.error(f"History query failed: {str(e)}")
+            messagebox.showerror("History", f"Query failed: {str(e)}", parent=self)
+            return
+        self._next_cursor = page.next_cursor
+        self.tree.delete(*self.tree.get_children())
+        for run in page.rows:
+            self.tree.insert("", tk.END, iid=str(run['id']), values=(
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run['ts'])),
+                run['client_ip'],
+                run['command_key'] or "",
+                "OK" if run['ok'] else run['error'],
+                run['elapsed'],
+            ))
+        self.older_button.state(["!disabled"] if page.next_cursor else ["disabled"])
+        self.newer_button.state(["!disabled"] if len(self._cursors) > 1 else ["disabled"])
+
+    def _on_select(self, _event):
+        selection = self.tree.selection()
+        if not selection:
+            return
+        if self._detail_job is not None:
+            self._detail_job.cancel()
+        self.detail_view.clear()
+        self.detail_view.append("Loading...")
+        job = self._submit(
+            "History run",
+            self._load_run,
+            self.history, int(selection[0]),
+            done=lambda store: self._show_run(job, store),
+            error=lambda e: self._show_run(job, None, f"Could not load run: {str(e)}")
+        )
+        self._detail_job = job
+
+    def _show_run(self, job: Job, store: Optional[LineStore], message: Optional[str] = None):
+        # A later selection or a closed window makes this result stale
+        if job is not self._detail_job or not self.winfo_exists():
+            return
+        self._detail_job = None
+        if store is None:
+            self.detail_view.clear()
+            self.detail_view.append(message or "Run no longer in history")
+        else:
+            self.detail_view.show(store)
 
+    @staticmethod
+    def _load_run(job: Job, emit: Callable, history, run_id: int) -> Optional[LineStore]:
+        """Read one run and lay its text out in a LineStore, off the Tk thread."""
+        run = history.get(run_id)
+        if run is None:
+            return None
+        store = LineStore(CONFIG['OUTPUT_SPILL_DIR'])
+        if run['parsed']:
+            store.append(f"Result: {format_parsed(run['parsed'])}\n\n")
+        for index, output in enumerate(run.get('outputs') or []):
+            if job.cancelled:
+                raise CancelledError()
+            store.append(f"Command {index + 1} Output:\n{output}\n\n")
+        store.append(f"--- logclient ---\n{run.get('logclient') or ''}")
+        return store
 
 if __name__ == "__main__":
     app = SSHApp()
@@ -0,0 +1,292 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from config import CONFIG
+from metrics import METRICS
+from parsers import parse_outputs
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    client_ip TEXT NOT NULL,
+    command_key TEXT,
+    proxy TEXT,
+    ok INTEGER NOT NULL,
+    elapsed REAL,
+    error TEXT,
+    parsed TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_runs_ip_ts ON runs (client_ip, ts);
+CREATE INDEX IF NOT EXISTS idx_runs_command_ts ON runs (command_key, ts);
+CREATE INDEX IF NOT EXISTS idx_runs_ts ON runs (ts);
+CREATE TABLE IF NOT EXISTS run_output (
+    run_id INTEGER PRIMARY KEY REFERENCES runs (id) ON DELETE CASCADE,
+    commands TEXT,
+    outputs BLOB,
+    logclient BLOB,
+    logclient_size INTEGER
+);
+"""
+
+METADATA_COLUMNS = ('id', 'ts', 'client_ip', 'command_key', 'proxy', 'ok', 'elapsed', 'error', 'parsed')
+
+# Cursor of a history page: (ts, id) of its last row
+Cursor = Tuple[float, int]
+
+class HistoryPage(NamedTuple):
+    """One page of run metadata, newest first; ``next_cursor`` is None on the last page."""
+    rows: List[Dict[str, Any]]
+    next_cursor: Optional[Cursor]
+
+class _Run(NamedTuple):
+    ts: float
+    client_ip: str
+    command_key: Optional[str]
+    proxy: Optional[str]
+    commands: List[str]
+    outputs: Optional[List[str]]
+    logclient_output: Optional[str]
+    error: Optional[str]
+    elapsed: float
+
+def _compress(text: Optional[str]) -> Tuple[Optional[bytes], int]:
+    """zlib-compress text; a SpilledOutput is streamed from its file."""
+    if text is None:
+        return None, 0
+    compressor = zlib.compressobj(CONFIG['HISTORY_COMPRESS_LEVEL'])
+    if hasattr(text, 'iter_chunks'):
+        parts = [compressor.compress(chunk) for chunk in text.iter_chunks()]
+        size = text.size
+    else:
+        data = text.encode('utf-8')
+        parts = [compressor.compress(data)]
+        size = len(data)
+    parts.append(compressor.flush())
+    return b"".join(parts), size
+
+def _decompress(blob: Optional[bytes]) -> Optional[str]:
+    return None if blob is None else zlib.decompress(blob).decode('utf-8', errors='replace')
+
+class RunHistory:
+    """SQLite store of command sequence runs, queryable by box, command and time.
+
+    ``record`` only enqueues; a writer thread parses, compresses and inserts
+    queued runs in batches of up to HISTORY_BATCH_SIZE per transaction, at
+    least every HISTORY_FLUSH_INTERVAL seconds. The database runs in WAL
+    mode, so readers (the GUI, the Dash app, another process) never block
+    the writer. Run metadata lives in ``runs``; outputs and the zlib
+    compressed logclient text live in ``run_output`` and are only read by
+    ``get``.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.dropped = 0
+        self._queue: "queue.Queue[Optional[_Run]]" = queue.Queue(maxsize=CONFIG['HISTORY_QUEUE_SIZE'])
+        self._local = threading.local()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        db = self._connect()
+        try:
+            db.executescript(SCHEMA)
+        finally:
+            db.close()
+        self._writer = threading.Thread(target=self._write_loop, name="history-writer", daemon=True)
+        self._writer.start()
+
+    def record(self, client_ip: str, command_key: Optional[str], commands: Sequence[str],
+               outputs: Optional[List[str]], logclient_output: Optional[str],
+               error: Optional[BaseException], elapsed: float, proxy: Optional[str] = None):
+        """Queue a finished (or failed) run for writing; never blocks."""
+        run = _Run(time.time(), client_ip, command_key, proxy, list(commands), outputs, logclient_output,
+                   None if error is None else f"{type(error).__name__}: {error}", elapsed)
+        try:
+            self._queue.put_nowait(run)
+        except queue.Full:
+            self.dropped += 1
+            METRICS.incr('history_dropped')
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                logger.warning(f"History queue full, dropped {self.dropped} runs")
+
+    def page(self, client_ip: Optional[str] = None, command_key: Optional[str] = None,
+             since: Optional[float] = None, until: Optional[float] = None,
+             cursor: Optional[Cursor] = None, limit: Optional[int] = None) -> HistoryPage:
+        """Run metadata matching the filters, newest first, one page at a time.
+
+        Pass the previous page's ``next_cursor`` to get the page after it;
+        keyset paging keeps every page an index range scan.
+        """
+        limit = limit or CONFIG['HISTORY_PAGE_SIZE']
+        clauses, params = [], []
+        for column, value in (('client_ip', client_ip), ('command_key', command_key)):
+            if value:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            clauses.append("ts >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("ts < ?")
+            params.append(until)
+        if cursor is not None:
+            clauses.append("(ts, id) < (?, ?)")
+            params.extend(cursor)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = self._db().execute(
+            f"SELECT {', '.join(METADATA_COLUMNS)} FROM runs {where} ORDER BY ts DESC, id DESC LIMIT ?",
+            params + [limit + 1]
+        ).fetchall()
+        more = len(rows) > limit
+        rows = [self._row(row) for row in rows[:limit]]
+        next_cursor = (rows[-1]['ts'], rows[-1]['id']) if more else None
+        return HistoryPage(rows, next_cursor)
+
+    def get(self, run_id: int) -> Optional[Dict[str, Any]]:
+        """Full record of one run, including commands, outputs and logclient text."""
+        db = self._db()
+        row = db.execute(f"SELECT {', '.join(METADATA_COLUMNS)} FROM runs WHERE id = ?", (run_id,)).fetchone()
+        if row is None:
+            return None
+        record = self._row(row)
+        detail = db.execute(
+            "SELECT commands, outputs, logclient, logclient_size FROM run_output WHERE run_id = ?", (run_id,)
+        ).fetchone()
+        if detail is not None:
+            outputs = _decompress(detail[1])
+            record.update(
+                commands=json.loads(detail[0]) if detail[0] else [],
+                outputs=json.loads(outputs) if outputs is not None else None,
+                logclient=_decompress(detail[2]),
+                logclient_size=detail[3],
+            )
+        return record
+
+    def purge(self, older_than: float) -> int:
+        """Delete runs recorded before the given timestamp; returns how many."""
+        db = self._connect()
+        try:
+            db.execute("PRAGMA foreign_keys = ON")
+            with db:
+                return db.execute("DELETE FROM runs WHERE ts < ?", (older_than,)).rowcount
+        finally:
+            db.close()
+
+    def flush(self, timeout: Optional[float] = None):
+        """Wait until everything recorded so far has been written."""
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def close(self):
+        """Write what is queued and stop the writer."""
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+
+    def _write_loop(self):
+        db = self._connect()
+        db.execute("PRAGMA foreign_keys = ON")
+        if CONFIG['HISTORY_RETENTION_DAYS']:
+            cutoff = time.time() - CONFIG['HISTORY_RETENTION_DAYS'] * 86400
+            with db:
+                db.execute("DELETE FROM runs WHERE ts < ?", (cutoff,))
+        stopping = False
+        while not stopping:
+            batch, waiters = [], []
+            item = self._queue.get()
+            deadline = time.monotonic() + CONFIG['HISTORY_FLUSH_INTERVAL']
+            while True:
+                if item is None:
+                    stopping = True
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    batch.append(item)
+                if stopping or waiters or len(batch) >= CONFIG['HISTORY_BATCH_SIZE']:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if batch:
+                try:
+                    self._insert(db, batch)
+                except Exception as e:
+                    logger.error(f"Could not write {len(batch)} runs to history: {str(e)}")
+            for waiter in waiters:
+                waiter.set()
+        db.close()
+
+    def _insert(self, db: sqlite3.Connection, batch: List[_Run]):
+        with METRICS.span('history_write', runs=len(batch)), db:
+            for run in batch:
+                parsed = parse_outputs(run.command_key, run.outputs) if run.command_key and run.outputs else None
+                cursor = db.execute(
+                    "INSERT INTO runs (ts, client_ip, command_key, proxy, ok, elapsed, error, parsed) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (run.ts, run.client_ip, run.command_key, run.proxy, run.error is None,
+                     round(run.elapsed, 3), run.error, json.dumps(parsed) if parsed else None)
+                )
+                outputs, _ = _compress(json.dumps([str(output) for output in run.outputs])
+                                       if run.outputs is not None else None)
+                logclient, logclient_size = _compress(run.logclient_output)
+                db.execute(
+                    "INSERT INTO run_output (run_id, commands, outputs, logclient, logclient_size) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (cursor.lastrowid, json.dumps(run.commands), outputs, logclient, logclient_size)
+                )
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, timeout=30)
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA synchronous = NORMAL")
+        return db
+
+    def _db(self) -> sqlite3.Connection:
+        """Per-thread read connection."""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = self._connect()
+        return db
+
+    @staticmethod
+    def _row(row: Sequence[Any]) -> Dict[str, Any]:
+        record = dict(zip(METADATA_COLUMNS, row))
+        record['ok'] = bool(record['ok'])
+        record['parsed'] = json.loads(record['parsed']) if record['parsed'] else None
+        return record
+
+_history: Optional[RunHistory] = None
+_history_pid: Optional[int] = None
+_history_lock = threading.Lock()
+
+def get_history() -> Optional[RunHistory]:
+    """The process-wide history store, or None if HISTORY_DB is unset.
+
+    A forked child (e.g. a pre-forking server worker) opens its own store, since
+    the writer thread does not survive the fork.
+    """
+    global _history, _history_pid
+    if not CONFIG['HISTORY_DB']:
+        return None
+    with _history_lock:
+        if _history_pid != os.getpid():
+            # A store that failed to open is not retried in this process
+            _history_pid = os.getpid()
+            try:
+                _history = RunHistory(CONFIG['HISTORY_DB'])
+                atexit.register(_history.close)
+            except (OSError, sqlite3.Error) as e:
+                logger.error(f"Could not open run history {CONFIG['HISTORY_DB']}: {str(e)}")
+                _history = None
+        return _history
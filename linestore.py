@@ -0,0 +1,161 @@
+import codecs
+import logging
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Dict, Iterable, List, Optional
+
+from recvbuf import SCAN_SIZE, SpillFile
+
+logger = logging.getLogger(__name__)
+
+LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+LEVEL_PATTERN = re.compile(r"\b(DEBUG|INFO|WARN(?:ING)?|ERROR|CRITICAL|FATAL)\b")
+# Level spellings folded into LEVELS
+LEVEL_ALIASES = {'WARN': 'WARNING', 'CRITICAL': 'ERROR', 'FATAL': 'ERROR'}
+
+class LineStore:
+    """Append-only text kept in a temp file, addressed by line number.
+
+    Memory per line is its start offset (8 bytes) plus its level code (1
+    byte) and, for lines carrying a log level, an entry in that level's
+    index; the text itself stays on disk and is read back one window at a
+    time. A trailing line without its newline yet is kept in memory and
+    counts as the last line.
+    """
+    def __init__(self, spill_dir: Optional[str] = None):
+        self._file = SpillFile(spill_dir)
+        # Start offset of every complete line, plus the end of the last one
+        self._offsets = array('Q', [0])
+        self._levels = bytearray()
+        self._level_lines: Dict[str, array] = {level: array('L') for level in LEVELS}
+        self._partial = ""
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    @property
+    def complete_lines(self) -> int:
+        return len(self._offsets) - 1
+
+    def __len__(self) -> int:
+        return self.complete_lines + (1 if self._partial else 0)
+
+    @property
+    def size(self) -> int:
+        return self._file.size + len(self._partial)
+
+    def append(self, text: str):
+        """Add text; lines end at "\\n" and a trailing "\\r" is dropped."""
+        parts = (self._partial + text).split("\n")
+        self._partial = parts.pop()
+        if not parts:
+            return
+        encoded = []
+        offset = self._offsets[-1]
+        for line in parts:
+            line = line.rstrip("\r")
+            data = line.encode('utf-8') + b"\n"
+            encoded.append(data)
+            offset += len(data)
+            self._offsets.append(offset)
+            level = LEVEL_PATTERN.search(line)
+            if level is None:
+                self._levels.append(0)
+            else:
+                name = LEVEL_ALIASES.get(level.group(1), level.group(1))
+                self._levels.append(LEVELS.index(name) + 1)
+                self._level_lines[name].append(len(self._offsets) - 2)
+        self._file.write(b"".join(encoded))
+
+    def append_bytes(self, chunks: Iterable[bytes]):
+        """Add UTF-8 data arriving in chunks, e.g. a SpilledOutput's ``iter_chunks``."""
+        for chunk in chunks:
+            self.append(self._decoder.decode(chunk))
+        self.append(self._decoder.decode(b"", final=True))
+
+    def line(self, number: int) -> str:
+        return self.lines(number, number + 1)[0]
+
+    def lines(self, start: int, end: int) -> List[str]:
+        """Lines ``[start, end)`` with one file read."""
+        end = min(end, len(self))
+        if start >= end:
+            return []
+        complete_end = min(end, self.complete_lines)
+        result = []
+        if start < complete_end:
+            data = self._file.read(self._offsets[start], self._offsets[complete_end])
+            result = data.decode('utf-8', errors='replace').split("\n")[:-1]
+        if end > self.complete_lines:
+            result.append(self._partial)
+        return result
+
+    def level(self, number: int) -> Optional[str]:
+        code = self._levels[number] if number < len(self._levels) else 0
+        return LEVELS[code - 1] if code else None
+
+    def level_lines(self, level: str, start: int = 0) -> array:
+        """Numbers of the complete lines at ``level`` from line ``start`` on."""
+        lines = self._level_lines[level]
+        return lines[bisect_left(lines, start):]
+
+    def search(self, pattern: "re.Pattern", start: int = 0, end: Optional[int] = None) -> array:
+        """Numbers of the complete lines in ``[start, end)`` matching a bytes pattern.
+
+        The file is scanned in windows of whole lines with a single regex
+        pass each, so this runs at regex speed rather than line by line.
+        """
+        end = self.complete_lines if end is None else min(end, self.complete_lines)
+        found = array('L')
+        line = start
+        while line < end:
+            # A window of whole lines, at least one line even if it is huge
+            window_end = max(line + 1, bisect_right(self._offsets, self._offsets[line] + SCAN_SIZE, line, end + 1) - 1)
+            base = self._offsets[line]
+            window = self._file.read(base, self._offsets[window_end])
+            position = 0
+            while True:
+                match = pattern.search(window, position)
+                if match is None:
+                    break
+                number = bisect_right(self._offsets, base + match.start(), line, window_end + 1) - 1
+                found.append(number)
+                # One hit per line is enough
+                position = self._offsets[number + 1] - base
+            line = window_end
+        return found
+
+class LineFilter:
+    """Line numbers of a LineStore matching a regex and/or a level, kept up to date incrementally.
+
+    ``refresh`` only looks at lines added since the previous call.
+    """
+    def __init__(self, store: LineStore, pattern: Optional[str] = None, level: Optional[str] = None,
+                 ignore_case: bool = True):
+        if level is not None and level not in LEVELS:
+            raise ValueError(f"Unknown level: {level}")
+        self.store = store
+        self.level = level
+        self.pattern = re.compile(pattern.encode('utf-8'), re.MULTILINE | (re.IGNORECASE if ignore_case else 0)) if pattern else None
+        self.lines = array('L')
+        self._scanned = 0
+
+    def __len__(self) -> int:
+        return len(self.lines)
+
+    def refresh(self) -> int:
+        """Index newly completed lines; returns how many matched."""
+        end = self.store.complete_lines
+        if end <= self._scanned:
+            return 0
+        if self.pattern is not None:
+            matches = self.store.search(self.pattern, self._scanned, end)
+            if self.level is not None:
+                code = LEVELS.index(self.level) + 1
+                matches = array('L', (number for number in matches if self.store._levels[number] == code))
+        elif self.level is not None:
+            matches = self.store.level_lines(self.level, self._scanned)
+        else:
+            matches = array('L', range(self._scanned, end))
+        self._scanned = end
+        self.lines.extend(matches)
+        return len(matches)
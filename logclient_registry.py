@@ -0,0 +1,130 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: journal writes are not locked across processes
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+class LogclientRegistry:
+    """PIDs of the logclient processes this process started on one proxy.
+
+    Every start and stop is appended to a JSON-lines journal shared by all
+    local kal-tools processes, so logclients left behind by a crashed run
+    can be found by the next one (``orphans``) and killed. Appends are O(1);
+    the journal is compacted when orphans are collected.
+    """
+    def __init__(self, proxy_host: str, journal_path: Optional[str] = None):
+        self.proxy_host = proxy_host
+        self.journal_path = journal_path
+        self._pids: Dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._pids)
+
+    def add(self, pid: int, client_ip: str):
+        with self._lock:
+            self._pids[pid] = client_ip
+        self._append({'op': 'add', 'host': self.proxy_host, 'pid': pid, 'ip': client_ip,
+                      'owner': os.getpid(), 'time': round(time.time(), 3)})
+
+    def remove(self, pid: int):
+        with self._lock:
+            if self._pids.pop(pid, None) is None:
+                return
+        self._append({'op': 'del', 'host': self.proxy_host, 'pid': pid})
+
+    def pids(self, client_ip: Optional[str] = None) -> List[int]:
+        """Tracked PIDs, optionally only those started for client_ip."""
+        with self._lock:
+            return [pid for pid, ip in self._pids.items() if client_ip is None or ip == client_ip]
+
+    def orphans(self) -> List[Tuple[int, str]]:
+        """(pid, client IP) of logclients on this proxy whose owning process has died.
+
+        The journal is compacted to the entries that are still live.
+        """
+        if not self.journal_path or not os.path.exists(self.journal_path):
+            return []
+        with self._journal_lock():
+            live: Dict[Tuple[str, int], dict] = {}
+            try:
+                with open(self.journal_path) as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            continue
+                        key = (entry.get('host'), entry.get('pid'))
+                        if entry.get('op') == 'add':
+                            live[key] = entry
+                        else:
+                            live.pop(key, None)
+            except OSError as e:
+                logger.error(f"Could not read logclient journal: {str(e)}")
+                return []
+
+            orphaned = [entry for (host, _), entry in live.items()
+                        if host == self.proxy_host and not _process_alive(entry.get('owner'))]
+            for entry in orphaned:
+                del live[(entry['host'], entry['pid'])]
+            self._rewrite(live.values())
+        return [(entry['pid'], entry.get('ip', '')) for entry in orphaned]
+
+    def _append(self, entry: dict):
+        if not self.journal_path:
+            return
+        try:
+            with self._journal_lock():
+                with open(self.journal_path, 'a') as f:
+                    f.write(json.dumps(entry) + "\n")
+        except OSError as e:
+            logger.error(f"Could not write logclient journal: {str(e)}")
+
+    def _rewrite(self, entries):
+        tmp_path = f"{self.journal_path}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                for entry in entries:
+                    f.write(json.dumps(entry) + "\n")
+            os.replace(tmp_path, self.journal_path)
+        except OSError as e:
+            logger.error(f"Could not compact logclient journal: {str(e)}")
+
+    @contextmanager
+    def _journal_lock(self) -> Iterator[None]:
+        os.makedirs(os.path.dirname(self.journal_path) or '.', exist_ok=True)
+        if fcntl is None:
+            yield
+            return
+        with open(f"{self.journal_path}.lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _process_alive(pid: Optional[int]) -> bool:
+    if not pid:
+        return False
+    if os.name == 'nt':
+        # os.kill(pid, 0) sends CTRL_C_EVENT on Windows; never reap there
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
@@ -0,0 +1,215 @@
+import codecs
+import contextvars
+import logging
+import threading
+from collections import deque
+from typing import Callable, Deque, List, Optional
+
+import paramiko
+
+from metrics import METRICS
+from recvbuf import CHUNK_SIZE, Output, SpillFile, SpilledOutput
+
+logger = logging.getLogger(__name__)
+
+class LogclientStream:
+    """Background reader for a running ``logclient`` channel.
+
+    Output is read continuously so the channel window never fills, decoded
+    incrementally (multibyte characters split across chunks survive), and
+    kept in a ring buffer bounded by ``max_lines`` and/or ``max_bytes``.
+    When a bound is hit the oldest lines are dropped and counted in
+    ``dropped_lines``, or with ``spill`` written to a temp file and counted
+    in ``spilled_lines``; ``text`` then returns a SpilledOutput covering the
+    whole session once the stream has stopped. Subscribers receive each
+    complete line as it arrives.
+
+    With ``on_pid`` the first line is taken to be the remote process ID
+    (printed by ``echo $$`` before ``exec logclient``); it is stored in
+    ``pid`` and passed to the callback instead of being buffered.
+    ``exited`` is set once the remote side closed the stream.
+    """
+    def __init__(self, channel: paramiko.Channel, client_ip: str,
+                 max_lines: Optional[int] = None, max_bytes: Optional[int] = None,
+                 spill: bool = False, spill_dir: Optional[str] = None,
+                 preview_bytes: int = 64 * 1024,
+                 on_pid: Optional[Callable[[int], None]] = None):
+        self.channel = channel
+        self.client_ip = client_ip
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.on_pid = on_pid
+        self.pid: Optional[int] = None
+        self.exited = False
+        self.spill = spill
+        self.spill_dir = spill_dir
+        self.preview_bytes = preview_bytes
+        self.dropped_lines = 0
+        self.spilled_lines = 0
+        self._spill_file: Optional[SpillFile] = None
+        # Size of the spill file once the buffered tail has been appended at stop
+        self._sealed_size: Optional[int] = None
+        self.bytes_received = 0
+        self._expect_pid = on_pid is not None
+        self._lines: Deque[str] = deque()
+        self._buffered_bytes = 0
+        self._partial = ""
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._subscribers: List[Callable[[str], None]] = []
+        self._lock = threading.Lock()
+        # The reader records metrics under the tags of the run that created it
+        self._thread = threading.Thread(
+            target=contextvars.copy_context().run, args=(self._read_loop,),
+            name=f"logclient-{client_ip}", daemon=True
+        )
+
+    def start(self) -> "LogclientStream":
+        """Start the background reader."""
+        self._thread.start()
+        return self
+
+    @property
+    def running(self) -> bool:
+        return self._thread.is_alive()
+
+    def subscribe(self, callback: Callable[[str], None], replay: bool = False) -> Callable[[], None]:
+        """Call ``callback`` with every new line; returns an unsubscribe function.
+
+        With ``replay`` the lines already buffered are delivered first.
+        Callbacks run on the reader thread and must not block.
+        """
+        with self._lock:
+            backlog = list(self._lines) if replay else []
+            self._subscribers.append(callback)
+        for line in backlog:
+            self._notify(callback, line)
+
+        def unsubscribe():
+            with self._lock:
+                if callback in self._subscribers:
+                    self._subscribers.remove(callback)
+        return unsubscribe
+
+    def lines(self) -> List[str]:
+        """Snapshot of the buffered lines."""
+        with self._lock:
+            return list(self._lines)
+
+    def text(self) -> Output:
+        """Buffered output as a single string.
+
+        After lines were spilled this is a SpilledOutput of the whole session
+        once the stream has stopped; before that, the buffered tail preceded
+        by a note pointing to the spill file.
+        """
+        with self._lock:
+            if self._sealed_size is not None:
+                return SpilledOutput(self._spill_file, 0, self._sealed_size, self.preview_bytes)
+            text = self._buffered_text_locked()
+            if self._spill_file is not None:
+                text = f"[{self.spilled_lines} earlier lines in {self._spill_file.path}]\n{text}"
+            return text
+
+    def stop(self, timeout: float) -> Output:
+        """Interrupt logclient, wait up to ``timeout`` for it to exit and return the output."""
+        try:
+            if not self.channel.closed:
+                self.channel.send("\x03")  # Ctrl-C
+        except Exception as e:
+            logger.debug(f"Could not interrupt logclient for {self.client_ip}: {str(e)}")
+
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning(f"Logclient for {self.client_ip} did not exit within {timeout}s")
+        self.channel.close()
+        self._thread.join(1)
+        if not self._thread.is_alive():
+            self._seal_spill()
+        return self.text()
+
+    def _seal_spill(self):
+        """Append the buffered tail to the spill file so it holds the whole session."""
+        with self._lock:
+            if self._spill_file is None or self._sealed_size is not None:
+                return
+            text = self._buffered_text_locked()
+            if text:
+                self._spill_file.write(text.encode('utf-8'))
+            self._sealed_size = self._spill_file.size
+
+    def _buffered_text_locked(self) -> str:
+        text = "\n".join(self._lines)
+        if self._partial:
+            text = f"{text}\n{self._partial}" if text else self._partial
+        return text
+
+    def _read_loop(self):
+        try:
+            while True:
+                chunk = self.channel.recv(CHUNK_SIZE)
+                if not chunk:
+                    self.exited = True
+                    break
+                self.bytes_received += len(chunk)
+                if METRICS.enabled:
+                    METRICS.incr('logclient_recv_calls')
+                    METRICS.incr('logclient_bytes_received', len(chunk))
+                self._feed(self._decoder.decode(chunk))
+        except Exception as e:
+            if not self.channel.closed:
+                logger.error(f"Error reading logclient output for {self.client_ip}: {str(e)}")
+        finally:
+            self._feed(self._decoder.decode(b"", final=True), final=True)
+
+    def _feed(self, text: str, final: bool = False):
+        with self._lock:
+            parts = (self._partial + text).split("\n")
+            self._partial = parts.pop()
+            if final and self._partial:
+                parts.append(self._partial)
+                self._partial = ""
+            lines = [part.rstrip("\r") for part in parts]
+            new_pid = None
+            if self._expect_pid and lines:
+                self._expect_pid = False
+                if lines[0].strip().isdigit():
+                    new_pid = self.pid = int(lines.pop(0).strip())
+                else:
+                    logger.warning(f"Expected a logclient PID for {self.client_ip}, got {lines[0]!r}")
+            for line in lines:
+                self._append_locked(line)
+            subscribers = list(self._subscribers)
+
+        if new_pid is not None:
+            try:
+                self.on_pid(new_pid)
+            except Exception as e:
+                logger.error(f"Logclient PID callback failed: {str(e)}")
+        for line in lines:
+            for callback in subscribers:
+                self._notify(callback, line)
+
+    def _append_locked(self, line: str):
+        self._lines.append(line)
+        self._buffered_bytes += len(line.encode('utf-8')) + 1
+        while self._lines and (
+            (self.max_lines is not None and len(self._lines) > self.max_lines)
+            or (self.max_bytes is not None and self._buffered_bytes > self.max_bytes)
+        ):
+            dropped = self._lines.popleft()
+            encoded = dropped.encode('utf-8') + b"\n"
+            self._buffered_bytes -= len(encoded)
+            if self.spill:
+                if self._spill_file is None:
+                    self._spill_file = SpillFile(self.spill_dir)
+                self._spill_file.write(encoded)
+                self.spilled_lines += 1
+            else:
+                self.dropped_lines += 1
+
+    def _notify(self, callback: Callable[[str], None], line: str):
+        try:
+            callback(line)
+        except Exception as e:
+            logger.error(f"Logclient subscriber failed: {str(e)}")
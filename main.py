@@ -1,8 +1,15 @@
 #!/usr/bin/env python3
 import logging
-from gui import SSHApp
+import sys
 
 def main():
+    # Any arguments select the headless CLI, which must not load tkinter
+    if len(sys.argv) > 1:
+        from cli import main as cli_main
+        return cli_main(sys.argv[1:])
+
+    from gui import SSHApp
+
     # Configure logging
     logging.basicConfig(
         level=logging.INFO,
@@ -18,4 +25,4 @@ def main():
     app.mainloop()
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
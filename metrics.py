@@ -0,0 +1,194 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Iterator, List, Optional, TextIO, Tuple
+
+from config import CONFIG
+
+# Tags applied to every span and counter recorded in the current context,
+# e.g. the client IP and command key of the run being executed
+_context_tags: contextvars.ContextVar = contextvars.ContextVar('metric_tags', default={})
+
+TagKey = Tuple[Tuple[str, str], ...]
+
+class _NullSpan:
+    """Span returned while metrics are disabled; does nothing."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def tag(self, **tags):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+class _Span:
+    __slots__ = ('_metrics', 'name', 'tags', '_start', '_wall_start')
+
+    def __init__(self, metrics: "Metrics", name: str, tags: Dict[str, str]):
+        self._metrics = metrics
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self._wall_start = time.time()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self._start
+        self._metrics._record_span(self, duration, exc_type.__name__ if exc_type else None)
+        return False
+
+    def tag(self, **tags):
+        """Add tags discovered while the span is open."""
+        self.tags.update((key, str(tag_value)) for key, tag_value in tags.items())
+
+class Metrics:
+    """Timing spans and counters for the SSH hot path.
+
+    Disabled by default (CONFIG['METRICS_ENABLED']); while disabled ``span``
+    returns a shared no-op object and ``incr`` returns immediately, so the
+    instrumentation costs one attribute check per call site. Recorded data
+    can be exported as JSON lines or in the Prometheus text format.
+    """
+    def __init__(self, enabled: bool = False, max_spans: int = 100000):
+        self.enabled = enabled
+        self._spans: Deque[dict] = deque(maxlen=max_spans)
+        self._durations: Dict[Tuple[str, TagKey], List[float]] = defaultdict(lambda: [0, 0.0])
+        self._counters: Dict[Tuple[str, TagKey], float] = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def span(self, name: str, **tags):
+        """Context manager timing a phase, tagged with the current context tags."""
+        if not self.enabled:
+            return _NULL_SPAN
+        merged = dict(_context_tags.get())
+        merged.update((key, str(tag_value)) for key, tag_value in tags.items())
+        return _Span(self, name, merged)
+
+    def incr(self, name: str, value: float = 1, **tags):
+        """Add value to a counter."""
+        if not self.enabled:
+            return
+        merged = dict(_context_tags.get())
+        merged.update((key, str(tag_value)) for key, tag_value in tags.items())
+        with self._lock:
+            self._counters[(name, _tag_key(merged))] += value
+
+    @contextmanager
+    def context(self, **tags) -> Iterator[None]:
+        """Tag everything recorded inside the block (and in contexts copied from it)."""
+        merged = dict(_context_tags.get())
+        merged.update((key, str(tag_value)) for key, tag_value in tags.items() if tag_value is not None)
+        token = _context_tags.set(merged)
+        try:
+            yield
+        finally:
+            _context_tags.reset(token)
+
+    def reset(self):
+        with self._lock:
+            self._spans.clear()
+            self._durations.clear()
+            self._counters.clear()
+
+    def span_totals(self, by: str = 'span') -> Dict[str, Tuple[int, float]]:
+        """Aggregate (count, total seconds) per span name, or per value of tag ``by``."""
+        totals: Dict[str, List[float]] = defaultdict(lambda: [0, 0.0])
+        with self._lock:
+            for (name, tag_key), (count, total) in self._durations.items():
+                key = name if by == 'span' else dict(tag_key).get(by, '')
+                totals[key][0] += count
+                totals[key][1] += total
+        return {key: (int(count), total) for key, (count, total) in totals.items()}
+
+    def counter_totals(self) -> Dict[str, float]:
+        """Counter values summed over all tags."""
+        totals: Dict[str, float] = defaultdict(float)
+        with self._lock:
+            for (name, _), value in self._counters.items():
+                totals[name] += value
+        return dict(totals)
+
+    def export_jsonl(self, out: TextIO):
+        """Write recorded spans, then current counter values, one JSON object per line."""
+        with self._lock:
+            spans = list(self._spans)
+            counters = list(self._counters.items())
+        for record in spans:
+            out.write(json.dumps(record) + "\n")
+        for (name, tag_key), value in counters:
+            out.write(json.dumps({'type': 'counter', 'name': name, 'tags': dict(tag_key), 'value': value}) + "\n")
+
+    def export_prometheus(self, out: TextIO, prefix: str = 'kal_tools'):
+        """Write span summaries and counters in the Prometheus text exposition format."""
+        with self._lock:
+            durations = sorted(self._durations.items())
+            counters = sorted(self._counters.items())
+
+        if durations:
+            out.write(f"# HELP {prefix}_span_seconds Time spent in each phase of a run.\n")
+            out.write(f"# TYPE {prefix}_span_seconds summary\n")
+            for (name, tag_key), (count, total) in durations:
+                labels = _labels((('span', name),) + tag_key)
+                out.write(f"{prefix}_span_seconds_count{labels} {int(count)}\n")
+                out.write(f"{prefix}_span_seconds_sum{labels} {total:.6f}\n")
+
+        written = set()
+        for (name, tag_key), value in counters:
+            metric = f"{prefix}_{name}_total"
+            if metric not in written:
+                out.write(f"# TYPE {metric} counter\n")
+                written.add(metric)
+            out.write(f"{metric}{_labels(tag_key)} {value:g}\n")
+
+    def write_files(self, jsonl_path: Optional[str] = None, prometheus_path: Optional[str] = None):
+        """Export to the given files; the Prometheus file is replaced atomically for scrapers."""
+        if jsonl_path:
+            with open(jsonl_path, 'a') as f:
+                self.export_jsonl(f)
+        if prometheus_path:
+            tmp_path = f"{prometheus_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                self.export_prometheus(f)
+            os.replace(tmp_path, prometheus_path)
+
+    def _record_span(self, span: _Span, duration: float, error: Optional[str]):
+        tag_key = _tag_key(span.tags)
+        record = {
+            'type': 'span',
+            'name': span.name,
+            'start': round(span._wall_start, 6),
+            'duration': round(duration, 6),
+            'tags': span.tags,
+            'error': error,
+        }
+        with self._lock:
+            self._spans.append(record)
+            entry = self._durations[(span.name, tag_key)]
+            entry[0] += 1
+            entry[1] += duration
+            if error:
+                self._counters[('errors', _tag_key(dict(span.tags, span=span.name, error=error)))] += 1
+
+def _tag_key(tags: Dict[str, str]) -> TagKey:
+    return tuple(sorted(tags.items()))
+
+def _labels(tag_key: TagKey) -> str:
+    if not tag_key:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in tag_key) + "}"
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+METRICS = Metrics(enabled=CONFIG['METRICS_ENABLED'], max_spans=CONFIG['METRICS_MAX_SPANS'])
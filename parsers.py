@@ -0,0 +1,87 @@
+import logging
+import re
+from typing import Any, Callable, Dict, List, Optional
+
+from config import CONFIG
+
+logger = logging.getLogger(__name__)
+
+Parser = Callable[[List[str]], Dict[str, Any]]
+
+PING_PACKETS_PATTERN = re.compile(
+    r"(?P<transmitted>\d+) packets transmitted, (?P<received>\d+) (?:packets )?received"
+    r"(?:, \+\d+ errors)?, (?P<loss>[\d.]+)% packet loss"
+)
+# iputils prints rtt min/avg/max/mdev, busybox round-trip min/avg/max (no mdev)
+PING_RTT_PATTERN = re.compile(
+    r"(?:rtt|round-trip) min/avg/max(?:/(?:mdev|stddev))? = "
+    r"(?P<min>[\d.]+)/(?P<avg>[\d.]+)/(?P<max>[\d.]+)(?:/(?P<mdev>[\d.]+))? ms"
+)
+KEY_VALUE_PATTERN = re.compile(r"(?P<key>[A-Za-z_][\w.]*)=(?P<value>\S+)")
+MILLISECONDS_PATTERN = re.compile(r"^(?P<number>-?[\d.]+)ms$")
+
+def parse_ping(outputs: List[str]) -> Dict[str, Any]:
+    """Packet counts, loss percentage and RTT statistics (ms) from ping output."""
+    text = "\n".join(outputs)
+    result: Dict[str, Any] = {}
+    packets = PING_PACKETS_PATTERN.search(text)
+    if packets:
+        result['transmitted'] = int(packets.group('transmitted'))
+        result['received'] = int(packets.group('received'))
+        result['packet_loss'] = float(packets.group('loss'))
+    rtt = PING_RTT_PATTERN.search(text)
+    if rtt:
+        for field in ('min', 'avg', 'max', 'mdev'):
+            if rtt.group(field) is not None:
+                result[f'rtt_{field}'] = float(rtt.group(field))
+    return result
+
+def parse_multicast(outputs: List[str]) -> Dict[str, Any]:
+    """Play status and timing from ``toish ms`` output.
+
+    Every ``key=value`` pair is kept; values with an ``ms`` suffix become
+    ``<key>_ms`` floats and ``playing`` is set from the ``state`` field.
+    """
+    result: Dict[str, Any] = {}
+    for match in KEY_VALUE_PATTERN.finditer("\n".join(outputs)):
+        key, value = match.group('key'), match.group('value')
+        milliseconds = MILLISECONDS_PATTERN.match(value)
+        if milliseconds:
+            result[f'{key}_ms'] = float(milliseconds.group('number'))
+        else:
+            result[key] = value
+    if 'state' in result:
+        result['playing'] = result['state'].upper() == 'PLAYING'
+    return result
+
+PARSERS: Dict[str, Parser] = {
+    'ping': parse_ping,
+    'multicast': parse_multicast,
+}
+
+def get_parser(command_key: str) -> Optional[Parser]:
+    """Return the parser declared by an AVAILABLE_COMMANDS entry ('parser' key), if any."""
+    parser_name = CONFIG['AVAILABLE_COMMANDS'].get(command_key, {}).get('parser')
+    if parser_name is None:
+        return None
+    if parser_name not in PARSERS:
+        raise ValueError(f"Unknown parser '{parser_name}' for command {command_key}")
+    return PARSERS[parser_name]
+
+def parse_outputs(command_key: str, outputs: List[str]) -> Optional[Dict[str, Any]]:
+    """Parse a run's outputs with the command's parser; None if it has none or parsing fails."""
+    parser = get_parser(command_key)
+    if parser is None:
+        return None
+    try:
+        return parser(outputs)
+    except Exception as e:
+        logger.error(f"Failed to parse {command_key} output: {str(e)}")
+        return None
+
+def format_parsed(parsed: Dict[str, Any]) -> str:
+    """One-line human readable summary of a parsed result."""
+    return ", ".join(
+        f"{key}={value:g}" if isinstance(value, float) else f"{key}={value}"
+        for key, value in parsed.items()
+    )
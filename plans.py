@@ -0,0 +1,172 @@
+import logging
+import re
+import shlex
+from typing import Any, Dict, List, NamedTuple, Optional, Pattern, Sequence, Union
+
+from config import CONFIG
+
+logger = logging.getLogger(__name__)
+
+# {name} placeholders; ${name} is shell syntax and left alone
+PLACEHOLDER_PATTERN = re.compile(r"(?<!\$)\{(\w+)\}")
+
+class Condition(NamedTuple):
+    """Run a step only if ``pattern`` matches (or with ``negate``, does not match) an earlier output."""
+    step: str
+    pattern: Pattern
+    negate: bool
+
+    def holds(self, output: str) -> bool:
+        return (self.pattern.search(output) is None) == self.negate
+
+class Step(NamedTuple):
+    """One command of a plan; ``index`` is its position in the plan's outputs."""
+    index: int
+    name: str
+    command: str
+    condition: Optional[Condition]
+
+class Stage(NamedTuple):
+    """Steps sent to the box in one round trip; ``concurrent`` steps are independent."""
+    steps: List[Step]
+    concurrent: bool
+
+def render(command: str, params: Dict[str, Any]) -> str:
+    """Substitute ``{name}`` placeholders with shell-quoted params; unknown names stay as they are."""
+    def substitute(match: "re.Match") -> str:
+        name = match.group(1)
+        return shlex.quote(str(params[name])) if name in params else match.group(0)
+    return PLACEHOLDER_PATTERN.sub(substitute, command)
+
+class Plan:
+    """Declarative command plan for one AVAILABLE_COMMANDS entry.
+
+    An entry's ``steps`` list holds steps and groups:
+
+        'steps': [
+            {'id': 'mode', 'command': 'toish is getobject var.standby.mode'},
+            {'command': 'toish ps setstandby false',
+             'unless': {'step': 'mode', 'match': r'(?i)\\bfalse\\b'}},
+            {'group': [{'command': 'uptime'}, {'command': 'df -h'}]}
+        ]
+
+    A step with ``when`` runs only if the regex matches the named earlier
+    step's output, one with ``unless`` only if it does not; a step whose
+    dependency was skipped is skipped too. The steps of a ``group`` do not
+    depend on each other and run concurrently. Commands are templates:
+    ``{ip}`` is the client IP and other ``{name}`` placeholders come from
+    the entry's ``params``. Entries with ``command``/``commands`` are plans
+    of unconditional steps.
+
+    Skipped steps have an empty output, so outputs still line up with
+    ``commands``.
+    """
+    def __init__(self, layout: Sequence[Union[Step, List[Step]]], params: Optional[Dict[str, Any]] = None):
+        self.layout = list(layout)
+        self.params = dict(params or {})
+        self.steps: List[Step] = []
+        for item in self.layout:
+            self.steps.extend(item if isinstance(item, list) else [item])
+        self._indexes = {step.name: step.index for step in self.steps}
+
+    @classmethod
+    def sequence(cls, commands: Sequence[str], params: Optional[Dict[str, Any]] = None) -> "Plan":
+        """Plan running commands one after another, unconditionally."""
+        return cls([Step(index, str(index), command, None) for index, command in enumerate(commands)], params)
+
+    @classmethod
+    def from_config(cls, command_key: str, commands: Optional[Sequence[str]] = None) -> "Plan":
+        """Plan for an AVAILABLE_COMMANDS entry.
+
+        Entries without ``steps`` run ``commands`` when given (else their own
+        command list) in sequence. Raises ValueError on a malformed plan.
+        """
+        command_config = CONFIG['AVAILABLE_COMMANDS'].get(command_key)
+        if command_config is None:
+            raise ValueError(f"Unknown command: {command_key}")
+        params = command_config.get('params')
+        if 'steps' not in command_config:
+            if commands is None:
+                commands = [command_config['command']] if 'command' in command_config \
+                    else command_config.get('commands', [])
+            return cls.sequence(commands, params)
+
+        layout: List[Union[Step, List[Step]]] = []
+        names: Dict[str, int] = {}
+        for entry in command_config['steps']:
+            if 'group' in entry:
+                # Steps of the group only see steps before the group
+                group = [cls._parse_step(command_key, step, len(names) + offset, names)
+                         for offset, step in enumerate(entry['group'])]
+                layout.append(group)
+            else:
+                group = [cls._parse_step(command_key, entry, len(names), names)]
+                layout.append(group[0])
+            for step in group:
+                if step.name in names:
+                    raise ValueError(f"Plan {command_key}: duplicate step id '{step.name}'")
+                names[step.name] = step.index
+        return cls(layout, params)
+
+    @staticmethod
+    def _parse_step(command_key: str, entry: Dict[str, Any], index: int, earlier: Dict[str, int]) -> Step:
+        if 'command' not in entry:
+            raise ValueError(f"Plan {command_key}: step {index + 1} has no command")
+        condition = None
+        for keyword, negate in (('when', False), ('unless', True)):
+            if keyword in entry:
+                spec = entry[keyword]
+                if spec['step'] not in earlier:
+                    raise ValueError(f"Plan {command_key}: step {index + 1} depends on unknown "
+                                     f"earlier step '{spec['step']}'")
+                condition = Condition(spec['step'], re.compile(spec['match']), negate)
+        return Step(index, entry.get('id', str(index)), entry['command'], condition)
+
+    @property
+    def commands(self) -> List[str]:
+        return [step.command for step in self.steps]
+
+    def render(self, client_ip: str) -> "Plan":
+        """Copy of the plan with ``{ip}`` and the params substituted into every command."""
+        params = dict(self.params, ip=client_ip)
+        layout = [
+            [step._replace(command=render(step.command, params)) for step in item] if isinstance(item, list)
+            else item._replace(command=render(item.command, params))
+            for item in self.layout
+        ]
+        return Plan(layout, self.params)
+
+    def stages(self, batch: bool) -> List[Stage]:
+        """Split the plan into round trips.
+
+        Groups are a stage of their own. With ``batch`` consecutive steps
+        share a stage until one depends on a step of that stage, since
+        conditions are evaluated before a stage is sent; without it every
+        step is its own stage.
+        """
+        stages: List[Stage] = []
+        current: List[Step] = []
+        for item in self.layout:
+            if isinstance(item, list):
+                if current:
+                    stages.append(Stage(current, False))
+                    current = []
+                stages.append(Stage(item, True))
+                continue
+            depends_on_current = item.condition is not None and any(
+                item.condition.step == step.name for step in current
+            )
+            if current and (not batch or depends_on_current):
+                stages.append(Stage(current, False))
+                current = []
+            current.append(item)
+        if current:
+            stages.append(Stage(current, False))
+        return stages
+
+    def should_run(self, step: Step, outputs: List[Optional[str]]) -> bool:
+        """Whether a step's condition holds for the outputs so far (None marks a skipped step)."""
+        if step.condition is None:
+            return True
+        output = outputs[self._indexes[step.condition.step]]
+        return output is not None and step.condition.holds(output)
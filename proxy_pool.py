@@ -0,0 +1,342 @@
+import ipaddress
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from cache import ResultCache
+from config import CONFIG
+from metrics import METRICS
+from rolling import RebootResult, RollingReboot
+from runner_core import FleetResult, run_fleet_members
+from ssh_client import ClientSession, CommandRunner, SSHClient
+
+logger = logging.getLogger(__name__)
+
+Network = ipaddress.IPv4Network
+
+class ProxySpec(NamedTuple):
+    """A proxy host and the client subnets it should preferably serve."""
+    host: str
+    subnets: Tuple[Network, ...] = ()
+    port: int = 22
+
+def parse_proxy_specs(spec: str) -> List[ProxySpec]:
+    """Parse ``host[:port][=cidr,cidr...]`` entries separated by whitespace or semicolons.
+
+    ``proxy-se1=10.10.0.0/16,10.11.0.0/16; proxy-se2=10.20.0.0/16 proxy-se3``
+    gives proxy-se3 no affinity, so it only takes clients the others cannot.
+    """
+    specs = []
+    for entry in spec.replace(';', ' ').split():
+        address, _, subnets = entry.partition('=')
+        host, _, port = address.partition(':')
+        if not host:
+            raise ValueError(f"Proxy entry without host: '{entry}'")
+        specs.append(ProxySpec(host, tuple(
+            ipaddress.IPv4Network(subnet, strict=False) for subnet in subnets.split(',') if subnet
+        ), int(port or 22)))
+    return specs
+
+class _Proxy:
+    """One pool member: its connection, runner and routing state."""
+    def __init__(self, spec: ProxySpec):
+        self.spec = spec
+        self.ssh_client: Optional[SSHClient] = None
+        self.runner: Optional[CommandRunner] = None
+        self.state = 'down'  # 'up', 'down' (reconnect later) or 'draining' (retired)
+        self.outstanding = 0
+        self.retry_at = 0.0
+        # Logclients started over a lost connection, killed after reconnecting
+        self.stale_pids: List[int] = []
+
+    @property
+    def host(self) -> str:
+        return self.spec.host if self.spec.port == 22 else f"{self.spec.host}:{self.spec.port}"
+
+    def alive(self) -> bool:
+        transport = self.ssh_client.client.get_transport() if self.ssh_client and self.ssh_client.client else None
+        return transport is not None and transport.is_active()
+
+    def affinity(self, address: ipaddress.IPv4Address) -> int:
+        """Prefix length of the most specific subnet containing address, -1 if none."""
+        return max((subnet.prefixlen for subnet in self.spec.subnets if address in subnet), default=-1)
+
+class ProxyPool:
+    """Connections to several proxies with per-client routing and failover.
+
+    Each client IP goes to the live proxies whose subnets contain it most
+    specifically (or to all live proxies if none of them do), and among
+    those to the one with the fewest outstanding sequences. A proxy whose
+    connection dies is taken out of rotation, its in-flight work is failed
+    over to another proxy (read-only commands only; a ``mutating`` entry may
+    already have run) and it is reconnected after PROXY_RECONNECT_INTERVAL.
+    ``drain`` retires a proxy once its outstanding sequences have finished.
+
+    Every proxy gets its own CommandRunner (session pool, logclients,
+    breakers); the result cache is shared, so a cached answer does not
+    depend on which proxy produced it.
+    """
+    def __init__(self, specs: Iterable[ProxySpec], username: str, key_path: str,
+                 passphrase: Optional[str] = None, hop_mode: Optional[str] = None,
+                 use_cache: bool = True):
+        self.proxies = [_Proxy(spec) for spec in specs]
+        if not self.proxies:
+            raise ValueError("Proxy pool needs at least one proxy")
+        self.username = username
+        self.key_path = key_path
+        self.passphrase = passphrase
+        self.hop_mode = hop_mode
+        self.result_cache = (
+            ResultCache(CONFIG['RESULT_CACHE_SIZE'], CONFIG['RESULT_CACHE_TTL'])
+            if use_cache and CONFIG['RESULT_CACHE_SIZE'] > 0 else None
+        )
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+
+    def connect(self) -> int:
+        """Connect to every proxy concurrently; returns how many are up.
+
+        Raises ConnectionError if none of them could be reached.
+        """
+        with ThreadPoolExecutor(max_workers=len(self.proxies), thread_name_prefix="proxy-connect") as executor:
+            list(executor.map(self._connect, self.proxies))
+        up = sum(proxy.state == 'up' for proxy in self.proxies)
+        if not up:
+            raise ConnectionError("Could not connect to any proxy")
+        logger.info(f"Connected to {up} of {len(self.proxies)} proxies")
+        return up
+
+    def close(self, timeout: float = 0.0):
+        """Stop leasing proxies and close their connections.
+
+        A proxy with sequences still in flight is closed by the last of
+        them to finish (see ``_release``), never underneath them; the call
+        first waits up to ``timeout`` seconds for them.
+        """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            for proxy in self.proxies:
+                proxy.state = 'draining'
+            while any(proxy.outstanding for proxy in self.proxies):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    busy = [proxy.host for proxy in self.proxies if proxy.outstanding]
+                    logger.warning(f"Closing proxies {', '.join(busy)} once their sequences finish")
+                    break
+                self._released.wait(remaining)
+            connections = [self._detach(proxy) for proxy in self.proxies if not proxy.outstanding]
+        for connection in connections:
+            self._close(*connection)
+
+    def live_hosts(self) -> List[str]:
+        with self._lock:
+            return [proxy.host for proxy in self.proxies if proxy.state == 'up']
+
+    def drain(self, host: str, timeout: Optional[float] = None) -> bool:
+        """Stop routing to host and close it once its outstanding sequences finish.
+
+        Returns False if they were still running after ``timeout`` seconds;
+        the proxy is then closed when the last one completes.
+        """
+        proxy = self._proxy(host)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            proxy.state = 'draining'
+            while proxy.outstanding:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    logger.warning(f"Proxy {host} still has {proxy.outstanding} sequences after drain timeout")
+                    return False
+                self._released.wait(remaining)
+            connection = self._detach(proxy)
+        self._close(*connection)
+        logger.info(f"Drained proxy {host}")
+        return True
+
+    def run_fleet(self, client_ips: Iterable[str], commands: List[str],
+                  max_workers: Optional[int] = None,
+                  timeout: Optional[float] = None,
+                  command_key: Optional[str] = None,
+                  throttle: Optional[Callable[[], None]] = None) -> Iterator[FleetResult]:
+        """Like CommandRunner.run_fleet, spread over the pool.
+
+        ``max_workers`` defaults to FLEET_MAX_WORKERS per live proxy.
+        """
+        self._reconnect_due()
+        ips = list(dict.fromkeys(client_ips))
+        default_workers = CONFIG['FLEET_MAX_WORKERS'] * max(1, len(self.live_hosts()))
+        workers = max(1, min(max_workers or default_workers, len(ips) or 1))
+        logger.info(f"Running fleet sweep on {len(ips)} clients over {len(self.live_hosts())} proxies "
+                    f"with {workers} workers")
+
+        try:
+            yield from run_fleet_members(
+                ips, lambda ip: self.run_command_sequence(ip, commands, timeout, command_key=command_key),
+                workers, throttle
+            )
+        finally:
+            for runner in self._runners():
+                runner.kill_tracked_logclients()
+
+    def rolling_reboot(self, client_ips: Iterable[str], command_key: str = 'reboot',
+                       wave_size: Optional[int] = None, max_outage: Optional[float] = None,
+                       stop_event: Optional[threading.Event] = None) -> Iterator[RebootResult]:
+        """Reboot the clients in waves across the pool (see CommandRunner.rolling_reboot)."""
+        return RollingReboot(self, command_key, wave_size=wave_size, max_outage=max_outage,
+                             stop_event=stop_event).run(client_ips)
+
+    def probe_reachable(self, client_ip: str, timeout: float) -> bool:
+        """Probe the client through the proxy routed for it; False if no proxy is left."""
+        try:
+            proxy = self._acquire(ipaddress.IPv4Address(client_ip), ())
+        except ConnectionError:
+            return False
+        try:
+            return proxy.runner.probe_reachable(client_ip, timeout)
+        except Exception as e:
+            self._mark_down(proxy, e)
+            return False
+        finally:
+            self._release(proxy)
+
+    @contextmanager
+    def client_session(self, client_ip: str) -> Iterator[ClientSession]:
+        """Lease a session to the client through the proxy routed for it (see CommandRunner)."""
+        proxy = self._acquire(ipaddress.IPv4Address(client_ip), ())
+        try:
+            with METRICS.context(proxy=proxy.host), proxy.runner.client_session(client_ip) as session:
+                yield session
+        finally:
+            self._release(proxy)
+
+    def run_command_sequence(self, client_ip: str, commands: List[str],
+                             timeout: Optional[float] = None,
+                             on_log_line: Optional[Callable[[str], None]] = None,
+                             on_output: Optional[Callable[[int, str], None]] = None,
+                             cancel_event: Optional[threading.Event] = None,
+                             batch: Optional[bool] = None,
+                             command_key: Optional[str] = None) -> Tuple[List[str], str]:
+        """Run the sequence through the proxy routed for client_ip (see CommandRunner).
+
+        If that proxy fails underneath the sequence, a read-only sequence is
+        retried on the next proxy; errors of the client itself are raised.
+        """
+        address = ipaddress.IPv4Address(client_ip)
+        mutating = bool(CONFIG['AVAILABLE_COMMANDS'].get(command_key, {}).get('mutating')) if command_key else False
+        tried = set()
+        while True:
+            proxy = self._acquire(address, tried)
+            try:
+                with METRICS.context(proxy=proxy.host):
+                    return proxy.runner.run_command_sequence(
+                        client_ip, commands, timeout, on_log_line, on_output, cancel_event, batch, command_key
+                    )
+            except (CancelledError, ValueError):
+                raise
+            except Exception as e:
+                if proxy.alive() and not proxy.runner.proxy_breaker.is_open(proxy.host):
+                    raise
+                self._mark_down(proxy, e)
+                if mutating:
+                    raise
+                tried.add(proxy.host)
+                METRICS.incr('proxy_failovers')
+                logger.warning(f"Failing {client_ip} over from proxy {proxy.host}")
+            finally:
+                self._release(proxy)
+
+    def _acquire(self, address: ipaddress.IPv4Address, exclude) -> _Proxy:
+        """Pick the least loaded live proxy with the best affinity for address and lease it."""
+        for attempt in range(2):
+            with self._lock:
+                candidates = [proxy for proxy in self.proxies
+                              if proxy.state == 'up' and proxy.host not in exclude]
+                if candidates:
+                    best = max(proxy.affinity(address) for proxy in candidates)
+                    proxy = min((proxy for proxy in candidates if proxy.affinity(address) == best),
+                                key=lambda proxy: proxy.outstanding)
+                    proxy.outstanding += 1
+                    return proxy
+            if attempt == 0:
+                self._reconnect_due()
+        raise ConnectionError(f"No live proxy left for {address}")
+
+    def _release(self, proxy: _Proxy):
+        with self._lock:
+            proxy.outstanding -= 1
+            self._released.notify_all()
+            if proxy.outstanding or proxy.state == 'up':
+                return
+            # Last sequence on a dead or draining proxy
+            connection = self._detach(proxy)
+        self._close(*connection)
+
+    @staticmethod
+    def _detach(proxy: _Proxy) -> Tuple[Optional[CommandRunner], Optional[SSHClient]]:
+        """Take the connection off a proxy for closing (pool lock held)."""
+        runner, ssh_client = proxy.runner, proxy.ssh_client
+        proxy.runner = proxy.ssh_client = None
+        if runner is not None and proxy.state == 'down':
+            proxy.stale_pids.extend(runner.logclients.pids())
+        return runner, ssh_client
+
+    def _mark_down(self, proxy: _Proxy, error: Exception):
+        with self._lock:
+            if proxy.state != 'up':
+                return
+            proxy.state = 'down'
+            proxy.retry_at = time.monotonic() + CONFIG['PROXY_RECONNECT_INTERVAL']
+        logger.error(f"Proxy {proxy.host} taken out of rotation: {str(error)}")
+        METRICS.incr('proxy_down', proxy=proxy.host)
+
+    def _reconnect_due(self):
+        now = time.monotonic()
+        with self._lock:
+            due = [proxy for proxy in self.proxies
+                   if proxy.state == 'down' and proxy.retry_at <= now and not proxy.outstanding]
+            for proxy in due:
+                proxy.retry_at = now + CONFIG['PROXY_RECONNECT_INTERVAL']
+        for proxy in due:
+            self._connect(proxy)
+
+    def _connect(self, proxy: _Proxy):
+        ssh_client = SSHClient(proxy.spec.host, self.username, self.key_path, self.passphrase, port=proxy.spec.port)
+        try:
+            ssh_client.connect()
+            runner = CommandRunner(ssh_client, hop_mode=self.hop_mode, result_cache=self.result_cache)
+        except Exception as e:
+            logger.error(f"Could not connect to proxy {proxy.host}: {str(e)}")
+            with self._lock:
+                proxy.retry_at = time.monotonic() + CONFIG['PROXY_RECONNECT_INTERVAL']
+            return
+        with self._lock:
+            previous = self._detach(proxy)
+            stale_pids, proxy.stale_pids = proxy.stale_pids, []
+            proxy.ssh_client, proxy.runner = ssh_client, runner
+            proxy.state = 'up'
+        self._close(*previous)
+        if stale_pids:
+            runner.kill_logclients(stale_pids)
+
+    def _runners(self) -> List[CommandRunner]:
+        with self._lock:
+            return [proxy.runner for proxy in self.proxies if proxy.runner is not None]
+
+    def _proxy(self, host: str) -> _Proxy:
+        for proxy in self.proxies:
+            if proxy.host == host:
+                return proxy
+        raise KeyError(f"Unknown proxy {host}")
+
+    @staticmethod
+    def _close(runner: Optional[CommandRunner], ssh_client: Optional[SSHClient]):
+        try:
+            if runner is not None:
+                runner.close()
+            if ssh_client is not None:
+                ssh_client.disconnect()
+        except Exception as e:
+            logger.error(f"Error closing proxy connection: {str(e)}")
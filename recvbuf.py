@@ -0,0 +1,222 @@
+import logging
+import os
+import re
+import tempfile
+import threading
+import weakref
+from typing import Iterator, NamedTuple, Optional, Union
+
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 32768
+
+# Bytes kept in memory after spilling, so markers can still be matched
+SEARCH_WINDOW = 4 * CHUNK_SIZE
+# Longest marker a search may have to find across two reads
+SEARCH_OVERLAP = 512
+# Window size when scanning a spill file
+SCAN_SIZE = 1024 * 1024
+
+class BufferMatch(NamedTuple):
+    """A regex match at absolute byte offsets of a ReceiveBuffer."""
+    start: int
+    end: int
+    match: "re.Match"
+
+class SpillFile:
+    """Append-only temp file, deleted once no buffer or SpilledOutput refers to it."""
+    def __init__(self, spill_dir: Optional[str]):
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(prefix='kal-output-', suffix='.log', dir=spill_dir)
+        self._file = os.fdopen(fd, 'w+b')
+        self._lock = threading.Lock()
+        self.size = 0
+        weakref.finalize(self, _remove_file, self._file, self.path)
+
+    def write(self, data) -> None:
+        with self._lock:
+            self._file.seek(0, os.SEEK_END)
+            self._file.write(data)
+            self.size += len(data)
+
+    def read(self, start: int, end: int) -> bytes:
+        with self._lock:
+            self._file.flush()
+            self._file.seek(start)
+            return self._file.read(max(0, end - start))
+
+def _remove_file(file, path: str):
+    try:
+        file.close()
+        os.unlink(path)
+    except OSError as e:
+        logger.debug(f"Could not remove spill file {path}: {str(e)}")
+
+def _decode(data: bytes, normalize_newlines: bool) -> str:
+    text = data.decode('utf-8', errors='replace')
+    return text.replace("\r\n", "\n") if normalize_newlines else text
+
+class SpilledOutput(str):
+    """Output too large to keep in memory, stored in a temp file.
+
+    The string value is a preview (the first and last ``preview_bytes``
+    with a note in between), so it can be shown, logged or JSON-encoded
+    like any other output. ``read_text``/``read_bytes`` load the full
+    output on demand; the file is removed once the last reference to it
+    is gone. Pickling keeps only the preview.
+    """
+    def __new__(cls, spill: SpillFile, start: int, end: int, preview_bytes: int,
+                normalize_newlines: bool = False) -> "SpilledOutput":
+        size = end - start
+        if size <= 2 * preview_bytes:
+            preview = _decode(spill.read(start, end), normalize_newlines)
+        else:
+            head = _decode(spill.read(start, start + preview_bytes), normalize_newlines)
+            tail = _decode(spill.read(end - preview_bytes, end), normalize_newlines)
+            preview = (f"{head}\n... [{size - 2 * preview_bytes} bytes omitted, "
+                       f"full output in {spill.path}] ...\n{tail}")
+        output = super().__new__(cls, preview)
+        output._spill = spill
+        output.start = start
+        output.end = end
+        output.normalize_newlines = normalize_newlines
+        return output
+
+    @property
+    def path(self) -> str:
+        return self._spill.path
+
+    @property
+    def size(self) -> int:
+        """Size of the full output in bytes."""
+        return self.end - self.start
+
+    def read_bytes(self) -> bytes:
+        return self._spill.read(self.start, self.end)
+
+    def read_text(self) -> str:
+        return _decode(self.read_bytes(), self.normalize_newlines)
+
+    def iter_chunks(self, size: int = SCAN_SIZE) -> Iterator[bytes]:
+        """Yield the full output in chunks of at most ``size`` bytes."""
+        for offset in range(self.start, self.end, size):
+            yield self._spill.read(offset, min(offset + size, self.end))
+
+    def __reduce__(self):
+        return str, (str(self),)
+
+Output = Union[str, SpilledOutput]
+
+class ReceiveBuffer:
+    """Byte accumulator for channel output with a memory cap.
+
+    Data is copied into a preallocated ``bytearray`` that doubles when full,
+    so growth is amortized O(1) instead of rebuilding a string per read,
+    and is decoded only when a slice is asked for (``text``), so multibyte
+    characters split across reads decode correctly.
+
+    Once more than ``max_bytes`` have arrived everything is moved to a temp
+    file and only the last SEARCH_WINDOW bytes stay in memory for
+    ``search_new``. ``text`` then returns slices larger than ``max_bytes``
+    as SpilledOutput handles instead of strings.
+    """
+    def __init__(self, max_bytes: Optional[int] = None, spill_dir: Optional[str] = None,
+                 preview_bytes: int = 64 * 1024, initial_size: int = CHUNK_SIZE):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.preview_bytes = preview_bytes
+        self.size = 0
+        self._data = bytearray(initial_size)
+        # Absolute offset of _data[0]; non-zero only after spilling
+        self._base = 0
+        self._used = 0
+        self._searched = 0
+        self._spill: Optional[SpillFile] = None
+
+    @property
+    def spilled(self) -> bool:
+        return self._spill is not None
+
+    def append(self, chunk: bytes):
+        if not chunk:
+            return
+        if self._spill is None and self.max_bytes is not None and self.size + len(chunk) > self.max_bytes:
+            self._start_spill()
+        if self._spill is not None:
+            self._spill.write(chunk)
+        self._copy_in(chunk)
+        self.size += len(chunk)
+        if self._spill is not None and self._used > 2 * SEARCH_WINDOW:
+            self._trim_window()
+
+    def search_new(self, pattern: "re.Pattern") -> Optional[BufferMatch]:
+        """First match of pattern in the data appended since the previous call.
+
+        Searches resume SEARCH_OVERLAP bytes early, so a marker split over
+        two reads is still found.
+        """
+        start = max(self._base, self._searched - SEARCH_OVERLAP)
+        self._searched = self.size
+        match = pattern.search(self._data, start - self._base, self._used)
+        if match is None:
+            return None
+        return BufferMatch(self._base + match.start(), self._base + match.end(), match)
+
+    def finditer(self, pattern: "re.Pattern", start: int = 0, end: Optional[int] = None) -> Iterator[BufferMatch]:
+        """All non-overlapping matches in ``[start, end)``, scanning a spill file in windows."""
+        end = self.size if end is None else min(end, self.size)
+        if self._spill is None:
+            for match in pattern.finditer(self._data, start, end):
+                yield BufferMatch(match.start(), match.end(), match)
+            return
+        position = start
+        while position < end:
+            window_end = min(end, position + SCAN_SIZE)
+            window = self._spill.read(position, window_end)
+            next_position = window_end - SEARCH_OVERLAP if window_end < end else end
+            for match in pattern.finditer(window):
+                if window_end < end and match.end() > len(window) - SEARCH_OVERLAP:
+                    # May continue past the window; matched again in the next one
+                    next_position = position + match.start()
+                    break
+                yield BufferMatch(position + match.start(), position + match.end(), match)
+                next_position = max(next_position, position + match.end())
+            position = max(next_position, position + 1)
+
+    def text(self, start: int = 0, end: Optional[int] = None, normalize_newlines: bool = False) -> Output:
+        """Decode ``[start, end)``; a spilled slice over ``max_bytes`` comes back as SpilledOutput."""
+        end = self.size if end is None else min(end, self.size)
+        start = min(start, end)
+        if self._spill is None:
+            return _decode(bytes(self._data[start:end]), normalize_newlines)
+        if start >= self._base:
+            return _decode(bytes(self._data[start - self._base:end - self._base]), normalize_newlines)
+        if self.max_bytes is None or end - start <= self.max_bytes:
+            return _decode(self._spill.read(start, end), normalize_newlines)
+        return SpilledOutput(self._spill, start, end, self.preview_bytes, normalize_newlines)
+
+    def _copy_in(self, chunk: bytes):
+        needed = self._used + len(chunk)
+        if needed > len(self._data):
+            capacity = len(self._data) or CHUNK_SIZE
+            while capacity < needed:
+                capacity *= 2
+            self._data.extend(bytes(capacity - len(self._data)))
+        memoryview(self._data)[self._used:needed] = chunk
+        self._used = needed
+
+    def _start_spill(self):
+        self._spill = SpillFile(self.spill_dir)
+        self._spill.write(memoryview(self._data)[:self._used])
+        METRICS.incr('output_spills')
+        logger.info(f"Output exceeded {self.max_bytes} bytes, spilling to {self._spill.path}")
+
+    def _trim_window(self):
+        drop = self._used - SEARCH_WINDOW
+        del self._data[:drop]
+        self._data.extend(bytes(drop))
+        self._used -= drop
+        self._base += drop
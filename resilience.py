@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Tuple, Type, TypeVar
+
+import paramiko
+
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# Errors worth another attempt: a dropped connection or a garbled/slow
+# banner under load. Timeouts and refused channel opens usually mean the box
+# is down, so retrying them only multiplies the cost; the circuit breaker
+# deals with those. Authentication failures are final.
+TRANSIENT_ERRORS: Tuple[Type[BaseException], ...] = (
+    ConnectionResetError,
+    ConnectionAbortedError,
+    EOFError,
+    paramiko.SSHException,
+)
+PERMANENT_ERRORS: Tuple[Type[BaseException], ...] = (
+    TimeoutError,
+    paramiko.AuthenticationException,
+    paramiko.ChannelException,
+)
+
+class CircuitOpenError(ConnectionError):
+    """Raised instead of trying a target whose circuit breaker is open."""
+
+class LatencyTracker:
+    """Adaptive timeouts from smoothed observed latency, per key.
+
+    Uses the TCP retransmission-timeout estimator (RFC 6298): the timeout is
+    ``srtt + 4 * rttvar`` scaled by ``headroom``, clamped to
+    ``[floor, ceiling]``, where the ceiling is the configured fixed timeout.
+    Keys without samples get the ceiling.
+    """
+    ALPHA = 0.125
+    BETA = 0.25
+
+    def __init__(self, floor: float, headroom: float = 2.0):
+        self.floor = floor
+        self.headroom = headroom
+        self._estimates: Dict[Hashable, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, key: Hashable, seconds: float):
+        with self._lock:
+            estimate = self._estimates.get(key)
+            if estimate is None:
+                self._estimates[key] = (seconds, seconds / 2)
+                return
+            srtt, rttvar = estimate
+            rttvar = (1 - self.BETA) * rttvar + self.BETA * abs(srtt - seconds)
+            srtt = (1 - self.ALPHA) * srtt + self.ALPHA * seconds
+            self._estimates[key] = (srtt, rttvar)
+
+    def timeout(self, key: Hashable, ceiling: float) -> float:
+        with self._lock:
+            estimate = self._estimates.get(key)
+        if estimate is None:
+            return ceiling
+        srtt, rttvar = estimate
+        return min(ceiling, max(self.floor, self.headroom * (srtt + 4 * rttvar)))
+
+class CircuitBreaker:
+    """Per-key circuit breaker.
+
+    After ``failure_threshold`` consecutive failures a key's circuit opens
+    and ``check`` raises CircuitOpenError for ``cooldown`` seconds. The
+    first caller after the cooldown is let through as a trial (half-open);
+    its success closes the circuit, its failure re-opens it with the
+    cooldown doubled, up to ``max_cooldown``.
+    """
+    def __init__(self, name: str, failure_threshold: int, cooldown: float, max_cooldown: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        # key -> [consecutive failures, open until, current cooldown, trial started] (monotonic)
+        self._state: Dict[Hashable, list] = {}
+        self._lock = threading.Lock()
+
+    def check(self, key: Hashable):
+        """Raise CircuitOpenError if calls to key should fail fast right now."""
+        with self._lock:
+            state = self._state.get(key)
+            if state is None or state[0] < self.failure_threshold:
+                return
+            now = time.monotonic()
+            remaining = state[1] - now
+            # A trial that never reported back stops blocking after one cooldown
+            if remaining <= 0 and now - state[3] > state[2]:
+                state[3] = now  # half-open: let one trial through
+                return
+        METRICS.incr('circuit_rejections', breaker=self.name)
+        if remaining > 0:
+            raise CircuitOpenError(f"{self.name} circuit open for {key} ({remaining:.0f}s left)")
+        raise CircuitOpenError(f"{self.name} circuit open for {key} (trial in progress)")
+
+    def is_open(self, key: Hashable) -> bool:
+        """True while key is inside its cooldown; unlike ``check`` this never starts a trial."""
+        with self._lock:
+            state = self._state.get(key)
+            return state is not None and state[0] >= self.failure_threshold and state[1] > time.monotonic()
+
+    def record_success(self, key: Hashable):
+        with self._lock:
+            self._state.pop(key, None)
+
+    def record_failure(self, key: Hashable):
+        with self._lock:
+            state = self._state.setdefault(key, [0, 0.0, self.cooldown, float('-inf')])
+            state[0] += 1
+            if state[0] < self.failure_threshold:
+                return
+            if state[0] > self.failure_threshold and state[1] <= time.monotonic():
+                # The half-open trial failed
+                state[2] = min(self.max_cooldown, state[2] * 2)
+            state[1] = time.monotonic() + state[2]
+            state[3] = float('-inf')
+            cooldown = state[2]
+        logger.warning(f"{self.name} circuit open for {key} for {cooldown:.0f}s")
+        METRICS.incr('circuit_opens', breaker=self.name)
+
+def retry(fn: Callable[[], T], attempts: int, base_delay: float, max_delay: float,
+          description: str = "operation",
+          should_retry: Optional[Callable[[BaseException], bool]] = None) -> T:
+    """Call fn, retrying transient failures with full-jitter exponential backoff.
+
+    The delay before retry ``n`` is uniform in ``[0, min(max_delay, base_delay * 2**n)]``.
+    """
+    should_retry = should_retry or is_transient
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except Exception as e:
+            attempt += 1
+            if attempt >= attempts or not should_retry(e):
+                raise
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+            logger.info(f"{description} failed ({str(e)}), retry {attempt} in {delay:.2f}s")
+            METRICS.incr('retries')
+            time.sleep(delay)
+
+async def retry_async(fn: Callable[[], Awaitable[T]], attempts: int, base_delay: float, max_delay: float,
+                      description: str = "operation",
+                      should_retry: Optional[Callable[[BaseException], bool]] = None) -> T:
+    """Await fn(), retrying like ``retry`` but sleeping cooperatively between attempts."""
+    should_retry = should_retry or is_transient
+    attempt = 0
+    while True:
+        try:
+            return await fn()
+        except Exception as e:
+            attempt += 1
+            if attempt >= attempts or not should_retry(e):
+                raise
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+            logger.info(f"{description} failed ({str(e)}), retry {attempt} in {delay:.2f}s")
+            METRICS.incr('retries')
+            await asyncio.sleep(delay)
+
+def is_transient(error: BaseException) -> bool:
+    if isinstance(error, PERMANENT_ERRORS + (CircuitOpenError,)):
+        return False
+    return isinstance(error, TRANSIENT_ERRORS)
@@ -0,0 +1,191 @@
+import contextvars
+import logging
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Deque, Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+from config import CONFIG, get_command_list
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+class RebootResult(NamedTuple):
+    """How one box fared in a rolling reboot.
+
+    ``status`` is 'healthy' (went down and came back), 'unreachable' (down
+    before the reboot, left alone), 'not_rebooted' (never went down),
+    'timed_out' (went down and did not come back in time), 'unconfirmed'
+    (still rebooting when the rollout was stopped) or 'not_started' (the
+    rollout stopped before reaching the box).
+    """
+    client_ip: str
+    status: str
+    wave: Optional[int]
+    elapsed: float
+    downtime: Optional[float]
+    error: Optional[Exception]
+
+    @property
+    def ok(self) -> bool:
+        return self.status == 'healthy'
+
+class _Box:
+    def __init__(self, client_ip: str, wave: int, error: Optional[Exception]):
+        self.client_ip = client_ip
+        self.wave = wave
+        self.error = error
+        self.rebooted_at = time.monotonic()
+        self.down_at: Optional[float] = None
+
+class RollingReboot:
+    """Reboot boxes in waves while capping how many are offline at once.
+
+    A wave reboots up to ``wave_size`` boxes, fewer when that would take
+    more than ``max_outage`` percent of all boxes offline; boxes that do not
+    answer before their wave are skipped rather than rebooted. Every
+    rebooting box is then probed each ``poll_interval`` seconds, all of them
+    concurrently over the proxy connection, and counts as healthy once it
+    was seen down and answers again. The next wave starts as soon as
+    ``healthy_fraction`` of the current one is healthy, without waiting for
+    its stragglers. The rollout stops early when a finished wave fell short
+    of that fraction, or when boxes that never came back use up the outage
+    budget.
+
+    ``runner`` is a CommandRunner or ProxyPool: anything with ``run_fleet``
+    and ``probe_reachable``. ``command_key`` must be an AVAILABLE_COMMANDS
+    entry marked ``reboots``.
+    """
+    def __init__(self, runner: Any, command_key: str = 'reboot',
+                 wave_size: Optional[int] = None, max_outage: Optional[float] = None,
+                 healthy_fraction: Optional[float] = None, poll_interval: Optional[float] = None,
+                 stop_event: Optional[threading.Event] = None):
+        if not CONFIG['AVAILABLE_COMMANDS'].get(command_key, {}).get('reboots'):
+            raise ValueError(f"Command '{command_key}' does not reboot the box")
+        self.runner = runner
+        self.command_key = command_key
+        self.wave_size = wave_size or CONFIG['REBOOT_WAVE_SIZE']
+        self.max_outage = CONFIG['REBOOT_MAX_OUTAGE'] if max_outage is None else max_outage
+        self.healthy_fraction = CONFIG['REBOOT_HEALTHY_FRACTION'] if healthy_fraction is None else healthy_fraction
+        self.poll_interval = poll_interval or CONFIG['REBOOT_POLL_INTERVAL']
+        self.stop_event = stop_event or threading.Event()
+        self._probe_pool: Optional[ThreadPoolExecutor] = None
+
+    def run(self, client_ips: Iterable[str]) -> Iterator[RebootResult]:
+        """Reboot the boxes, yielding each box's result as soon as it is known.
+
+        Setting ``stop_event`` ends the rollout at the next poll; boxes
+        still rebooting are then reported as 'unconfirmed'.
+        """
+        pending: Deque[str] = deque(dict.fromkeys(client_ips))
+        total = len(pending)
+        max_offline = max(1, math.floor(total * self.max_outage / 100))
+        in_flight: Dict[str, _Box] = {}
+        stuck = 0  # boxes that went down and never came back
+        wave: List[_Box] = []
+        wave_healthy = 0
+        waves = 0
+        halted = False
+        logger.info(f"Rolling reboot of {total} boxes, at most {max_offline} offline at once")
+
+        self._probe_pool = ThreadPoolExecutor(max_workers=CONFIG['REBOOT_PROBE_WORKERS'],
+                                              thread_name_prefix="reboot-probe")
+        try:
+            while (in_flight or (pending and not halted)) and not self.stop_event.is_set():
+                wave_done = all(box.client_ip not in in_flight for box in wave)
+                wave_ready = wave_done or wave_healthy >= math.ceil(self.healthy_fraction * len(wave))
+                if pending and not halted and wave_ready:
+                    if wave_done and wave_healthy < self.healthy_fraction * len(wave):
+                        # Stop starting waves, but see the boxes already rebooting through
+                        logger.error(f"Halting rolling reboot: only {wave_healthy} of {len(wave)} boxes "
+                                     f"in wave {waves} came back")
+                        halted = True
+                        continue
+                    size = min(self.wave_size, max_offline - len(in_flight) - stuck, len(pending))
+                    if size > 0:
+                        waves += 1
+                        wave, wave_healthy = [], 0
+                        batch = [pending.popleft() for _ in range(size)]
+                        yield from self._start_wave(batch, waves, in_flight, wave)
+                    elif not in_flight:
+                        logger.error(f"Halting rolling reboot: {stuck} boxes that did not come back "
+                                     f"use up the outage budget")
+                        halted = True
+                    continue
+
+                for result in self._poll(in_flight):
+                    stuck += result.status == 'timed_out'
+                    wave_healthy += result.ok and result.wave == waves
+                    yield result
+                self.stop_event.wait(self.poll_interval)
+
+            for box in in_flight.values():
+                yield RebootResult(box.client_ip, 'unconfirmed', box.wave, time.monotonic() - box.rebooted_at,
+                                   None, box.error)
+            for client_ip in pending:
+                yield RebootResult(client_ip, 'not_started', None, 0.0, None, None)
+        finally:
+            self._probe_pool.shutdown(wait=True, cancel_futures=True)
+
+    def _start_wave(self, client_ips: List[str], wave_number: int,
+                    in_flight: Dict[str, _Box], wave: List[_Box]) -> Iterator[RebootResult]:
+        """Check the boxes answer, then reboot those that do."""
+        reachable = self._probe_all(client_ips)
+        targets = []
+        for client_ip in client_ips:
+            if reachable[client_ip]:
+                targets.append(client_ip)
+            else:
+                logger.warning(f"Skipping unreachable box {client_ip}")
+                yield RebootResult(client_ip, 'unreachable', wave_number, 0.0, None, None)
+        if not targets:
+            return
+        logger.info(f"Wave {wave_number}: rebooting {len(targets)} boxes")
+        METRICS.incr('reboot_waves')
+        commands = get_command_list(self.command_key)
+        with METRICS.span('reboot_wave', boxes=len(targets)):
+            for result in self.runner.run_fleet(targets, commands, max_workers=len(targets),
+                                                command_key=self.command_key):
+                # The box dropping the session mid-command is expected; whether
+                # it really rebooted shows in the probes
+                if result.error is not None:
+                    logger.debug(f"Reboot of {result.client_ip} ended with: {str(result.error)}")
+                box = _Box(result.client_ip, wave_number, result.error)
+                in_flight[result.client_ip] = box
+                wave.append(box)
+
+    def _poll(self, in_flight: Dict[str, _Box]) -> List[RebootResult]:
+        """Probe every rebooting box once and retire those that are done."""
+        reachable = self._probe_all(list(in_flight))
+        now = time.monotonic()
+        finished = []
+        for client_ip, up in reachable.items():
+            box = in_flight[client_ip]
+            status = None
+            if not up and box.down_at is None:
+                box.down_at = now
+            elif up and box.down_at is not None:
+                status = 'healthy'
+            elif up and now - box.rebooted_at > CONFIG['REBOOT_DOWN_TIMEOUT']:
+                status = 'not_rebooted'
+            elif not up and now - box.rebooted_at > CONFIG['REBOOT_UP_TIMEOUT']:
+                status = 'timed_out'
+            if status is not None:
+                del in_flight[client_ip]
+                METRICS.incr(f'reboot_{status}')
+                downtime = now - box.down_at if box.down_at is not None and status == 'healthy' else None
+                finished.append(RebootResult(client_ip, status, box.wave, now - box.rebooted_at,
+                                             downtime, box.error))
+        return finished
+
+    def _probe_all(self, client_ips: List[str]) -> Dict[str, bool]:
+        timeout = CONFIG['REBOOT_PROBE_TIMEOUT']
+        futures = {
+            client_ip: self._probe_pool.submit(contextvars.copy_context().run,
+                                               self.runner.probe_reachable, client_ip, timeout)
+            for client_ip in client_ips
+        }
+        with METRICS.span('reboot_probe', boxes=len(client_ips)):
+            return {client_ip: future.result() for client_ip, future in futures.items()}
@@ -0,0 +1,503 @@
+"""Transport-independent parts of the command runners.
+
+CommandRunner (paramiko, one thread per session) and AsyncCommandRunner
+(asyncssh, one event loop) only differ in how bytes reach the proxy and
+the boxes. Everything else lives here and is used by both: the marker
+scripts and their parsing, the nested ssh login, plan walking, and the
+result cache, breaker, run history and logclient bookkeeping around a
+command sequence.
+"""
+import contextvars
+import logging
+import re
+import threading
+import time
+from concurrent.futures import CancelledError, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Iterable, Iterator, List, Match, NamedTuple, Optional, Pattern, Tuple, Type
+
+from cache import ResultCache
+from config import CONFIG
+from history import RunHistory, get_history
+from logclient_registry import LogclientRegistry
+from logstream import LogclientStream
+from metrics import METRICS
+from plans import Plan, Stage
+from recvbuf import BufferMatch, Output, ReceiveBuffer
+from resilience import CircuitBreaker, LatencyTracker
+
+logger = logging.getLogger(__name__)
+
+# Prefix of the echo markers used to detect command completion in shell mode
+SENTINEL = "__KAL_"
+
+# Prompts and failures the nested ssh can produce while logging in
+AUTH_PROMPT_PATTERN = re.compile(
+    r"\(yes/no[^)]*\)\?|password:"
+    r"|(?P<failure>permission denied|no route to host|connection refused"
+    r"|connection timed out|could not resolve hostname)"
+    r"|[#$>] ?$",
+    re.IGNORECASE
+)
+
+# What the proxy's ssh prints when the client drops the nested session
+CLIENT_CLOSED = r"Connection to \S+ closed"
+
+class CommandTimeoutError(TimeoutError):
+    """Raised when expected output does not arrive before the deadline."""
+    def __init__(self, message: str, output: str = ""):
+        super().__init__(message)
+        self.output = output
+
+class FleetResult(NamedTuple):
+    """Outcome of a command sequence run against a single client.
+
+    ``skipped`` marks a client that was never started because the sweep's
+    throttle refused it (e.g. on shutdown); ``error`` holds the reason.
+    """
+    client_ip: str
+    outputs: List[str]
+    logclient_output: str
+    error: Optional[Exception]
+    elapsed: float
+    skipped: bool = False
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+class CommandResult(NamedTuple):
+    """Output of a single command executed over a direct client session.
+
+    A stream larger than OUTPUT_MAX_BYTES is a SpilledOutput.
+    """
+    stdout: Output
+    stderr: Output
+    exit_status: int
+
+class _FleetMemberRun:
+    """Times one fleet member and builds its FleetResult, for the sync and async runners alike."""
+    def __init__(self, client_ip: str):
+        self.client_ip = client_ip
+        self.started = time.monotonic()
+
+    def finished(self, result: Tuple[List[str], str]) -> FleetResult:
+        outputs, logclient_output = result
+        return FleetResult(self.client_ip, outputs, logclient_output, None, time.monotonic() - self.started)
+
+    def failed(self, error: Exception) -> FleetResult:
+        logger.error(f"Fleet member {self.client_ip} failed: {str(error)}")
+        return FleetResult(self.client_ip, [], "", error, time.monotonic() - self.started)
+
+def skipped_member(client_ip: str, reason: Exception) -> FleetResult:
+    """Result of a fleet member the throttle refused, so it never ran."""
+    return FleetResult(client_ip, [], "", reason, 0.0, skipped=True)
+
+def fleet_member(client_ip: str, run: Callable[[str], Tuple[List[str], str]],
+                 throttle: Optional[Callable[[], None]] = None) -> FleetResult:
+    """Run one fleet member's sequence with ``run(client_ip)``, capturing any error.
+
+    A member the throttle refuses (by raising) is not run and comes back ``skipped``.
+    """
+    try:
+        if throttle is not None:
+            throttle()
+    except Exception as e:
+        logger.debug(f"Fleet member {client_ip} skipped: {str(e)}")
+        return skipped_member(client_ip, e)
+    member = _FleetMemberRun(client_ip)
+    try:
+        return member.finished(run(client_ip))
+    except Exception as e:
+        return member.failed(e)
+
+async def fleet_member_async(client_ip: str,
+                             run: Callable[[str], Awaitable[Tuple[List[str], str]]]) -> FleetResult:
+    """``fleet_member`` for a coroutine function; the caller applies any throttle."""
+    member = _FleetMemberRun(client_ip)
+    try:
+        return member.finished(await run(client_ip))
+    except Exception as e:
+        return member.failed(e)
+
+def run_fleet_members(client_ips: Iterable[str], run: Callable[[str], Tuple[List[str], str]], workers: int,
+                      throttle: Optional[Callable[[], None]] = None) -> Iterator[FleetResult]:
+    """Run ``fleet_member`` for every client on a thread pool, yielding results as they finish.
+
+    Each worker inherits the caller's metric tags (e.g. the command key).
+    Clients still queued are cancelled if the consumer abandons the iterator.
+    """
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fleet")
+    try:
+        futures = [
+            executor.submit(contextvars.copy_context().run, fleet_member, client_ip, run, throttle)
+            for client_ip in client_ips
+        ]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def output_buffer() -> ReceiveBuffer:
+    """Receive buffer for one command's output, spilling past OUTPUT_MAX_BYTES."""
+    return ReceiveBuffer(CONFIG['OUTPUT_MAX_BYTES'] or None, CONFIG['OUTPUT_SPILL_DIR'],
+                         CONFIG['OUTPUT_PREVIEW_BYTES'])
+
+def bytes_pattern(pattern: Pattern) -> Pattern:
+    """The bytes equivalent of an ASCII str pattern."""
+    return re.compile(pattern.pattern.encode(), pattern.flags & ~re.UNICODE)
+
+def combined_output(result: CommandResult) -> Output:
+    """stdout followed by stderr; a spilled stream is passed through when the other is empty."""
+    if not result.stderr:
+        return result.stdout
+    if not result.stdout:
+        return result.stderr
+    return result.stdout + result.stderr
+
+def ready_script(token: str) -> Tuple[str, Pattern]:
+    """A line echoing a marker, and the pattern that finds it once the shell ran it.
+
+    The split quotes keep the typed echo from matching the marker.
+    """
+    return f'echo "{SENTINEL}""READY_{token}"\n', re.compile(f"{SENTINEL}READY_{token}")
+
+def command_script(token: str, command: str) -> str:
+    """One shell line running command between BEGIN and END markers; END carries the exit status."""
+    return f'echo "{SENTINEL}""BEGIN_{token}"; {command}; echo "{SENTINEL}""END_{token}:$?"\n'
+
+def command_end_pattern(token: str) -> Pattern:
+    """Bytes pattern for the END marker of ``command_script``, or the client dropping the session."""
+    return re.compile(rf"{SENTINEL}END_{token}:(?P<status>\d+)|{CLIENT_CLOSED}".encode())
+
+def split_command(buffer: ReceiveBuffer, token: str, end: BufferMatch) -> Tuple[Output, Optional[int]]:
+    """The output of a ``command_script`` run and its exit status.
+
+    The status is None when ``end`` is the client dropping the connection
+    (e.g. a reboot) rather than the END marker.
+    """
+    begin_pattern = re.compile(rf"{SENTINEL}BEGIN_{token}[^\n]*\n".encode())
+    begin = next(buffer.finditer(begin_pattern, 0, end.start), None)
+    output = buffer.text(begin.end if begin else 0, end.start, normalize_newlines=True)
+    status = end.match.group("status")
+    return output, None if status is None else int(status)
+
+def batch_script(token: str, commands: List[str], stderr_markers: bool = False) -> str:
+    """Join commands into one script that brackets each with BEGIN/END markers.
+
+    The END marker carries the command's exit status. With ``stderr_markers``
+    the BEGIN marker is also written to stderr so that stream can be split too.
+    """
+    lines = []
+    for index, command in enumerate(commands):
+        begin = f'echo "{SENTINEL}""BEGIN_{token}_{index}"'
+        if stderr_markers:
+            begin += f'; {begin} >&2'
+        lines.append(f'{begin}; {command}; echo "{SENTINEL}""END_{token}_{index}:$?"')
+    return "\n".join(lines) + "\n"
+
+def batch_end_pattern(token: str, count: int) -> Pattern:
+    """Bytes pattern for the END marker of a batch's last command, or the client dropping the session."""
+    return re.compile(rf"{SENTINEL}END_{token}_{count - 1}:\d+|{CLIENT_CLOSED}".encode())
+
+def split_batch(buffer: ReceiveBuffer, token: str, end: Optional[int] = None,
+                normalize_newlines: bool = False) -> List[Tuple[Output, Optional[int]]]:
+    """Split batched output into (output, exit status) per command that started.
+
+    Only ``buffer[:end]`` is considered. A command whose END marker is
+    missing runs to the next BEGIN marker or ``end``, and has a status of None.
+    """
+    end = buffer.size if end is None else end
+    marker = re.compile(
+        rf"{SENTINEL}(?P<kind>BEGIN|END)_{token}_(?P<index>\d+)(?::(?P<status>\d+))?\r?\n?".encode()
+    )
+    segments: List[Tuple[int, int, Optional[int]]] = []
+    start = None
+    for found in buffer.finditer(marker, 0, end):
+        if found.match.group("kind") == b"BEGIN":
+            if start is not None:
+                segments.append((start, found.start, None))
+            start = found.end
+        elif start is not None:
+            segments.append((start, found.start, int(found.match.group("status"))))
+            start = None
+    if start is not None:
+        segments.append((start, end, None))
+    return [(buffer.text(first, last, normalize_newlines), status) for first, last, status in segments]
+
+def split_exec_batch(out: ReceiveBuffer, err: ReceiveBuffer, token: str) -> List[CommandResult]:
+    """Results of a ``batch_script(stderr_markers=True)`` run over exec, one per command that started."""
+    out_parts = split_batch(out, token)
+    err_parts = split_batch(err, token)
+    err_parts += [("", None)] * (len(out_parts) - len(err_parts))
+    return [
+        CommandResult(out, err, -1 if status is None else status)
+        for (out, status), (err, _) in zip(out_parts, err_parts)
+    ]
+
+def split_shell_batch(buffer: ReceiveBuffer, token: str, end: BufferMatch) -> Tuple[List[CommandResult], bool]:
+    """Results of a ``batch_script`` typed into a shell, and whether the client is still attached.
+
+    When ``end`` is the client dropping the connection the shell belongs to
+    the proxy again, so nothing else may be typed into it.
+    """
+    attached = end.match.group(0).startswith(SENTINEL.encode())
+    results = [
+        CommandResult(out, "", -1 if status is None else status)
+        for out, status in split_batch(buffer, token, end.end if attached else end.start,
+                                       normalize_newlines=True)
+    ]
+    return results, attached
+
+def logclient_command(client_ip: str) -> str:
+    """The shell prints its PID before exec'ing logclient, so the PID is logclient's own."""
+    return f"echo $$; exec logclient {client_ip}"
+
+def kill_command(pids: List[int]) -> str:
+    """Kill the PIDs whose command line still names logclient, so a reused PID is left alone."""
+    pid_list = " ".join(str(int(pid)) for pid in pids)
+    return f"for pid in {pid_list}; do grep -qs logclient /proc/$pid/cmdline && kill -9 $pid; done; true"
+
+class NestedLogin:
+    """Answers the prompts of a nested ssh login, one matched AUTH_PROMPT_PATTERN at a time.
+
+    ``rejected`` is the exception raised when the password is asked for
+    twice (the transport's own authentication error).
+    """
+    def __init__(self, password: str, rejected: Type[Exception]):
+        self.password = password
+        self.rejected = rejected
+        self.password_sent = False
+        self.done = False
+
+    def answer(self, match: Match) -> Optional[str]:
+        """What to type in reply to a prompt, if anything; sets ``done`` once the client shell is up."""
+        prompt = match.group(0).lower()
+        if "yes/no" in prompt:
+            return "yes\n"
+        if "password:" in prompt:
+            if self.password_sent:
+                raise self.rejected("Client rejected the password")
+            self.password_sent = True
+            return f"{self.password}\n"
+        if match.group("failure"):
+            raise ConnectionError(f"Nested ssh failed: {match.group(0).strip()}")
+        # Any other prompt is the proxy's own until the password was sent
+        self.done = self.password_sent
+        return None
+
+class PlanProgress:
+    """Walks a plan's stages for one sequence, collecting each step's output.
+
+    ``stages`` yields the steps to run per round trip, leaving out those
+    whose condition fails on the outputs so far; the runner runs each
+    stage and hands its outputs to ``record``.
+    """
+    def __init__(self, plan: Plan, client_ip: str, batch: bool,
+                 on_output: Optional[Callable[[int, str], None]] = None,
+                 cancel_event: Optional[threading.Event] = None):
+        self.plan = plan
+        self.client_ip = client_ip
+        self.batch = batch
+        self.on_output = on_output
+        self.cancel_event = cancel_event
+        self._outputs: List[Optional[Output]] = [None] * len(plan.steps)
+
+    def stages(self) -> Iterator[Stage]:
+        """Stages still to run; raises CancelledError before one once ``cancel_event`` is set."""
+        for stage in self.plan.stages(self.batch):
+            steps = [step for step in stage.steps if self.plan.should_run(step, self._outputs)]
+            if len(steps) < len(stage.steps):
+                METRICS.incr('plan_steps_skipped', len(stage.steps) - len(steps))
+            if not steps:
+                continue
+            if self.cancel_event is not None and self.cancel_event.is_set():
+                raise CancelledError(f"Cancelled before command {steps[0].index + 1} on {self.client_ip}")
+            yield Stage(steps, stage.concurrent)
+
+    def record(self, stage: Stage, results: List[Output]):
+        """Store a stage's outputs; fewer than its steps means the session closed part-way."""
+        for step, output in zip(stage.steps, results):
+            self._outputs[step.index] = output
+            if self.on_output:
+                self.on_output(step.index, output)
+        if len(results) < len(stage.steps):
+            raise ConnectionError(
+                f"Session to {self.client_ip} closed during command {stage.steps[len(results)].index + 1} "
+                f"of {len(self.plan.steps)}"
+            )
+
+    def outputs(self) -> List[str]:
+        """Every step's output, empty for the steps that were skipped."""
+        return ["" if output is None else output for output in self._outputs]
+
+class SequenceRun:
+    """The bookkeeping around one run_command_sequence call.
+
+    Resolves the command key to a rendered plan, answers from the result
+    cache while fresh, checks the breakers, and records the outcome in the
+    run history and the cache; the runner does the I/O in between.
+    """
+    def __init__(self, runner: "RunnerBase", client_ip: str, commands: List[str],
+                 command_key: Optional[str] = None, batch: Optional[bool] = None):
+        if not runner.ssh_client.validate_ip(client_ip):
+            raise ValueError(f"Invalid IP address: {client_ip}")
+        self.runner = runner
+        self.client_ip = client_ip
+        self.command_key = command_key
+        self.batch = CONFIG['BATCH_COMMANDS'] if batch is None else batch
+        self.command_config = CONFIG['AVAILABLE_COMMANDS'].get(command_key, {}) if command_key else {}
+        plan = Plan.from_config(command_key, commands) if self.command_config else Plan.sequence(commands)
+        self.plan = plan.render(client_ip)
+        self.commands = self.plan.commands
+        self.cache = runner.result_cache if self.command_config.get('cacheable') else None
+        # The rendered commands are part of the key: a changed entry or param must not hit
+        self.cache_key = (command_key, tuple(self.commands))
+        self.generation: Optional[int] = None
+        self.started = time.monotonic()
+
+    def cached(self, on_output: Optional[Callable[[int, str], None]] = None) -> Optional[Tuple[List[str], str]]:
+        """The cached result, replayed to ``on_output``, or None on a miss (or when not cacheable)."""
+        if self.cache is None:
+            return None
+        cached = self.cache.get(self.client_ip, self.cache_key)
+        if cached is None:
+            METRICS.incr('cache_misses')
+            self.generation = self.cache.generation(self.client_ip)
+            return None
+        METRICS.incr('cache_hits')
+        outputs, logclient_output = cached
+        if on_output:
+            for index, output in enumerate(outputs):
+                on_output(index, output)
+        return list(outputs), logclient_output
+
+    @contextmanager
+    def attempt(self) -> Iterator[None]:
+        """Guard the run itself: check the breakers first and record a failure in the history."""
+        self.runner.proxy_breaker.check(self.runner.ssh_client.host)
+        self.runner.client_breaker.check(self.client_ip)
+        self.started = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            self._record_history(None, None, e)
+            raise
+        finally:
+            # Invalidate even on failure: the box may have changed part-way
+            if self.command_config.get('mutating') and self.runner.result_cache is not None:
+                self.runner.result_cache.invalidate_ip(self.client_ip)
+
+    def finished(self, outputs: List[str], logclient_output: str) -> Tuple[List[str], str]:
+        """Record a successful run in the history and the cache and return it."""
+        self._record_history(outputs, logclient_output, None)
+        if self.cache is not None:
+            self.cache.put(self.client_ip, self.cache_key, (tuple(outputs), logclient_output),
+                           self.command_config.get('cache_ttl'), self.generation)
+        return outputs, logclient_output
+
+    def _record_history(self, outputs: Optional[List[str]], logclient_output: Optional[str],
+                        error: Optional[BaseException]):
+        if self.runner.history is not None:
+            self.runner.history.record(self.client_ip, self.command_key, self.commands, outputs,
+                                       logclient_output, error, time.monotonic() - self.started,
+                                       proxy=self.runner.ssh_client.host)
+
+class RunnerBase:
+    """State and bookkeeping shared by CommandRunner and AsyncCommandRunner.
+
+    Subclasses provide the I/O, including ``kill_logclients``.
+    """
+    def __init__(self, ssh_client: Any, hop_mode: Optional[str] = None,
+                 result_cache: Optional[ResultCache] = None,
+                 history: Optional[RunHistory] = None):
+        self.ssh_client = ssh_client
+        self.hop_mode = hop_mode or CONFIG['CLIENT_HOP_MODE']
+        if result_cache is None and CONFIG['RESULT_CACHE_SIZE'] > 0:
+            result_cache = ResultCache(CONFIG['RESULT_CACHE_SIZE'], CONFIG['RESULT_CACHE_TTL'])
+        self.result_cache = result_cache
+        self.history = history if history is not None else get_history()
+        self.logclients = LogclientRegistry(ssh_client.host, CONFIG['LOGCLIENT_JOURNAL'])
+        # Timeouts follow each box's observed latency, capped by the configured ones
+        self.latency = LatencyTracker(CONFIG['ADAPTIVE_TIMEOUT_MIN'], CONFIG['ADAPTIVE_TIMEOUT_HEADROOM'])
+        self.client_breaker = CircuitBreaker(
+            'client', CONFIG['CLIENT_BREAKER_THRESHOLD'], CONFIG['BREAKER_COOLDOWN'], CONFIG['BREAKER_MAX_COOLDOWN']
+        )
+        self.proxy_breaker = CircuitBreaker(
+            'proxy', CONFIG['PROXY_BREAKER_THRESHOLD'], CONFIG['BREAKER_COOLDOWN'], CONFIG['BREAKER_MAX_COOLDOWN']
+        )
+
+    def kill_logclients(self, pids: List[int]) -> Tuple[str, str]:
+        raise NotImplementedError
+
+    def kill_logclient_for_ip(self, client_ip: str) -> Tuple[str, str]:
+        """
+        Kill the logclient processes this runner started for the specified client IP.
+        Returns a tuple of (stdout, stderr) from the kill command.
+        """
+        return self.kill_logclients(self.logclients.pids(client_ip))
+
+    def kill_tracked_logclients(self) -> Tuple[str, str]:
+        """Kill every logclient this runner still tracks, in a single exec."""
+        return self.kill_logclients(self.logclients.pids())
+
+    def reap_orphaned_logclients(self) -> List[int]:
+        """Kill logclients on this proxy left behind by kal-tools processes that died."""
+        orphans = self.logclients.orphans()
+        if orphans:
+            logger.warning(f"Reaping {len(orphans)} orphaned logclient processes on {self.ssh_client.host}")
+            self.kill_logclients([pid for pid, _ in orphans])
+        return [pid for pid, _ in orphans]
+
+    def _logclients_killed(self, pids: List[int], out: str, err: str) -> Tuple[str, str]:
+        """Forget PIDs the kill command ran for."""
+        for pid in pids:
+            self.logclients.remove(pid)
+        logger.debug(f"Killed logclient processes {' '.join(map(str, pids))}: {out!r} {err!r}")
+        return out, err
+
+    @contextmanager
+    def _breaker_guard(self, breaker: CircuitBreaker, key: str) -> Iterator[None]:
+        """Record the block's outcome with the breaker; a cancellation counts as neither."""
+        try:
+            yield
+        except CancelledError:
+            raise
+        except Exception:
+            breaker.record_failure(key)
+            raise
+        breaker.record_success(key)
+
+    def _logclient_stream(self, stream_class: Type[LogclientStream], channel: Any,
+                          client_ip: str) -> LogclientStream:
+        """Start streaming a logclient channel, journaling its PID once it is known."""
+        return stream_class(
+            channel,
+            client_ip,
+            max_lines=CONFIG['LOGCLIENT_MAX_LINES'],
+            max_bytes=CONFIG['LOGCLIENT_MAX_BYTES'],
+            spill=CONFIG['LOGCLIENT_SPILL'],
+            spill_dir=CONFIG['OUTPUT_SPILL_DIR'],
+            preview_bytes=CONFIG['OUTPUT_PREVIEW_BYTES'],
+            on_pid=lambda pid: self.logclients.add(pid, client_ip)
+        ).start()
+
+    def _drain_timeout(self) -> float:
+        return self.latency.timeout(('drain', self.ssh_client.host), CONFIG['LOGCLIENT_DRAIN_TIMEOUT'])
+
+    def _logclient_drained(self, stream: LogclientStream, started: float) -> Optional[int]:
+        """Account for a stopped logclient; returns its PID if it ignored the interrupt and must be killed."""
+        if stream.exited:
+            self.latency.observe(('drain', self.ssh_client.host), time.monotonic() - started)
+        if stream.dropped_lines:
+            logger.warning(f"Dropped {stream.dropped_lines} oldest logclient lines for {stream.client_ip}")
+        if stream.spilled_lines:
+            logger.info(f"Spilled {stream.spilled_lines} logclient lines for {stream.client_ip} to disk")
+        if stream.pid is None:
+            if not stream.exited:
+                logger.warning(f"Logclient for {stream.client_ip} did not report its PID and may still run")
+            return None
+        if stream.exited:
+            self.logclients.remove(stream.pid)
+            return None
+        return stream.pid
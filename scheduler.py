@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""Monitoring daemon running periodic fleet sweeps.
+
+Sweeps are declared in a JSON file:
+
+    {"sweeps": [
+        {"name": "ping", "command": "ping", "interval": 300,
+         "targets": "estate.txt", "concurrency": 16},
+        {"name": "standby", "command": "standby_status", "interval": 900,
+         "targets": ["10.10.0.5", "10.10.0.6"], "overrun": "coalesce"}
+    ]}
+
+``targets`` is a list of IPs or a file in the ``cli.py`` IP format, re-read
+before every run. Each run starts up to ``jitter`` x ``interval`` seconds
+after its slot, so sweeps sharing an interval do not fire together, and
+every box session across all sweeps takes a token from one global bucket
+(SCHEDULER_SESSION_RATE per second), so the proxy never sees a burst. A
+sweep still running when its next slot comes is not started twice: the
+slot is skipped (``overrun: skip``) or a single catch-up run is queued
+(``coalesce``). A proxy connection that dropped is re-established before
+the next sweep. Results are written as JSON lines, one per box.
+
+    python scheduler.py sweeps.json --output results.jsonl
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import signal
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, TextIO, Tuple, Union
+
+os.environ.setdefault('KAL_TOOLS_SKIP_DOTENV', '1')
+
+from cli import add_connection_arguments, connect_runner, fleet_record, read_ips
+from config import CONFIG, get_command_list
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+OVERRUN_POLICIES = ('skip', 'coalesce')
+
+class TokenBucket:
+    """Thread-safe token bucket: ``rate`` tokens per second, at most ``burst`` banked.
+
+    ``burst`` is at least one token, or ``acquire`` could never succeed.
+    """
+    def __init__(self, rate: float, burst: float):
+        if rate <= 0:
+            raise ValueError("Token rate must be positive")
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, stop: Optional[threading.Event] = None) -> bool:
+        """Block until a token is available; returns False if ``stop`` was set first."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if stop is None:
+                time.sleep(wait)
+            elif stop.wait(wait):
+                return False
+
+class Sweep:
+    """One declared sweep and its scheduling state."""
+    def __init__(self, name: str, command: str, interval: float, targets: Union[str, List[str]],
+                 concurrency: Optional[int] = None, jitter: Optional[float] = None,
+                 overrun: str = 'skip', timeout: Optional[float] = None):
+        if command not in CONFIG['AVAILABLE_COMMANDS']:
+            raise ValueError(f"Sweep {name}: unknown command '{command}'")
+        if interval <= 0:
+            raise ValueError(f"Sweep {name}: interval must be positive")
+        if overrun not in OVERRUN_POLICIES:
+            raise ValueError(f"Sweep {name}: overrun must be one of {', '.join(OVERRUN_POLICIES)}")
+        self.name = name
+        self.command = command
+        self.interval = interval
+        self.targets = targets
+        self.concurrency = concurrency
+        self.jitter = CONFIG['SCHEDULER_JITTER'] if jitter is None else jitter
+        self.overrun = overrun
+        self.timeout = timeout
+        self.slot = time.monotonic()
+        self.next_run = self.slot + self._jitter()
+        self.running = False
+        self.pending = False
+        self.runs = 0
+        self.skipped = 0
+
+    @classmethod
+    def from_dict(cls, entry: Dict[str, Any]) -> "Sweep":
+        return cls(
+            entry.get('name') or entry['command'],
+            entry['command'],
+            float(entry['interval']),
+            entry['targets'],
+            concurrency=entry.get('concurrency'),
+            jitter=entry.get('jitter'),
+            overrun=entry.get('overrun', 'skip'),
+            timeout=entry.get('timeout'),
+        )
+
+    def ips(self) -> List[str]:
+        if isinstance(self.targets, str):
+            with open(self.targets) as f:
+                return list(read_ips([f]))
+        return list(self.targets)
+
+    def advance(self, now: float):
+        """Move to the first slot after now; slots stay on the interval grid (no drift)."""
+        missed = int((now - self.slot) // self.interval)
+        self.slot += (missed + 1) * self.interval
+        self.next_run = self.slot + self._jitter()
+
+    def _jitter(self) -> float:
+        return random.uniform(0, self.jitter * self.interval)
+
+def load_sweeps(path: str) -> List[Sweep]:
+    with open(path) as f:
+        data = json.load(f)
+    sweeps = [Sweep.from_dict(entry) for entry in data.get('sweeps', [])]
+    names = [sweep.name for sweep in sweeps]
+    if len(set(names)) != len(names):
+        raise ValueError("Sweep names must be unique")
+    return sweeps
+
+class Scheduler:
+    """Runs sweeps on their schedules against one runner (CommandRunner or ProxyPool).
+
+    With ``connect``, which returns a fresh (runner, SSHClient) pair like
+    ``cli.connect_runner``, a runner whose proxy connection dropped is
+    replaced before the next sweep starts. A ProxyPool reconnects its
+    proxies itself.
+    """
+    def __init__(self, runner: Any, sweeps: List[Sweep], out: TextIO,
+                 session_rate: Optional[float] = None, session_burst: Optional[float] = None,
+                 connect: Optional[Callable[[], Tuple[Any, Any]]] = None, ssh_client: Any = None):
+        self.runner = runner
+        self.ssh_client = ssh_client
+        self.connect = connect
+        self.sweeps = sweeps
+        self.out = out
+        rate = CONFIG['SCHEDULER_SESSION_RATE'] if session_rate is None else session_rate
+        if rate <= 0:
+            raise ValueError("Session rate must be positive")
+        self.bucket = TokenBucket(rate, session_burst or CONFIG['SCHEDULER_SESSION_BURST'] or rate)
+        self.stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self._out_lock = threading.Lock()
+        self._connect_lock = threading.Lock()
+        self._threads: List[threading.Thread] = []
+
+    def run_forever(self):
+        """Dispatch sweeps until stop() is called, then wait for running sweeps."""
+        logger.info(f"Scheduling {len(self.sweeps)} sweeps")
+        while not self.stop_event.is_set():
+            now = time.monotonic()
+            with self._lock:
+                for sweep in self.sweeps:
+                    if sweep.next_run <= now:
+                        self._dispatch(sweep, now)
+                next_due = min(sweep.next_run for sweep in self.sweeps)
+            self.stop_event.wait(max(0.0, min(next_due - time.monotonic(), 1.0)))
+        for thread in list(self._threads):
+            thread.join()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def close(self):
+        """Close the current runner and its proxy connection."""
+        self._close(self.runner, self.ssh_client)
+
+    def _dispatch(self, sweep: Sweep, now: float):
+        """Start a due sweep, or apply its overrun policy if it is still running (lock held)."""
+        sweep.advance(now)
+        if sweep.running:
+            if sweep.overrun == 'coalesce':
+                sweep.pending = True
+            else:
+                sweep.skipped += 1
+                logger.warning(f"Sweep {sweep.name} still running, skipping this run "
+                               f"({sweep.skipped} skipped so far)")
+            return
+        self._start(sweep)
+
+    def _start(self, sweep: Sweep):
+        sweep.running = True
+        thread = threading.Thread(target=self._run_sweep, args=(sweep,), name=f"sweep-{sweep.name}", daemon=True)
+        self._threads = [t for t in self._threads if t.is_alive()] + [thread]
+        thread.start()
+
+    def _run_sweep(self, sweep: Sweep):
+        started = time.monotonic()
+        failures = boxes = 0
+        try:
+            runner = self._live_runner()
+            ips = sweep.ips()
+            commands = get_command_list(sweep.command)
+            with METRICS.context(command_key=sweep.command, sweep=sweep.name):
+                for result in runner.run_fleet(ips, commands, max_workers=sweep.concurrency,
+                                                    timeout=sweep.timeout, command_key=sweep.command,
+                                                    throttle=self._throttle):
+                    if result.skipped:
+                        # Refused by the throttle on shutdown, not a real failure
+                        continue
+                    boxes += 1
+                    failures += not result.ok
+                    record = fleet_record(result, sweep.command, include_logclient=False)
+                    record['sweep'] = sweep.name
+                    record['time'] = round(time.time(), 3)
+                    self._write(record)
+        except Exception as e:
+            logger.error(f"Sweep {sweep.name} failed: {str(e)}")
+        finally:
+            elapsed = time.monotonic() - started
+            logger.info(f"Sweep {sweep.name}: {boxes} boxes, {failures} failed in {elapsed:.1f}s")
+            with self._lock:
+                sweep.runs += 1
+                sweep.running = False
+                if elapsed > sweep.interval:
+                    logger.warning(f"Sweep {sweep.name} took {elapsed:.1f}s, longer than its "
+                                   f"{sweep.interval:g}s interval")
+                if sweep.pending and not self.stop_event.is_set():
+                    # One catch-up run for however many slots were missed
+                    sweep.pending = False
+                    self._start(sweep)
+
+    def _live_runner(self) -> Any:
+        """The runner for a sweep, reconnecting first if its proxy connection dropped.
+
+        A failed reconnect fails this sweep; the next one tries again.
+        """
+        with self._connect_lock:
+            if self.connect is None or getattr(self.runner, 'connected', True):
+                return self.runner
+            logger.warning("Proxy connection lost, reconnecting")
+            stale = (self.runner, self.ssh_client)
+            self.runner, self.ssh_client = self.connect()
+            logger.info("Reconnected to the proxy")
+        # Sweeps still running on the lost connection fail on their own
+        self._close(*stale)
+        return self.runner
+
+    @staticmethod
+    def _close(runner: Any, ssh_client: Any):
+        try:
+            runner.close()
+            if ssh_client is not None:
+                ssh_client.disconnect()
+        except Exception as e:
+            logger.error(f"Error closing proxy connection: {str(e)}")
+
+    def _throttle(self):
+        if not self.bucket.acquire(self.stop_event):
+            raise InterruptedError("Scheduler is stopping")
+
+    def _write(self, record: Dict[str, Any]):
+        with self._out_lock:
+            self.out.write(json.dumps(record) + "\n")
+            self.out.flush()
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Run periodic fleet sweeps and stream JSON lines.")
+    parser.add_argument('sweeps', help="JSON file declaring the sweeps")
+    parser.add_argument('-o', '--output', help="append results to FILE (default: stdout)")
+    parser.add_argument('--session-rate', type=float, default=CONFIG['SCHEDULER_SESSION_RATE'],
+                        help="box sessions started per second across all sweeps (default: %(default)s)")
+    add_connection_arguments(parser)
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="log progress to stderr (-vv for debug)")
+    return parser
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=[logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbose, 2)],
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        stream=sys.stderr
+    )
+    if args.verbose < 2:
+        logging.getLogger('paramiko').setLevel(logging.WARNING)
+        logging.getLogger('asyncssh').setLevel(logging.WARNING)
+
+    if args.session_rate <= 0:
+        parser.error("--session-rate must be positive")
+
+    try:
+        sweeps = load_sweeps(args.sweeps)
+    except (OSError, ValueError, KeyError) as e:
+        parser.error(f"invalid sweeps file: {str(e)}")
+    if not sweeps:
+        parser.error("no sweeps declared")
+
+    try:
+        # Monitoring wants fresh readings, never cached ones
+        runner, ssh_client = connect_runner(args, use_cache=False)
+    except Exception as e:
+        logger.error(f"Could not connect to proxy {' '.join(args.proxy) or args.host}: {str(e)}")
+        return 2
+
+    out = open(args.output, 'a') if args.output else sys.stdout
+    scheduler = Scheduler(runner, sweeps, out, session_rate=args.session_rate,
+                          connect=lambda: connect_runner(args, use_cache=False), ssh_client=ssh_client)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: scheduler.stop())
+    try:
+        scheduler.run_forever()
+    finally:
+        scheduler.close()
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
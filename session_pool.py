@@ -0,0 +1,111 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class SessionPool:
+    """LRU pool of authenticated client sessions keyed by client IP.
+
+    Sessions are checked out exclusively: ``acquire`` removes a session from
+    the pool and ``release`` puts it back, so a session is never shared
+    between two running command sequences. Pooled sessions must provide
+    ``alive`` and ``close()``.
+    """
+    def __init__(self, max_size: int, idle_ttl: float,
+                 probe: Optional[Callable[[Any], bool]] = None):
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.probe = probe
+        self._sessions: "OrderedDict[str, Tuple[Any, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._sessions)
+
+    def acquire(self, client_ip: str) -> Optional[Any]:
+        """Check out a healthy idle session for client_ip, or return None."""
+        with self._lock:
+            entry = self._sessions.pop(client_ip, None)
+            if entry is None:
+                self.misses += 1
+                return None
+
+        session, last_used = entry
+        if time.monotonic() - last_used > self.idle_ttl:
+            logger.debug(f"Pooled session to {client_ip} expired")
+            self._close(session)
+            session = None
+        elif not session.alive or (self.probe and not self._probe(session)):
+            logger.info(f"Pooled session to {client_ip} failed health probe")
+            self._close(session)
+            session = None
+
+        with self._lock:
+            if session is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return session
+
+    def release(self, client_ip: str, session: Any):
+        """Return a session to the pool, evicting the least recently used if full."""
+        if not session.alive:
+            self._close(session)
+            return
+
+        stale: List[Any] = []
+        with self._lock:
+            previous = self._sessions.pop(client_ip, None)
+            if previous is not None:
+                # A concurrent run opened a second session to the same box
+                stale.append(previous[0])
+            self._sessions[client_ip] = (session, time.monotonic())
+            stale.extend(self._expire_locked())
+            while len(self._sessions) > self.max_size:
+                _, (evicted, _) = self._sessions.popitem(last=False)
+                self.evictions += 1
+                stale.append(evicted)
+
+        for old in stale:
+            self._close(old)
+
+    def prune(self):
+        """Close sessions that have been idle longer than the TTL."""
+        with self._lock:
+            stale = self._expire_locked()
+        for session in stale:
+            self._close(session)
+
+    def close_all(self):
+        """Close every pooled session."""
+        with self._lock:
+            sessions = [session for session, _ in self._sessions.values()]
+            self._sessions.clear()
+        for session in sessions:
+            self._close(session)
+
+    def _expire_locked(self) -> List[Any]:
+        now = time.monotonic()
+        expired = [ip for ip, (_, last_used) in self._sessions.items() if now - last_used > self.idle_ttl]
+        return [self._sessions.pop(ip)[0] for ip in expired]
+
+    def _probe(self, session: Any) -> bool:
+        try:
+            return self.probe(session)
+        except Exception as e:
+            logger.debug(f"Session probe raised: {str(e)}")
+            return False
+
+    @staticmethod
+    def _close(session: Any):
+        try:
+            session.close()
+        except Exception as e:
+            logger.debug(f"Error closing pooled session: {str(e)}")
@@ -0,0 +1,480 @@
+"""In-process stand-in for the SSH proxy and the STBs behind it.
+
+The simulator runs a paramiko server on localhost that behaves like the
+production proxy closely enough to drive ``SSHClient`` and ``CommandRunner``
+without real hardware: it accepts any public key, runs ``logclient <ip>``
+as a streaming exec command, forwards ``direct-tcpip`` channels to simulated
+STB sshd instances and offers an interactive shell with a nested
+``ssh root@<ip>`` for the legacy hop mode.
+"""
+import logging
+import os
+import random
+import re
+import shlex
+import socket
+import tempfile
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import paramiko
+
+logger = logging.getLogger(__name__)
+
+STB_PROMPT = "root@stb:~# "
+PROXY_PROMPT = "proxy$ "
+LOG_LEVELS = ("DEBUG", "INFO", "INFO", "INFO", "WARNING", "ERROR")
+
+
+class SimulatorConfig:
+    """Tunable behaviour of the simulated proxy and STBs."""
+    def __init__(self, latency: float = 0.0, connect_latency: float = 0.0,
+                 round_trip: float = 0.0, output_lines: int = 4, log_interval: float = 0.05,
+                 log_line_size: int = 80, password: str = "kreatv",
+                 host_key_prompt: bool = False,
+                 unreachable: Optional[Iterable[str]] = None,
+                 reboot_downtime: float = 0.0):
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.round_trip = round_trip
+        self.output_lines = output_lines
+        self.log_interval = log_interval
+        self.log_line_size = log_line_size
+        self.password = password
+        self.host_key_prompt = host_key_prompt
+        self.unreachable: Set[str] = set(unreachable or ())
+        # With a downtime, ``reboot`` makes the box unreachable for that many seconds
+        self.reboot_downtime = reboot_downtime
+
+
+class StbShell:
+    """Tiny command interpreter emulating the STB userland."""
+    def __init__(self, client_ip: str, config: SimulatorConfig):
+        self.client_ip = client_ip
+        self.config = config
+        self.status = 0
+        self.standby = "true"
+
+    def run(self, line: str, stderr: Optional[List[str]] = None) -> str:
+        """Run a ``;``-separated command line and return its output.
+
+        Output of commands ending in ``>&2`` is appended to ``stderr`` when
+        given, and kept inline otherwise (as on a terminal).
+        """
+        output = []
+        for part in re.split(r";|\n", line):
+            part = part.strip()
+            if part.endswith(">&2"):
+                part = part[:-3].strip()
+                if part and stderr is not None:
+                    stderr.append(self._run_one(part))
+                    continue
+            if part:
+                output.append(self._run_one(part))
+        return "".join(output)
+
+    def _run_one(self, command: str) -> str:
+        try:
+            argv = shlex.split(command)
+        except ValueError:
+            argv = command.split()
+        name, args = argv[0], argv[1:]
+        # Shell builtins cost nothing; everything else takes ``latency``
+        if self.config.latency and name not in ("echo", "true", "false"):
+            time.sleep(self.config.latency)
+
+        if name == "echo":
+            self.status, text = 0, " ".join(args).replace("$?", str(self.status))
+            return text + "\n"
+        if name == "true":
+            self.status = 0
+            return ""
+        if name == "false":
+            self.status = 1
+            return ""
+        if name == "sleep":
+            time.sleep(float(args[0]) if args else 0)
+            self.status = 0
+            return ""
+        if name == "ping":
+            self.status = 0
+            return self._ping(args[-1] if args else self.client_ip)
+        if name == "toish":
+            return self._toish(args)
+        if name == "reboot":
+            self.status = 0
+            if self.config.reboot_downtime:
+                self._go_down(self.config.reboot_downtime)
+            return "The system is going down for reboot NOW!\n"
+        if name == "cat":
+            self.status = 0
+            return "".join(f"{path}: line {i}\n" for path in args for i in range(self.config.output_lines))
+        self.status = 127
+        return f"sh: {name}: not found\n"
+
+    def _ping(self, target: str) -> str:
+        rtts = [random.uniform(0.3, 2.5) for _ in range(4)]
+        lines = [f"PING {target} ({target}): 56 data bytes"]
+        lines += [f"64 bytes from {target}: seq={i} ttl=64 time={rtt:.3f} ms" for i, rtt in enumerate(rtts)]
+        avg = sum(rtts) / len(rtts)
+        mdev = (sum((r - avg) ** 2 for r in rtts) / len(rtts)) ** 0.5
+        lines += [
+            "",
+            f"--- {target} ping statistics ---",
+            "4 packets transmitted, 4 packets received, 0% packet loss",
+            f"round-trip min/avg/max/mdev = {min(rtts):.3f}/{avg:.3f}/{max(rtts):.3f}/{mdev:.3f} ms",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def _go_down(self, seconds: float):
+        """Refuse new connections to this box for a while, as during a reboot."""
+        unreachable = self.config.unreachable
+        unreachable.add(self.client_ip)
+        timer = threading.Timer(seconds, unreachable.discard, args=(self.client_ip,))
+        timer.daemon = True
+        timer.start()
+
+    def _toish(self, args) -> str:
+        self.status = 0
+        if args[:2] == ["is", "getobject"]:
+            return f"{args[2] if len(args) > 2 else ''} = {self.standby}\n"
+        if args[:2] == ["ps", "setstandby"]:
+            self.standby = args[2] if len(args) > 2 else "false"
+            return "OK\n"
+        if args[:2] == ["ms", "playuri"]:
+            uri = args[2] if len(args) > 2 else ""
+            return (f"Playing {uri}\n"
+                    f"state=PLAYING time_to_first_frame={random.randint(300, 900)}ms\n")
+        return "\n".join(f"toish {' '.join(args)} [{i}]" for i in range(self.config.output_lines)) + "\n"
+
+
+def _finish_channel(channel: paramiko.Channel):
+    """Send EOF and close the channel once the client has had time to see the request reply."""
+    try:
+        channel.shutdown_write()
+    except Exception:
+        pass
+    # Closing straight away can overtake paramiko's reply to the exec
+    # request, which the client reports as "Channel closed"
+    threading.Timer(0.5, channel.close).start()
+
+
+class _StbServer(paramiko.ServerInterface):
+    """Server side of a simulated STB sshd reached through the proxy."""
+    def __init__(self, client_ip: str, config: SimulatorConfig):
+        self.client_ip = client_ip
+        self.config = config
+        self.shell = StbShell(client_ip, config)
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        if password == self.config.password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self._exec, args=(channel, command.decode()), daemon=True).start()
+        return True
+
+    def check_channel_subsystem_request(self, channel, name):
+        return False
+
+    def _exec(self, channel: paramiko.Channel, command: str):
+        try:
+            if self.config.round_trip:
+                time.sleep(self.config.round_trip)
+            stderr: List[str] = []
+            channel.sendall(self.shell.run(command, stderr).encode())
+            if stderr:
+                channel.sendall_stderr("".join(stderr).encode())
+            channel.send_exit_status(self.shell.status)
+        except Exception as e:
+            logger.debug(f"STB exec failed on {self.client_ip}: {e}")
+        finally:
+            _finish_channel(channel)
+
+
+class _ProxyServer(paramiko.ServerInterface):
+    """Server side of the simulated proxy."""
+    def __init__(self, simulator: "SshSimulator"):
+        self.simulator = simulator
+        self.config = simulator.config
+        self.direct: Dict[int, Tuple[str, int]] = {}
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        if destination[0] in self.config.unreachable:
+            return paramiko.OPEN_FAILED_CONNECT_FAILED
+        self.direct[chanid] = destination
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        threading.Thread(target=self._interactive, args=(channel,), daemon=True).start()
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self._exec, args=(channel, command.decode()), daemon=True).start()
+        return True
+
+    def _exec(self, channel: paramiko.Channel, command: str):
+        try:
+            match = re.search(r"logclient (\S+)", command)
+            if match and "kill" not in command:
+                self.simulator.stream_logclient(channel, match.group(1), command)
+                return
+            if "kill" in command:
+                channel.sendall(self.simulator.kill(command).encode())
+            channel.send_exit_status(0)
+        except Exception as e:
+            logger.debug(f"Proxy exec failed: {e}")
+        finally:
+            _finish_channel(channel)
+
+    def _interactive(self, channel: paramiko.Channel):
+        """Emulate a login shell on the proxy with a nested ssh to STBs."""
+        try:
+            channel.sendall(PROXY_PROMPT.encode())
+            lines = _LineReader(channel, self.config.round_trip)
+            proxy_shell = StbShell(self.simulator.host, self.config)
+            while True:
+                line = lines.readline()
+                if line is None or line.strip() == "exit":
+                    break
+                match = re.search(r"ssh .*?(\S+)@(\S+)", line)
+                if match:
+                    self._nested_ssh(channel, lines, match.group(2))
+                elif line.strip():
+                    channel.sendall(proxy_shell.run(line).replace("\n", "\r\n").encode())
+                channel.sendall(PROXY_PROMPT.encode())
+        except Exception as e:
+            logger.debug(f"Proxy shell failed: {e}")
+        finally:
+            channel.close()
+
+    def _nested_ssh(self, channel: paramiko.Channel, lines: "_LineReader", client_ip: str):
+        if self.config.connect_latency:
+            time.sleep(self.config.connect_latency)
+        if client_ip in self.config.unreachable:
+            channel.sendall(f"ssh: connect to host {client_ip} port 22: No route to host\r\n".encode())
+            return
+        if self.config.host_key_prompt:
+            channel.sendall(b"Are you sure you want to continue connecting (yes/no)? ")
+            if (lines.readline() or "").strip() != "yes":
+                channel.sendall(b"Host key verification failed.\r\n")
+                return
+        channel.sendall(f"root@{client_ip}'s password: ".encode())
+        lines.echo = False
+        password = lines.readline()
+        lines.echo = True
+        channel.sendall(b"\r\n")
+        if password is None or password.strip() != self.config.password:
+            channel.sendall(b"Permission denied, please try again.\r\n")
+            return
+
+        shell = StbShell(client_ip, self.config)
+        channel.sendall(STB_PROMPT.encode())
+        while True:
+            line = lines.readline()
+            if line is None:
+                return
+            if line.strip() == "exit":
+                channel.sendall(f"logout\r\nConnection to {client_ip} closed.\r\n".encode())
+                return
+            output = shell.run(line)
+            channel.sendall(output.replace("\n", "\r\n").encode() + STB_PROMPT.encode())
+
+
+class _LineReader:
+    """Line-buffered reader over a PTY channel that echoes input like a tty.
+
+    Each network read is delayed by ``round_trip`` seconds.
+    """
+    def __init__(self, channel: paramiko.Channel, round_trip: float = 0.0):
+        self.channel = channel
+        self.round_trip = round_trip
+        self.buffer = b""
+        self.echo = True
+
+    def readline(self) -> Optional[str]:
+        while b"\n" not in self.buffer and b"\r" not in self.buffer:
+            data = self.channel.recv(4096)
+            if not data:
+                return None
+            if self.round_trip:
+                time.sleep(self.round_trip)
+            if self.echo:
+                self.channel.sendall(data.replace(b"\r", b"").replace(b"\n", b"\r\n"))
+            self.buffer += data
+        line, _, self.buffer = re.split(rb"(\r\n|\r|\n)", self.buffer, maxsplit=1)
+        return line.decode(errors="replace")
+
+
+class SshSimulator:
+    """Localhost SSH server emulating the proxy and the STBs behind it.
+
+    Use as a context manager; ``host``, ``port`` and ``key_path`` can be
+    handed straight to ``SSHClient``.
+    """
+    def __init__(self, config: Optional[SimulatorConfig] = None):
+        self.config = config or SimulatorConfig()
+        self.host = "127.0.0.1"
+        self.port = 0
+        self._host_key = paramiko.RSAKey.generate(2048)
+        self._client_key = paramiko.RSAKey.generate(2048)
+        self._key_dir = tempfile.mkdtemp(prefix="kal-sim-")
+        self.key_path = os.path.join(self._key_dir, "id_rsa")
+        self._client_key.write_private_key_file(self.key_path)
+        self._socket: Optional[socket.socket] = None
+        self._transports = []
+        self._logclients: Dict[int, Tuple[str, threading.Event]] = {}
+        self._next_pid = 40000
+        self._lock = threading.Lock()
+        self._running = threading.Event()
+
+    def __enter__(self) -> "SshSimulator":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def start(self):
+        """Start listening on an ephemeral localhost port."""
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self.host, 0))
+        self._socket.listen(128)
+        self.port = self._socket.getsockname()[1]
+        self._running.set()
+        threading.Thread(target=self._accept_loop, name="sim-accept", daemon=True).start()
+
+    def stop(self):
+        """Stop the listener and close every simulated connection."""
+        self._running.clear()
+        if self._socket:
+            self._socket.close()
+        for transport in list(self._transports):
+            transport.close()
+        for _, stop in list(self._logclients.values()):
+            stop.set()
+        for name in os.listdir(self._key_dir):
+            os.unlink(os.path.join(self._key_dir, name))
+        os.rmdir(self._key_dir)
+
+    @property
+    def running_logclients(self) -> Dict[int, str]:
+        """Map of simulated logclient PIDs to the client IP they follow."""
+        with self._lock:
+            return {pid: ip for pid, (ip, _) in self._logclients.items()}
+
+    def _accept_loop(self):
+        while self._running.is_set():
+            try:
+                sock, _ = self._socket.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve_proxy, args=(sock,), daemon=True).start()
+
+    def _serve_proxy(self, sock: socket.socket):
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(self._host_key)
+        server = _ProxyServer(self)
+        transport.start_server(server=server)
+        self._transports.append(transport)
+        self._hold_channels(transport, server)
+
+    def _hold_channels(self, transport: paramiko.Transport, server: paramiko.ServerInterface):
+        # paramiko closes channels that are garbage collected, so keep a
+        # reference to every accepted channel until it is closed
+        channels = []
+        while transport.is_active():
+            channel = transport.accept(1)
+            channels = [chan for chan in channels if not chan.closed]
+            if channel is None:
+                continue
+            channels.append(channel)
+            destination = getattr(server, "direct", {}).pop(channel.get_id(), None)
+            if destination:
+                threading.Thread(target=self._serve_stb, args=(channel, destination[0]), daemon=True).start()
+
+    def _serve_stb(self, channel: paramiko.Channel, client_ip: str):
+        if self.config.connect_latency:
+            time.sleep(self.config.connect_latency)
+        transport = paramiko.Transport(channel)
+        transport.add_server_key(self._host_key)
+        server = _StbServer(client_ip, self.config)
+        try:
+            transport.start_server(server=server)
+        except (paramiko.SSHException, EOFError) as e:
+            # Reachability probes hang up after reading the banner
+            logger.debug(f"STB {client_ip}: handshake abandoned: {str(e)}")
+            return
+        self._transports.append(transport)
+        self._hold_channels(transport, server)
+
+    def stream_logclient(self, channel: paramiko.Channel, client_ip: str, command: str):
+        """Emit synthetic log lines until interrupted, killed or closed."""
+        stop = threading.Event()
+        with self._lock:
+            self._next_pid += 1
+            pid = self._next_pid
+            self._logclients[pid] = (client_ip, stop)
+        if "echo $$" in command:
+            channel.sendall(f"{pid}\r\n".encode())
+        channel.settimeout(0.0)
+        seq = 0
+        try:
+            while not stop.is_set() and not channel.closed:
+                try:
+                    if b"\x03" in channel.recv(1024):
+                        channel.sendall(b"^C\r\n")
+                        break
+                except socket.timeout:
+                    pass
+                level = LOG_LEVELS[seq % len(LOG_LEVELS)]
+                message = f"{time.strftime('%H:%M:%S')} {client_ip} {level} app[{seq}]: "
+                message += "x" * max(0, self.config.log_line_size - len(message))
+                channel.sendall((message + "\r\n").encode())
+                seq += 1
+                stop.wait(self.config.log_interval)
+        except Exception as e:
+            logger.debug(f"Logclient stream for {client_ip} ended: {e}")
+        finally:
+            with self._lock:
+                self._logclients.pop(pid, None)
+            try:
+                channel.send_exit_status(130)
+            except Exception:
+                pass
+            channel.close()
+
+    def kill(self, command: str) -> str:
+        """Emulate the kill commands used to stop logclient processes."""
+        pids = {int(pid) for pid in re.findall(r"\b(\d{3,})\b", command)}
+        match = re.search(r"logclient (\d{1,3}(?:\.\d{1,3}){3})", command)
+        with self._lock:
+            for pid, (ip, stop) in list(self._logclients.items()):
+                if pid in pids or (match and ip == match.group(1)):
+                    stop.set()
+        return ""
@@ -1,16 +1,39 @@
 import paramiko
 import socket
 import re
+import select
+import contextvars
 import logging
-from typing import List, Tuple, Optional
+import threading
+import uuid
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List, Match, Pattern, Tuple, Optional
 import time
+from config import CONFIG
+from cache import ResultCache
+from history import RunHistory
+from logstream import LogclientStream
+from metrics import METRICS
+from plans import Plan, Stage
+from recvbuf import CHUNK_SIZE, BufferMatch, Output, ReceiveBuffer
+from resilience import retry
+from rolling import RebootResult, RollingReboot
+from runner_core import (AUTH_PROMPT_PATTERN, CommandResult, CommandTimeoutError, FleetResult,
+                         NestedLogin, PlanProgress, RunnerBase, SequenceRun, batch_end_pattern, batch_script,
+                         bytes_pattern, combined_output, command_end_pattern, command_script, kill_command,
+                         logclient_command, output_buffer, ready_script, run_fleet_members, split_command,
+                         split_exec_batch, split_shell_batch)
+from session_pool import SessionPool
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 class SSHClient:
-    def __init__(self, host: str, username: str, key_path: str, passphrase: Optional[str] = None):
+    def __init__(self, host: str, username: str, key_path: str, passphrase: Optional[str] = None,
+                 port: int = 22):
         self.host = host
+        self.port = port
         self.username = username
         self.key_path = key_path
         self.passphrase = passphrase
@@ -19,23 +42,32 @@ class SSHClient:
 
     def connect(self) -> bool:
         """Establish SSH connection to the server."""
-        try:
-            self.client = paramiko.SSHClient()
-            self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        with METRICS.span('proxy_connect', host=self.host):
+            try:
+                self.client = paramiko.SSHClient()
+                self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                timeout = CONFIG['CONNECTION_TIMEOUT']
             
-            if self.passphrase:
-                key = paramiko.RSAKey.from_private_key_file(self.key_path, password=self.passphrase)
-                self.client.connect(self.host, username=self.username, pkey=key, timeout=10)
-            else:
-                self.client.connect(self.host, username=self.username, key_filename=self.key_path, timeout=10)
+                if self.passphrase:
+                    key = paramiko.RSAKey.from_private_key_file(self.key_path, password=self.passphrase)
+                    credentials = {'pkey': key}
+                else:
+                    credentials = {'key_filename': self.key_path}
+                retry(
+                    lambda: self.client.connect(self.host, port=self.port, username=self.username,
+                                                timeout=timeout, banner_timeout=timeout,
+                                                auth_timeout=timeout, **credentials),
+                    CONFIG['RETRY_ATTEMPTS'], CONFIG['RETRY_BASE_DELAY'], CONFIG['RETRY_MAX_DELAY'],
+                    description=f"Connecting to {self.host}"
+                )
             
-            self.connected = True
-            logger.info(f"Successfully connected to {self.host}")
-            return True
-        except Exception as e:
-            logger.error(f"Failed to connect to {self.host}: {str(e)}")
-            self.connected = False
-            raise
+                self.connected = True
+                logger.info(f"Successfully connected to {self.host}")
+                return True
+            except Exception as e:
+                logger.error(f"Failed to connect to {self.host}: {str(e)}")
+                self.connected = False
+                raise
 
     def disconnect(self):
         """Close SSH connection."""
@@ -57,7 +89,9 @@ class SSHClient:
             raise ConnectionError("Not connected to SSH server")
         
         try:
-            stdin, stdout, stderr = self.client.exec_command(command, get_pty=get_pty, timeout=30)
+            stdin, stdout, stderr = self.client.exec_command(
+                command, get_pty=get_pty, timeout=CONFIG['COMMAND_TIMEOUT']
+            )
             output = stdout.read().decode()
             error = stderr.read().decode()
             return output, error
@@ -65,147 +99,597 @@ class SSHClient:
             logger.error(f"Failed to execute command '{command}': {str(e)}")
             raise
 
-class CommandRunner:
-    def __init__(self, ssh_client: SSHClient):
-        self.ssh_client = ssh_client
+class ClientSession:
+    """Authenticated session to a single client (STB).
 
-    def run_command_sequence(self, client_ip: str, commands: List[str]) -> Tuple[List[str], str]:
-        """Run a sequence of commands on the client through the proxy."""
-        if not self.ssh_client.validate_ip(client_ip):
-            raise ValueError(f"Invalid IP address: {client_ip}")
+    In direct mode ``client_ssh`` is an SSH connection to the client itself,
+    tunnelled over a direct-tcpip channel on the proxy transport. In shell
+    mode ``client_ssh`` is a separate proxy connection and ``shell`` is the
+    interactive channel the nested ``ssh`` runs in.
+    """
+    def __init__(self, client_ip: str, client_ssh: paramiko.SSHClient,
+                 shell: Optional[paramiko.Channel] = None):
+        self.client_ip = client_ip
+        self.client_ssh = client_ssh
+        self.shell = shell
+        self.alive = True
+        self.last_result: Optional[CommandResult] = None
 
-        # Start logclient
-        logclient_channel = self._start_logclient(client_ip)
+    @property
+    def interactive(self) -> bool:
+        """Whether commands are typed into a nested ssh shell on the proxy."""
+        return self.shell is not None
+
+    def close(self):
+        """Close the session and its underlying transport."""
+        self.alive = False
+        self.client_ssh.close()
+
+class CommandRunner(RunnerBase):
+    def __init__(self, ssh_client: SSHClient, hop_mode: Optional[str] = None,
+                 session_pool: Optional[SessionPool] = None,
+                 result_cache: Optional[ResultCache] = None,
+                 history: Optional[RunHistory] = None):
+        super().__init__(ssh_client, hop_mode, result_cache, history)
+        if session_pool is None and CONFIG['SESSION_POOL_SIZE'] > 0:
+            session_pool = SessionPool(
+                CONFIG['SESSION_POOL_SIZE'],
+                CONFIG['SESSION_IDLE_TTL'],
+                probe=self._probe_session
+            )
+        self.session_pool = session_pool
+        if ssh_client.connected:
+            self.reap_orphaned_logclients()
+
+    @property
+    def connected(self) -> bool:
+        """Whether the proxy connection the runner uses is still open."""
+        transport = self.ssh_client.client.get_transport() if self.ssh_client.client else None
+        return transport is not None and transport.is_active()
+
+    def close(self):
+        """Close any pooled client sessions and kill logclients still running."""
+        if self.session_pool is not None:
+            self.session_pool.close_all()
+        self.kill_tracked_logclients()
+
+    def run_fleet(self, client_ips: Iterable[str], commands: List[str],
+                  max_workers: Optional[int] = None,
+                  timeout: Optional[float] = None,
+                  command_key: Optional[str] = None,
+                  throttle: Optional[Callable[[], None]] = None) -> Iterator[FleetResult]:
+        """Run the same command sequence on many clients concurrently.
+
+        Results are yielded as soon as each client finishes, so the order
+        follows completion rather than ``client_ips``. A failing client
+        produces a result with ``error`` set instead of aborting the sweep.
+        ``command_key`` is passed on to ``run_command_sequence``. ``throttle``
+        is called before each client is started and may block (rate limiting);
+        if it raises, that client is not run and its result has ``skipped`` set.
+        """
+        if not self.ssh_client.connected or not self.ssh_client.client:
+            raise ConnectionError("Not connected to SSH server")
+
+        # Drop duplicate IPs but keep the caller's ordering for submission
+        ips = list(dict.fromkeys(client_ips))
+        workers = max(1, min(max_workers or CONFIG['FLEET_MAX_WORKERS'], len(ips) or 1))
+        logger.info(f"Running fleet sweep on {len(ips)} clients with {workers} workers")
 
-        # Connect to client and run commands
-        outputs = []
         try:
-            shell, client_ssh = self._connect_to_client(client_ip)
-            
-            for cmd in commands:
-                output = self._run_client_command(shell, cmd)
-                outputs.append(output)
+            yield from run_fleet_members(
+                ips, lambda ip: self.run_command_sequence(ip, commands, timeout, command_key=command_key),
+                workers, throttle
+            )
+        finally:
+            # One exec cleans up any logclient that ignored its Ctrl-C
+            self.kill_tracked_logclients()
+
+    def rolling_reboot(self, client_ips: Iterable[str], command_key: str = 'reboot',
+                       wave_size: Optional[int] = None, max_outage: Optional[float] = None,
+                       stop_event: Optional[threading.Event] = None) -> Iterator[RebootResult]:
+        """Reboot the clients in waves, at most ``max_outage`` percent offline at once (see RollingReboot)."""
+        return RollingReboot(self, command_key, wave_size=wave_size, max_outage=max_outage,
+                             stop_event=stop_event).run(client_ips)
+
+    def probe_reachable(self, client_ip: str, timeout: float) -> bool:
+        """Whether the client's sshd answers through the proxy.
+
+        In direct mode this only reads the SSH banner over a direct-tcpip
+        channel; in shell mode it takes a full nested login.
+        """
+        if self.hop_mode == 'shell':
+            try:
+                session = self._connect_via_shell(client_ip, timeout)
+            except Exception:
+                return False
+            self._finish_client_session(session)
+            return True
 
-            self._finish_client_session(shell, client_ssh)
+        transport = self.ssh_client.client.get_transport() if self.ssh_client.client else None
+        if transport is None or not transport.is_active():
+            raise ConnectionError("Not connected to SSH server")
+        try:
+            channel = transport.open_channel(
+                "direct-tcpip", (client_ip, CONFIG['CLIENT_PORT']), ("127.0.0.1", 0), timeout=timeout
+            )
+        except Exception as e:
+            logger.debug(f"Probe of {client_ip} failed: {str(e)}")
+            return False
+        try:
+            channel.settimeout(timeout)
+            return channel.recv(64).startswith(b"SSH-")
+        except Exception as e:
+            logger.debug(f"Probe of {client_ip} failed: {str(e)}")
+            return False
+        finally:
+            channel.close()
+
+    def run_command_sequence(self, client_ip: str, commands: List[str],
+                             timeout: Optional[float] = None,
+                             on_log_line: Optional[Callable[[str], None]] = None,
+                             on_output: Optional[Callable[[int, str], None]] = None,
+                             cancel_event: Optional[threading.Event] = None,
+                             batch: Optional[bool] = None,
+                             command_key: Optional[str] = None) -> Tuple[List[str], str]:
+        """Run a sequence of commands on the client through the proxy.
+
+        Each command gets ``timeout`` seconds (default CONFIG['COMMAND_TIMEOUT'])
+        to complete. ``on_log_line`` is called from a background thread with
+        each logclient line as it arrives and ``on_output`` with the index and
+        output of each command as it finishes. Setting ``cancel_event`` stops
+        the sequence before the next command with CancelledError.
+
+        With ``batch`` (default CONFIG['BATCH_COMMANDS']) a multi-command
+        sequence is sent to the client in a single write and split back into
+        per-command outputs; it can then only be cancelled before it starts.
+
+        ``command_key`` names the AVAILABLE_COMMANDS entry being run. Entries
+        declaring ``steps`` run as a plan (see plans.Plan) instead of
+        ``commands``: conditional steps whose condition fails are skipped
+        and have an empty output. ``{ip}`` and the entry's params are
+        substituted into the commands either way. Entries marked
+        ``cacheable`` are answered from the result cache while fresh, and
+        entries marked ``mutating`` invalidate the box's cached results.
+
+        A box (or proxy) that keeps failing is skipped with CircuitOpenError
+        until its breaker's cooldown has passed. Runs that reach the box,
+        successful or not, are recorded in the run history.
+        """
+        sequence = SequenceRun(self, client_ip, commands, command_key, batch)
+        with METRICS.context(client_ip=client_ip):
+            cached = sequence.cached(on_output)
+            if cached is not None:
+                return cached
+            with sequence.attempt(), METRICS.span('sequence'):
+                outputs, logclient_output = self._run_sequence(
+                    client_ip, sequence.plan, timeout, on_log_line, on_output, cancel_event, sequence.batch
+                )
+            return sequence.finished(outputs, logclient_output)
+
+    def _run_sequence(self, client_ip: str, plan: Plan, timeout: Optional[float],
+                      on_log_line: Optional[Callable[[str], None]],
+                      on_output: Optional[Callable[[int, str], None]],
+                      cancel_event: Optional[threading.Event],
+                      batch: bool) -> Tuple[List[str], str]:
+        # Start logclient
+        with self._breaker_guard(self.proxy_breaker, self.ssh_client.host):
+            logclient_stream = self._start_logclient(client_ip)
+        if on_log_line:
+            logclient_stream.subscribe(on_log_line, replay=True)
+
+        # Connect to client and run the plan, one stage (round trip) at a time
+        progress = PlanProgress(plan, client_ip, batch, on_output, cancel_event)
+        try:
+            with self._breaker_guard(self.client_breaker, client_ip):
+                session = self._checkout_session(client_ip)
+                completed = False
+                try:
+                    for stage in progress.stages():
+                        progress.record(stage, self._run_stage(session, stage, timeout))
+                    completed = True
+                finally:
+                    self._checkin_session(session, reusable=completed)
         except Exception as e:
             logger.error(f"Error during command execution: {str(e)}")
+            self._get_logclient_output(logclient_stream)
             raise
-        
-        self.kill_logclient_for_ip(client_ip)
 
-        # Get logclient output
-        logclient_output = self._get_logclient_output(logclient_channel)
+        # Stop logclient and get its output
+        logclient_output = self._get_logclient_output(logclient_stream)
         
-        return outputs, logclient_output
+        return progress.outputs(), logclient_output
+
+    def _run_stage(self, session: ClientSession, stage: Stage, timeout: Optional[float]) -> List[Output]:
+        """Run a plan stage's steps in one round trip; returns an output per step that ran.
+
+        The concurrent steps of a group get an exec channel each in direct
+        mode; in shell mode there is only the one shell, so they are batched.
+        """
+        commands = [step.command for step in stage.steps]
+        if len(commands) == 1:
+            return [self._run_client_command(session, commands[0], timeout)]
+        if stage.concurrent and not session.interactive:
+            workers = min(len(commands), CONFIG['PLAN_GROUP_MAX_CHANNELS'])
+            with METRICS.span('group', commands=len(commands)), \
+                    ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"group-{session.client_ip}") as executor:
+                futures = [
+                    executor.submit(contextvars.copy_context().run, self._run_client_command, session, command, timeout)
+                    for command in commands
+                ]
+                return [future.result() for future in futures]
+        return [combined_output(result) for result in self._run_client_batch(session, commands, timeout)]
 
-    def _start_logclient(self, client_ip: str):
-        """Start logclient for the given client IP."""
-        cmd = f"logclient {client_ip}"
-        _, stdout, _ = self.ssh_client.client.exec_command(cmd, get_pty=True)
-        return stdout
+    def _start_logclient(self, client_ip: str) -> LogclientStream:
+        """Start logclient for the given client IP and stream its output in the background.
 
-    def _connect_to_client(self, client_ip: str) -> Tuple[paramiko.Channel, paramiko.SSHClient]:
-        """Establish connection to the client through proxy."""
+        The shell prints its PID before exec'ing logclient, so the PID is
+        logclient's own and can be signalled directly later.
+        """
+        cmd = logclient_command(client_ip)
+        def open_logclient() -> paramiko.Channel:
+            # Use a bare channel: exec_command's stdin file sends EOF when it is
+            # garbage collected, after which the Ctrl-C never reaches logclient
+            channel = self.ssh_client.client.get_transport().open_session(timeout=CONFIG['CONNECTION_TIMEOUT'])
+            channel.get_pty()
+            channel.exec_command(cmd)
+            return channel
+
+        with METRICS.span('logclient_start'):
+            channel = retry(open_logclient, CONFIG['RETRY_ATTEMPTS'], CONFIG['RETRY_BASE_DELAY'],
+                            CONFIG['RETRY_MAX_DELAY'], description=f"Starting logclient for {client_ip}")
+        return self._logclient_stream(LogclientStream, channel, client_ip)
+
+    @contextmanager
+    def client_session(self, client_ip: str) -> Iterator[ClientSession]:
+        """Lease a session to the client for work other than command sequences (e.g. file transfers).
+
+        The session goes back to the pool unless the block raised.
+        """
+        if not self.ssh_client.validate_ip(client_ip):
+            raise ValueError(f"Invalid IP address: {client_ip}")
+        self.proxy_breaker.check(self.ssh_client.host)
+        self.client_breaker.check(client_ip)
+        session = self._checkout_session(client_ip)
+        completed = False
+        try:
+            yield session
+            completed = True
+        finally:
+            self._checkin_session(session, reusable=completed)
+
+    def _checkout_session(self, client_ip: str) -> ClientSession:
+        """Reuse a pooled session to the client or open a new one."""
+        if self.session_pool is not None:
+            session = self.session_pool.acquire(client_ip)
+            if session is not None:
+                logger.debug(f"Reusing pooled session to {client_ip}")
+                return session
+        return self._connect_to_client(client_ip)
+
+    def _checkin_session(self, session: ClientSession, reusable: bool):
+        """Return a session to the pool, or close it if it cannot be reused."""
+        if self.session_pool is not None and reusable and session.alive:
+            self.session_pool.release(session.client_ip, session)
+        else:
+            self._finish_client_session(session)
+
+    def _probe_session(self, session: ClientSession) -> bool:
+        """Check that a pooled session can still carry commands."""
+        if session.interactive:
+            # One round trip through the nested shell
+            self._sync_shell(session.shell, CONFIG['SESSION_PROBE_TIMEOUT'])
+            return True
+        transport = session.client_ssh.get_transport()
+        # The transport runs over a proxy channel that closes with the box
+        return bool(transport and transport.is_active() and not transport.sock.closed)
+
+    def _connect_to_client(self, client_ip: str) -> ClientSession:
+        """Establish connection to the client through proxy, retrying transient failures."""
+        if self.hop_mode == 'direct':
+            connect = self._connect_direct
+        elif self.hop_mode == 'shell':
+            connect = self._connect_via_shell
+        else:
+            raise ValueError(f"Unknown client hop mode: {self.hop_mode}")
+
+        timeout = self.latency.timeout((client_ip, 'connect'), CONFIG['CONNECTION_TIMEOUT'])
+        with METRICS.span('client_connect', hop_mode=self.hop_mode):
+            started = time.monotonic()
+            session = retry(
+                lambda: connect(client_ip, timeout),
+                CONFIG['RETRY_ATTEMPTS'], CONFIG['RETRY_BASE_DELAY'], CONFIG['RETRY_MAX_DELAY'],
+                description=f"Connecting to client {client_ip}"
+            )
+            self.latency.observe((client_ip, 'connect'), time.monotonic() - started)
+            return session
+
+    def _connect_direct(self, client_ip: str, timeout: float) -> ClientSession:
+        """Open an SSH session to the client over a direct-tcpip channel on the proxy transport."""
+        transport = self.ssh_client.client.get_transport() if self.ssh_client.client else None
+        if transport is None or not transport.is_active():
+            raise ConnectionError("Not connected to SSH server")
+
+        try:
+            channel = transport.open_channel(
+                "direct-tcpip",
+                (client_ip, CONFIG['CLIENT_PORT']),
+                ("127.0.0.1", 0),
+                timeout=timeout
+            )
+
+            client_ssh = paramiko.SSHClient()
+            client_ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            client_ssh.connect(
+                client_ip,
+                port=CONFIG['CLIENT_PORT'],
+                username=CONFIG['CLIENT_USER'],
+                password=CONFIG['CLIENT_PASSWORD'],
+                sock=channel,
+                timeout=timeout,
+                banner_timeout=timeout,
+                auth_timeout=timeout,
+                look_for_keys=False,
+                allow_agent=False
+            )
+            return ClientSession(client_ip, client_ssh)
+        except Exception as e:
+            logger.error(f"Failed to connect to client {client_ip}: {str(e)}")
+            raise
+
+    def _connect_via_shell(self, client_ip: str, timeout: float) -> ClientSession:
+        """Establish connection to the client with a nested interactive ssh on the proxy."""
         client_ssh = paramiko.SSHClient()
         client_ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         
         try:
             client_ssh.connect(
                 self.ssh_client.host,
+                port=self.ssh_client.port,
                 username=self.ssh_client.username,
                 key_filename=self.ssh_client.key_path,
-                passphrase=self.ssh_client.passphrase
+                passphrase=self.ssh_client.passphrase,
+                timeout=CONFIG['CONNECTION_TIMEOUT']
             )
             
             shell = client_ssh.invoke_shell()
-            time.sleep(1)
+            self._sync_shell(shell, CONFIG['CONNECTION_TIMEOUT'])
             
             # Connect to client
-            shell.send(f"ssh -o StrictHostKeyChecking=no root@{client_ip}\n")
-            time.sleep(1)
+            shell.send(f"ssh -o StrictHostKeyChecking=no {CONFIG['CLIENT_USER']}@{client_ip}\n")
             
             # Handle authentication
-            self._handle_authentication(shell)
+            self._handle_authentication(shell, timeout)
             
-            return shell, client_ssh
+            return ClientSession(client_ip, client_ssh, shell)
         except Exception as e:
+            client_ssh.close()
             logger.error(f"Failed to connect to client {client_ip}: {str(e)}")
             raise
 
-    def _handle_authentication(self, shell: paramiko.Channel):
-        """Handle SSH authentication prompts."""
-        output = ""
-        timeout = time.time() + 10
+    def _handle_authentication(self, shell: paramiko.Channel, timeout: float):
+        """Answer the nested ssh prompts until the client shell is ready.
+
+        Raises CommandTimeoutError if the client shell is not up within timeout.
+        """
+        with METRICS.span('authenticate'):
+            deadline = time.monotonic() + timeout
+            login = NestedLogin(CONFIG['CLIENT_PASSWORD'], paramiko.AuthenticationException)
+            while not login.done:
+                _, match = self._read_until(shell, AUTH_PROMPT_PATTERN, deadline - time.monotonic())
+                reply = login.answer(match)
+                if reply:
+                    shell.send(reply)
+        
+            # Typed-ahead input reaches the client shell once it is up
+            self._sync_shell(shell, deadline - time.monotonic())
+
+    def _sync_shell(self, shell: paramiko.Channel, timeout: float):
+        """Wait until the shell has processed everything sent so far."""
+        script, pattern = ready_script(uuid.uuid4().hex)
+        shell.send(script)
+        self._read_until(shell, pattern, timeout)
+
+    def _read_until(self, channel: paramiko.Channel, pattern: Optional[Pattern],
+                    timeout: float) -> Tuple[str, Optional[Match]]:
+        """Read from channel until pattern matches, or until EOF if pattern is None.
+
+        Returns everything read so far and the match. Raises CommandTimeoutError
+        with the partial output when the deadline passes first.
+        """
+        buffer = ReceiveBuffer()
+        self._receive_until(channel, buffer, bytes_pattern(pattern) if pattern is not None else None, timeout)
+        output = buffer.text()
+        return output, pattern.search(output) if pattern is not None else None
+
+    def _receive_until(self, channel: paramiko.Channel, buffer: ReceiveBuffer,
+                       pattern: Optional[Pattern], timeout: float) -> Optional[BufferMatch]:
+        """Read from channel into buffer until the bytes pattern matches, or until EOF if it is None.
+
+        Only newly received data is searched after each read. Raises
+        CommandTimeoutError with the partial output when the deadline passes first.
+        """
+        deadline = time.monotonic() + timeout
         
-        while time.time() < timeout:
-            if shell.recv_ready():
-                chunk = shell.recv(1024).decode()
-                output += chunk
-                
-                if "yes/no" in output:
-                    shell.send("yes\n")
-                    time.sleep(1)
-                elif "password:" in output.lower():
-                    shell.send("kreatv\n")
-                    time.sleep(1)
-                    break
+        while True:
+            if pattern is not None:
+                found = buffer.search_new(pattern)
+                if found:
+                    return found
             
-            time.sleep(0.1)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                METRICS.incr('timeouts')
+                raise CommandTimeoutError(f"Timed out after {timeout:.1f}s waiting for output", buffer.text())
+            
+            channel.settimeout(remaining)
+            try:
+                chunk = channel.recv(CHUNK_SIZE)
+            except socket.timeout:
+                continue
+            
+            if METRICS.enabled:
+                METRICS.incr('recv_calls')
+                METRICS.incr('bytes_received', len(chunk))
+            if not chunk:
+                if pattern is None:
+                    return None
+                raise ConnectionError("Channel closed before expected output arrived")
+            buffer.append(chunk)
+
+    def _read_exec_output(self, channel: paramiko.Channel) -> Tuple[ReceiveBuffer, ReceiveBuffer]:
+        """Read an exec channel's stdout and stderr together to EOF into capped buffers.
+
+        Draining one stream to EOF before the other would let a command that
+        writes a lot to the other fill the channel window and stall. Raises
+        socket.timeout when neither stream receives anything for the
+        channel's timeout.
+        """
+        out, err = output_buffer(), output_buffer()
+        timeout = channel.gettimeout()
+        while True:
+            received = False
+            for buffer, ready, recv in ((out, channel.recv_ready, channel.recv),
+                                        (err, channel.recv_stderr_ready, channel.recv_stderr)):
+                if ready():
+                    chunk = recv(CHUNK_SIZE)
+                    if METRICS.enabled:
+                        METRICS.incr('recv_calls')
+                        METRICS.incr('bytes_received', len(chunk))
+                    buffer.append(chunk)
+                    received = True
+            if received:
+                continue
+            if channel.eof_received or channel.closed:
+                return out, err
+            # The channel's pipe is readable while either stream has data or after EOF
+            if not select.select([channel], [], [], timeout)[0]:
+                METRICS.incr('timeouts')
+                raise socket.timeout("Timed out waiting for command output")
 
-    def _run_client_command(self, shell: paramiko.Channel, command: str) -> str:
+    def _run_client_command(self, session: ClientSession, command: str,
+                            timeout: Optional[float] = None) -> Output:
         """Execute command on client and return output."""
-        shell.send(command + "\n")
-        time.sleep(2)
+        if not session.alive:
+            raise ConnectionError(f"Session to {session.client_ip} has been closed")
         
-        output = ""
-        while shell.recv_ready():
-            output += shell.recv(1024).decode()
+        latency_key = (session.client_ip, command)
+        timeout = self.latency.timeout(latency_key, timeout or CONFIG['COMMAND_TIMEOUT'])
+        started = time.monotonic()
+        with METRICS.span('command', command=command):
+            if not session.interactive:
+                result = self._exec_client_command(session, command, timeout)
+                self.latency.observe(latency_key, time.monotonic() - started)
+                return combined_output(result)
+
+            # Bracket the command with sentinels so completion is detected as
+            # soon as it happens, along with the exit status
+            token = uuid.uuid4().hex
+            buffer = output_buffer()
+            session.shell.send(command_script(token, command))
+            end = self._receive_until(session.shell, buffer, command_end_pattern(token), timeout)
+            self.latency.observe(latency_key, time.monotonic() - started)
         
-        return output
+            output, status = split_command(buffer, token, end)
+            if status is None:
+                # The client dropped the connection (e.g. reboot); the shell now
+                # belongs to the proxy, so nothing else may be typed into it
+                session.alive = False
+                status = -1
+            session.last_result = CommandResult(output, "", status)
+            return output
+
+    def _run_client_batch(self, session: ClientSession, commands: List[str],
+                          timeout: Optional[float] = None) -> List[CommandResult]:
+        """Run all commands on the client in one round trip.
+
+        Returns a result per command that started, in order; fewer results
+        than commands means the client went away part-way (e.g. a reboot).
+        The batch gets the sum of the per-command timeouts, or less once
+        this batch's latency on the client is known.
+        """
+        if not session.alive:
+            raise ConnectionError(f"Session to {session.client_ip} has been closed")
+
+        token = uuid.uuid4().hex
+        latency_key = (session.client_ip, tuple(commands))
+        budget = self.latency.timeout(latency_key, (timeout or CONFIG['COMMAND_TIMEOUT']) * len(commands))
+        started = time.monotonic()
+        with METRICS.span('batch', commands=len(commands)):
+            if not session.interactive:
+                _, stdout, _ = session.client_ssh.exec_command(
+                    batch_script(token, commands, stderr_markers=True), timeout=budget
+                )
+                out, err = self._read_exec_output(stdout.channel)
+                results = split_exec_batch(out, err, token)
+            else:
+                buffer = output_buffer()
+                session.shell.send(batch_script(token, commands))
+                end = self._receive_until(session.shell, buffer, batch_end_pattern(token, len(commands)), budget)
+                results, attached = split_shell_batch(buffer, token, end)
+                if not attached:
+                    # As in _run_client_command: the client is gone and the
+                    # shell belongs to the proxy again
+                    session.alive = False
+
+        if len(results) == len(commands):
+            self.latency.observe(latency_key, time.monotonic() - started)
+        if results:
+            session.last_result = results[-1]
+        return results
+
+    def _exec_client_command(self, session: ClientSession, command: str,
+                             timeout: Optional[float] = None) -> CommandResult:
+        """Execute command on a directly connected client with separate streams and exit status."""
+        _, stdout, _ = session.client_ssh.exec_command(
+            command, timeout=timeout or CONFIG['COMMAND_TIMEOUT']
+        )
+        out, err = self._read_exec_output(stdout.channel)
+        result = CommandResult(out.text(), err.text(), stdout.channel.recv_exit_status())
+        session.last_result = result
+        return result
 
-    def _finish_client_session(self, shell: paramiko.Channel, client_ssh: paramiko.SSHClient):
+    def _finish_client_session(self, session: ClientSession):
         """Clean up client session."""
-        shell.send("exit\n")
-        kill_cmd = f"ps -aux | grep 'logclient {client_ip}' | grep -v grep | awk '{{print $2}}' | xargs -r kill -9"
-        stdin, stdout, stderr = self.ssh_proxy.exec_command(kill_cmd)
-        out = stdout.read().decode()
-        err = stderr.read().decode()
-        time.sleep(1)
-        client_ssh.close()
-
-    def _get_logclient_output(self, channel) -> str:
-        """Collect and return logclient output."""
-        try:
-            channel.channel.send("\x03")  # Ctrl-C
-            time.sleep(1)
-            channel.channel.send("exit\n")
-            time.sleep(1)
-            
-            output = ""
-            timeout = time.time() + 5
-            while time.time() < timeout:
-                if channel.channel.recv_ready():
-                    output += channel.channel.recv(1024).decode()
-                else:
-                    time.sleep(0.1)
-            
-            channel.channel.close()
-            return output
-        except Exception as e:
-            logger.error(f"Error collecting logclient output: {str(e)}")
-            return ""
-        
-        def kill_logclient_for_ip(self, client_ip: str) -> Tuple[str, str]:
-            """
-            Kill the logclient process on the proxy that was started for the specified client IP.
-            Returns a tuple of (stdout, stderr) from the kill command.
-            """
-            # Build the kill command.
-            # Note: Adjust to include 'sudo' if necessary and ensure your user can run it without a password.
-            kill_cmd = f'ps -aux | grep "logclient {client_ip}" | grep -v grep | awk \'{{print $2}}\' | xargs -r kill -9'
-            stdin, stdout, stderr = self.ssh_client.client.exec_command(kill_cmd)
-            out = stdout.read().decode()
-            err = stderr.read().decode()
-            logger.info(f"kill_logclient_for_ip output: {repr(out)}")
-            logger.info(f"kill_logclient_for_ip error: {repr(err)}")
-            return out, err
+        if session.interactive and session.alive:
+            try:
+                session.shell.send("exit\n")
+            except Exception as e:
+                logger.debug(f"Could not exit shell on {session.client_ip}: {str(e)}")
+        session.close()
+
+    def _get_logclient_output(self, stream: LogclientStream) -> Output:
+        """Stop logclient (Ctrl-C on its PTY) and return its buffered output."""
+        started = time.monotonic()
+        with METRICS.span('logclient_drain'):
+            try:
+                output = stream.stop(self._drain_timeout())
+            except Exception as e:
+                logger.error(f"Error collecting logclient output: {str(e)}")
+                output = stream.text()
+
+        pid = self._logclient_drained(stream, started)
+        if pid is not None:
+            # It ignored the interrupt; signal the exact process instead
+            self.kill_logclients([pid])
+            self.logclients.remove(pid)
+        return output
+
+    def kill_logclients(self, pids: List[int]) -> Tuple[str, str]:
+        """Kill the given logclient PIDs on the proxy with one exec.
+
+        A PID is only signalled while its command line still names logclient,
+        so a PID reused by another process after logclient exited is left alone.
+        """
+        if not pids or not self.ssh_client.client:
+            return "", ""
+        with METRICS.span('logclient_kill', pids=len(pids)):
+            try:
+                _, stdout, stderr = self.ssh_client.client.exec_command(
+                    kill_command(pids), timeout=CONFIG['COMMAND_TIMEOUT']
+                )
+                out = stdout.read().decode(errors='replace')
+                err = stderr.read().decode(errors='replace')
+            except Exception as e:
+                logger.error(f"Could not kill logclient processes {pids}: {str(e)}")
+                return "", str(e)
+            return self._logclients_killed(pids, out, err)
@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault('KAL_TOOLS_SKIP_DOTENV', '1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import CONFIG
+
+@pytest.fixture(autouse=True)
+def isolated_config(tmp_path, monkeypatch):
+    """Keep tests out of the operator's run history, logclient journal and temp dir."""
+    monkeypatch.setitem(CONFIG, 'HISTORY_DB', '')
+    monkeypatch.setitem(CONFIG, 'LOGCLIENT_JOURNAL', str(tmp_path / 'logclients.jsonl'))
+    monkeypatch.setitem(CONFIG, 'OUTPUT_SPILL_DIR', str(tmp_path / 'spill'))
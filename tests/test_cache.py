@@ -0,0 +1,51 @@
+import time
+
+from cache import ResultCache
+
+def test_get_returns_stored_value_until_it_expires():
+    cache = ResultCache(10, 0.05)
+    cache.put('10.0.0.1', 'ping', 'pong')
+    assert cache.get('10.0.0.1', 'ping') == 'pong'
+    time.sleep(0.06)
+    assert cache.get('10.0.0.1', 'ping') is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResultCache(2, 60)
+    cache.put('a', 'k', 1)
+    cache.put('b', 'k', 2)
+    cache.get('a', 'k')
+    cache.put('c', 'k', 3)
+    assert cache.get('b', 'k') is None
+    assert cache.get('a', 'k') == 1
+    assert cache.evictions == 1
+
+def test_invalidate_ip_drops_entries_and_refuses_stale_put():
+    cache = ResultCache(10, 60)
+    cache.put('a', 'k1', 1)
+    cache.put('b', 'k1', 2)
+    generation = cache.generation('a')
+    cache.invalidate_ip('a')
+    assert cache.get('a', 'k1') is None
+    assert cache.get('b', 'k1') == 2
+    cache.put('a', 'k2', 'stale', generation=generation)
+    assert cache.get('a', 'k2') is None
+    cache.put('a', 'k2', 'fresh', generation=cache.generation('a'))
+    assert cache.get('a', 'k2') == 'fresh'
+
+def test_generations_are_pruned_without_accepting_stale_puts():
+    cache = ResultCache(2, 60)
+    stale = cache.generation('10.0.0.0')
+    cache.invalidate_ip('10.0.0.0')
+    for i in range(1, 10):
+        cache.invalidate_ip(f'10.0.0.{i}')
+    assert len(cache._generations) <= 2 * cache.max_size + 1
+    cache.put('10.0.0.0', 'k', 'stale', generation=stale)
+    assert cache.get('10.0.0.0', 'k') is None
+
+def test_clear_refuses_puts_started_before_it():
+    cache = ResultCache(10, 60)
+    generation = cache.generation('a')
+    cache.clear()
+    cache.put('a', 'k', 'stale', generation=generation)
+    assert len(cache) == 0
@@ -0,0 +1,65 @@
+import base64
+import re
+import socket
+
+import pytest
+
+from collect import _ShellArchiveStream, _is_under, _remote_relpath
+
+END = re.compile(rb"__END_(?P<status>\d+)")
+
+class FakeChannel:
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def settimeout(self, timeout):
+        pass
+
+    def recv(self, size):
+        if not self.chunks:
+            return b""
+        chunk = self.chunks.pop(0)
+        if chunk is None:
+            raise socket.timeout()
+        return chunk
+
+def encoded_lines(data: bytes, width: int = 76) -> bytes:
+    text = base64.b64encode(data)
+    return b"\r\n".join(text[i:i + width] for i in range(0, len(text), width)) + b"\r\n"
+
+def test_stream_decodes_base64_between_markers_in_any_chunking():
+    data = bytes(range(256)) * 40
+    transcript = b"echo begin\r\n__BEGIN\r\n" + encoded_lines(data) + b"__END_0\r\n$ "
+    for size in (1, 7, 100, len(transcript)):
+        chunks = [transcript[i:i + size] for i in range(0, len(transcript), size)]
+        stream = _ShellArchiveStream(FakeChannel(chunks), b"__BEGIN", END, idle_timeout=1)
+        assert stream.read() == data
+        assert stream.status == 0
+
+def test_stream_reports_exit_status_and_drains():
+    transcript = b"__BEGIN\n" + encoded_lines(b"partial") + b"__END_2\n"
+    stream = _ShellArchiveStream(FakeChannel([transcript]), b"__BEGIN", END, idle_timeout=1)
+    stream.drain()
+    assert stream.status == 2
+
+def test_stream_errors_on_closed_or_idle_channel():
+    stream = _ShellArchiveStream(FakeChannel([b"__BEGIN\nQUJD"]), b"__BEGIN", END, idle_timeout=1)
+    with pytest.raises(ConnectionError):
+        stream.read()
+    stream = _ShellArchiveStream(FakeChannel([None]), b"__BEGIN", END, idle_timeout=1)
+    with pytest.raises(TimeoutError):
+        stream.read()
+
+def test_remote_relpath_refuses_paths_outside_root():
+    assert _remote_relpath("/var/log//messages") == "var/log/messages"
+    assert _remote_relpath("tmp/../tmp/crash") == "tmp/crash"
+    # Paths are anchored at /, so climbing above it stays at /
+    assert _remote_relpath("/../etc/passwd") == "etc/passwd"
+    for path in ("/", "..", "."):
+        with pytest.raises(ValueError):
+            _remote_relpath(path)
+
+def test_is_under():
+    assert _is_under("var/log/messages", "var/log")
+    assert _is_under("var/log", "var/log")
+    assert not _is_under("var/logs/x", "var/log")
@@ -0,0 +1,55 @@
+import contextvars
+import threading
+import time
+
+from runner_core import run_fleet_members
+
+def test_results_are_yielded_in_completion_order():
+    delays = {'10.0.0.1': 0.3, '10.0.0.2': 0.0, '10.0.0.3': 0.15}
+
+    def run(client_ip):
+        time.sleep(delays[client_ip])
+        return [client_ip], ""
+
+    results = list(run_fleet_members(delays, run, workers=3))
+    assert [result.client_ip for result in results] == ['10.0.0.2', '10.0.0.3', '10.0.0.1']
+    assert all(result.ok and result.outputs == [result.client_ip] for result in results)
+
+def test_one_failing_box_does_not_stop_the_rest():
+    def run(client_ip):
+        if client_ip == '10.0.0.2':
+            raise ConnectionError("no route")
+        return ["ok"], "log"
+
+    results = {result.client_ip: result for result in
+               run_fleet_members(['10.0.0.1', '10.0.0.2', '10.0.0.3'], run, workers=1)}
+    assert len(results) == 3
+    assert isinstance(results['10.0.0.2'].error, ConnectionError)
+    assert not results['10.0.0.2'].skipped
+    assert results['10.0.0.1'].ok and results['10.0.0.3'].logclient_output == "log"
+
+def test_throttle_refusal_marks_boxes_skipped_without_running_them():
+    ran = []
+    allowed = iter([True, False, False])
+    lock = threading.Lock()
+
+    def throttle():
+        with lock:
+            if not next(allowed):
+                raise InterruptedError("stopping")
+
+    def run(client_ip):
+        ran.append(client_ip)
+        return [], ""
+
+    results = list(run_fleet_members(['a', 'b', 'c'], run, workers=1, throttle=throttle))
+    assert ran == ['a']
+    skipped = [result for result in results if result.skipped]
+    assert [result.client_ip for result in skipped] == ['b', 'c']
+    assert all(isinstance(result.error, InterruptedError) and result.elapsed == 0.0 for result in skipped)
+
+def test_members_see_the_callers_context():
+    tag = contextvars.ContextVar('tag', default=None)
+    tag.set('sweep-1')
+    results = list(run_fleet_members(['a', 'b'], lambda client_ip: ([tag.get()], ""), workers=2))
+    assert [result.outputs for result in results] == [['sweep-1'], ['sweep-1']]
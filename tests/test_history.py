@@ -0,0 +1,43 @@
+import pytest
+
+from history import RunHistory
+
+@pytest.fixture
+def history(tmp_path):
+    store = RunHistory(str(tmp_path / 'history.sqlite3'))
+    yield store
+    store.close()
+
+def record_runs(history, count, client_ip='10.0.0.1', command_key='ping'):
+    for i in range(count):
+        history.record(client_ip, command_key, ['ping -c 4 x'], [f"out {i}"], f"log {i}", None, 0.1)
+    history.flush(timeout=5)
+
+def test_keyset_pages_cover_every_run_once_newest_first(history):
+    record_runs(history, 25)
+    seen, cursor = [], None
+    while True:
+        page = history.page(cursor=cursor, limit=10)
+        seen.extend(run['id'] for run in page.rows)
+        if page.next_cursor is None:
+            break
+        cursor = page.next_cursor
+    assert len(seen) == 25
+    assert seen == sorted(seen, reverse=True)
+
+def test_page_filters_by_ip_and_command(history):
+    record_runs(history, 3, client_ip='10.0.0.1')
+    record_runs(history, 2, client_ip='10.0.0.2', command_key='multicast')
+    assert len(history.page(client_ip='10.0.0.2').rows) == 2
+    assert len(history.page(command_key='ping').rows) == 3
+    assert history.page(client_ip='10.0.0.2', command_key='ping').rows == []
+
+def test_get_returns_outputs_and_failures(history):
+    history.record('10.0.0.1', 'ping', ['a', 'b'], ['A', 'B'], "log text", None, 0.5)
+    history.record('10.0.0.1', 'ping', ['a'], None, None, TimeoutError("slow"), 30.0)
+    history.flush(timeout=5)
+    failed, done = history.page().rows
+    run = history.get(done['id'])
+    assert run['ok'] and run['outputs'] == ['A', 'B'] and run['logclient'] == "log text"
+    assert not failed['ok'] and "slow" in failed['error']
+    assert history.get(10**6) is None
@@ -0,0 +1,35 @@
+import re
+
+from linestore import LineFilter, LineStore
+
+def test_lines_are_addressed_by_number_across_appends(tmp_path):
+    store = LineStore(str(tmp_path))
+    store.append("first\r\nsec")
+    store.append("ond\nthird")
+    assert store.complete_lines == 2
+    assert len(store) == 3
+    assert store.lines(0, 10) == ["first", "second", "third"]
+    assert store.line(1) == "second"
+
+def test_levels_are_indexed_with_aliases(tmp_path):
+    store = LineStore(str(tmp_path))
+    store.append("a INFO started\nb WARN slow\nc plain\nd FATAL crash\n")
+    assert [store.level(n) for n in range(4)] == ['INFO', 'WARNING', None, 'ERROR']
+    assert list(store.level_lines('ERROR')) == [3]
+
+def test_append_bytes_decodes_split_characters(tmp_path):
+    store = LineStore(str(tmp_path))
+    data = "grüße\n".encode()
+    store.append_bytes(data[i:i + 1] for i in range(len(data)))
+    assert store.lines(0, 1) == ["grüße"]
+
+def test_search_and_filter_follow_new_lines(tmp_path):
+    store = LineStore(str(tmp_path))
+    store.append("".join(f"line {i} {'ERROR' if i % 3 == 0 else 'INFO'}\n" for i in range(100)))
+    assert list(store.search(re.compile(rb"line 9\d"))) == list(range(90, 100))
+    errors = LineFilter(store, level='ERROR')
+    errors.refresh()
+    assert len(errors) == 34
+    store.append("late ERROR\n")
+    errors.refresh()
+    assert len(errors) == 35
@@ -0,0 +1,37 @@
+from parsers import format_parsed, parse_multicast, parse_outputs, parse_ping
+
+IPUTILS_PING = """PING 10.0.0.1 (10.0.0.1) 56(84) bytes of data.
+64 bytes from 10.0.0.1: icmp_seq=1 ttl=64 time=0.512 ms
+
+--- 10.0.0.1 ping statistics ---
+4 packets transmitted, 3 received, 25% packet loss, time 3004ms
+rtt min/avg/max/mdev = 0.412/0.501/0.612/0.082 ms
+"""
+
+BUSYBOX_PING = """--- 10.0.0.1 ping statistics ---
+4 packets transmitted, 4 packets received, 0% packet loss
+round-trip min/avg/max = 0.3/0.4/0.6 ms
+"""
+
+def test_parse_ping_iputils():
+    assert parse_ping([IPUTILS_PING]) == {
+        'transmitted': 4, 'received': 3, 'packet_loss': 25.0,
+        'rtt_min': 0.412, 'rtt_avg': 0.501, 'rtt_max': 0.612, 'rtt_mdev': 0.082,
+    }
+
+def test_parse_ping_busybox_has_no_mdev():
+    parsed = parse_ping([BUSYBOX_PING])
+    assert parsed['received'] == 4
+    assert parsed['rtt_max'] == 0.6
+    assert 'rtt_mdev' not in parsed
+
+def test_parse_multicast_converts_milliseconds_and_state():
+    parsed = parse_multicast(["state=PLAYING channel=239.1.1.1 zap_time=350ms"])
+    assert parsed == {'state': 'PLAYING', 'channel': '239.1.1.1', 'zap_time_ms': 350.0, 'playing': True}
+
+def test_parse_outputs_uses_the_configured_parser():
+    assert parse_outputs('ping', [BUSYBOX_PING])['packet_loss'] == 0.0
+    assert parse_outputs('reboot', ["anything"]) is None
+
+def test_format_parsed():
+    assert format_parsed({'received': 4, 'rtt_avg': 0.5, 'playing': True}) == "received=4, rtt_avg=0.5, playing=True"
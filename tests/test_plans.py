@@ -0,0 +1,53 @@
+import pytest
+
+from config import CONFIG
+from plans import Plan, render
+
+STEPS = [
+    {'id': 'mode', 'command': 'get mode'},
+    {'command': 'wake', 'unless': {'step': 'mode', 'match': r'awake'}},
+    {'group': [{'id': 'up', 'command': 'uptime'}, {'command': 'df -h {path}'}]},
+    {'command': 'report {ip}', 'when': {'step': 'up', 'match': r'days'}},
+]
+
+@pytest.fixture
+def plan(monkeypatch):
+    monkeypatch.setitem(CONFIG['AVAILABLE_COMMANDS'], 'test_plan',
+                        {'name': 'Test', 'steps': STEPS, 'params': {'path': '/var log'}})
+    return Plan.from_config('test_plan')
+
+def test_render_quotes_params_and_leaves_shell_syntax():
+    assert render("ls {path} ${HOME} {unknown}", {'path': "a b"}) == "ls 'a b' ${HOME} {unknown}"
+
+def test_from_config_flattens_groups_in_order(plan):
+    assert plan.commands == ['get mode', 'wake', 'uptime', 'df -h {path}', 'report {ip}']
+    assert plan.render('10.0.0.1').commands[3:] == ["df -h '/var log'", 'report 10.0.0.1']
+
+def test_stages_split_at_dependencies_and_groups(plan):
+    batched = [[step.command for step in stage.steps] for stage in plan.stages(batch=True)]
+    assert batched == [['get mode'], ['wake'], ['uptime', 'df -h {path}'], ['report {ip}']]
+    assert [stage.concurrent for stage in plan.stages(batch=True)] == [False, False, True, False]
+    assert len(plan.stages(batch=False)) == 4
+
+def test_sequence_batches_into_one_stage():
+    plan = Plan.sequence(['a', 'b', 'c'])
+    assert len(plan.stages(batch=True)) == 1
+    assert len(plan.stages(batch=False)) == 3
+
+def test_should_run_follows_conditions(plan):
+    wake, report = plan.steps[1], plan.steps[4]
+    assert not plan.should_run(wake, ['awake', None, None, None, None])
+    assert plan.should_run(wake, ['asleep', None, None, None, None])
+    assert plan.should_run(report, ['', '', 'up 3 days', '', None])
+    # A skipped dependency skips the step too
+    assert not plan.should_run(report, ['', '', None, '', None])
+
+@pytest.mark.parametrize('steps', [
+    [{'command': 'a', 'when': {'step': 'later', 'match': 'x'}}, {'id': 'later', 'command': 'b'}],
+    [{'id': 'a', 'command': 'x'}, {'id': 'a', 'command': 'y'}],
+    [{'id': 'a'}],
+])
+def test_from_config_rejects_malformed_plans(monkeypatch, steps):
+    monkeypatch.setitem(CONFIG['AVAILABLE_COMMANDS'], 'bad_plan', {'name': 'Bad', 'steps': steps})
+    with pytest.raises(ValueError):
+        Plan.from_config('bad_plan')
@@ -0,0 +1,43 @@
+import re
+
+import recvbuf
+from recvbuf import SEARCH_WINDOW, ReceiveBuffer, SpilledOutput
+
+def test_text_decodes_multibyte_characters_split_across_reads():
+    buffer = ReceiveBuffer(initial_size=4)
+    data = "héllo wörld\r\n".encode()
+    for i in range(len(data)):
+        buffer.append(data[i:i + 1])
+    assert buffer.text() == "héllo wörld\r\n"
+    assert buffer.text(normalize_newlines=True) == "héllo wörld\n"
+
+def test_search_new_finds_marker_split_over_two_reads():
+    buffer = ReceiveBuffer()
+    pattern = re.compile(rb"__END_(\d+)")
+    buffer.append(b"output __EN")
+    assert buffer.search_new(pattern) is None
+    buffer.append(b"D_7 trailing")
+    found = buffer.search_new(pattern)
+    assert (found.start, found.match.group(1)) == (7, b"7")
+
+def test_large_output_spills_to_disk(tmp_path):
+    buffer = ReceiveBuffer(max_bytes=1000, spill_dir=str(tmp_path), preview_bytes=100)
+    line = b"x" * 99 + b"\n"
+    for _ in range(3 * SEARCH_WINDOW // len(line)):
+        buffer.append(line)
+    buffer.append(b"__END_0")
+    assert buffer.spilled
+    assert buffer.search_new(re.compile(rb"__END_\d")) is not None
+    output = buffer.text(0, buffer.size - 7)
+    assert isinstance(output, SpilledOutput)
+    assert output.size == buffer.size - 7
+    assert "bytes omitted" in output
+    assert output.read_bytes() == line * (3 * SEARCH_WINDOW // len(line))
+
+def test_finditer_scans_spill_file_in_windows(tmp_path, monkeypatch):
+    monkeypatch.setattr(recvbuf, 'SCAN_SIZE', 4096)
+    buffer = ReceiveBuffer(max_bytes=10, spill_dir=str(tmp_path))
+    for i in range(5000):
+        buffer.append(f"line {i} MARK_{i}\n".encode())
+    matches = list(buffer.finditer(re.compile(rb"MARK_(\d+)")))
+    assert [int(m.match.group(1)) for m in matches] == list(range(5000))
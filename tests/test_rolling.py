@@ -0,0 +1,68 @@
+import threading
+from collections import Counter
+
+import pytest
+
+from config import CONFIG
+from rolling import RollingReboot
+from runner_core import FleetResult
+
+class FakeFleet:
+    """Boxes that are down for ``downtime`` probes after a reboot; ``dead`` never answer."""
+    def __init__(self, dead=(), never_back=(), downtime=2):
+        self.dead = set(dead)
+        self.never_back = set(never_back)
+        self.downtime = downtime
+        self.waves = []
+        self._down = {}
+        self._lock = threading.Lock()
+
+    def run_fleet(self, client_ips, commands, max_workers=None, command_key=None):
+        self.waves.append(list(client_ips))
+        for client_ip in client_ips:
+            with self._lock:
+                self._down[client_ip] = self.downtime
+            yield FleetResult(client_ip, [], "", None, 0.0)
+
+    def probe_reachable(self, client_ip, timeout):
+        if client_ip in self.dead:
+            return False
+        with self._lock:
+            left = self._down.get(client_ip, 0)
+            if left and client_ip not in self.never_back:
+                self._down[client_ip] = left - 1
+        return not left
+
+@pytest.fixture(autouse=True)
+def fast_reboots(monkeypatch):
+    monkeypatch.setitem(CONFIG, 'REBOOT_DOWN_TIMEOUT', 5)
+    monkeypatch.setitem(CONFIG, 'REBOOT_UP_TIMEOUT', 0.2)
+
+def reboot(fleet, ips, **options):
+    return {result.client_ip: result.status for result in
+            RollingReboot(fleet, poll_interval=0.005, **options).run(ips)}
+
+def test_waves_never_exceed_the_outage_budget():
+    fleet = FakeFleet()
+    ips = [f"10.0.0.{i}" for i in range(10)]
+    statuses = reboot(fleet, ips, wave_size=4, max_outage=20)
+    assert set(statuses.values()) == {'healthy'}
+    assert max(len(wave) for wave in fleet.waves) == 2
+    assert sorted(ip for wave in fleet.waves for ip in wave) == sorted(ips)
+
+def test_unreachable_boxes_are_not_rebooted():
+    fleet = FakeFleet(dead={'10.0.0.1'})
+    statuses = reboot(fleet, ['10.0.0.1', '10.0.0.2'], wave_size=2, max_outage=100)
+    assert statuses == {'10.0.0.1': 'unreachable', '10.0.0.2': 'healthy'}
+    assert fleet.waves == [['10.0.0.2']]
+
+def test_failed_wave_halts_the_rollout():
+    fleet = FakeFleet(never_back={'10.0.0.1', '10.0.0.2'})
+    ips = ['10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.4']
+    statuses = reboot(fleet, ips, wave_size=2, max_outage=100, healthy_fraction=1.0)
+    assert Counter(statuses.values()) == {'timed_out': 2, 'not_started': 2}
+    assert len(fleet.waves) == 1
+
+def test_only_commands_marked_reboots_are_allowed():
+    with pytest.raises(ValueError):
+        RollingReboot(FakeFleet(), command_key='ping')
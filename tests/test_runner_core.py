@@ -0,0 +1,97 @@
+import re
+
+import pytest
+
+from runner_core import (AUTH_PROMPT_PATTERN, NestedLogin, batch_end_pattern, batch_script, command_end_pattern,
+                         command_script, split_batch, split_command, split_exec_batch, split_shell_batch)
+from recvbuf import ReceiveBuffer
+
+def filled(data: bytes) -> ReceiveBuffer:
+    buffer = ReceiveBuffer()
+    buffer.append(data)
+    return buffer
+
+def test_command_script_round_trip():
+    token = "t1"
+    script = command_script(token, "uptime")
+    # The typed line is echoed back by the shell before the markers print
+    buffer = filled(script.encode() + b"__KAL_BEGIN_t1\r\nup 3 days\r\n__KAL_END_t1:0\r\n$ ")
+    end = buffer.search_new(command_end_pattern(token))
+    output, status = split_command(buffer, token, end)
+    assert (output, status) == ("up 3 days\n", 0)
+
+def test_split_command_reports_dropped_client_without_status():
+    buffer = filled(b"__KAL_BEGIN_t1\r\nrebooting\r\nConnection to 10.0.0.1 closed.\r\n")
+    end = buffer.search_new(command_end_pattern("t1"))
+    output, status = split_command(buffer, "t1", end)
+    assert output == "rebooting\n"
+    assert status is None
+
+def test_split_batch_pairs_outputs_with_statuses():
+    buffer = filled(b"__KAL_BEGIN_b_0\nfirst\n__KAL_END_b_0:0\n"
+                    b"__KAL_BEGIN_b_1\nsecond\n__KAL_END_b_1:3\n"
+                    b"__KAL_BEGIN_b_2\nunfinished")
+    assert split_batch(buffer, "b") == [("first\n", 0), ("second\n", 3), ("unfinished", None)]
+
+def test_split_exec_batch_splits_both_streams():
+    script = batch_script("e", ["a", "b"], stderr_markers=True)
+    assert script.count("BEGIN_e_0") == 2
+    out = filled(b"__KAL_BEGIN_e_0\nA\n__KAL_END_e_0:0\n__KAL_BEGIN_e_1\nB\n__KAL_END_e_1:1\n")
+    err = filled(b"__KAL_BEGIN_e_0\n__KAL_BEGIN_e_1\noops\n")
+    results = split_exec_batch(out, err, "e")
+    assert [(r.stdout, r.stderr, r.exit_status) for r in results] == [("A\n", "", 0), ("B\n", "oops\n", 1)]
+
+def test_split_shell_batch_detects_client_detached():
+    pattern = batch_end_pattern("s", 2)
+    buffer = filled(b"__KAL_BEGIN_s_0\r\nA\r\n__KAL_END_s_0:0\r\n__KAL_BEGIN_s_1\r\nB\r\n__KAL_END_s_1:0\r\n")
+    results, attached = split_shell_batch(buffer, "s", buffer.search_new(pattern))
+    assert attached
+    assert [r.stdout for r in results] == ["A\n", "B\n"]
+
+    buffer = filled(b"__KAL_BEGIN_s_0\r\nA\r\n__KAL_END_s_0:0\r\n__KAL_BEGIN_s_1\r\n"
+                    b"Connection to 10.0.0.1 closed.\r\n")
+    results, attached = split_shell_batch(buffer, "s", buffer.search_new(pattern))
+    assert not attached
+    assert [(r.stdout, r.exit_status) for r in results] == [("A\n", 0), ("", -1)]
+
+def prompt(text: str) -> "re.Match":
+    return AUTH_PROMPT_PATTERN.search(text)
+
+def test_nested_login_answers_host_key_and_password():
+    login = NestedLogin("secret", PermissionError)
+    assert login.answer(prompt("Are you sure you want to continue connecting (yes/no)?")) == "yes\n"
+    assert login.answer(prompt("root@10.0.0.1's password:")) == "secret\n"
+    assert not login.done
+    assert login.answer(prompt("root@stb:~# ")) is None
+    assert login.done
+
+def test_nested_login_ignores_proxy_prompt_before_password():
+    login = NestedLogin("secret", PermissionError)
+    assert login.answer(prompt("proxy$ ")) is None
+    assert not login.done
+
+def test_nested_login_fails_on_second_password_prompt():
+    login = NestedLogin("secret", PermissionError)
+    login.answer(prompt("password:"))
+    with pytest.raises(PermissionError):
+        login.answer(prompt("password:"))
+
+def test_nested_login_fails_on_ssh_error():
+    login = NestedLogin("secret", PermissionError)
+    with pytest.raises(ConnectionError):
+        login.answer(prompt("ssh: connect to host 10.0.0.1 port 22: Connection refused"))
+
+def test_fleet_member_async_captures_results_and_errors():
+    import asyncio
+
+    from runner_core import fleet_member_async
+
+    async def run(client_ip):
+        if client_ip == 'bad':
+            raise ConnectionError("no route")
+        return ["out"], "log"
+
+    good = asyncio.run(fleet_member_async('good', run))
+    bad = asyncio.run(fleet_member_async('bad', run))
+    assert (good.ok, good.outputs, good.logclient_output) == (True, ["out"], "log")
+    assert isinstance(bad.error, ConnectionError) and not bad.skipped
@@ -0,0 +1,120 @@
+import io
+import json
+import threading
+import time
+
+import pytest
+
+from runner_core import FleetResult
+from scheduler import Scheduler, Sweep, TokenBucket
+
+class FakeTransport:
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+class FakeRunner:
+    """Answers every box with one output; ``connected`` follows its transport like CommandRunner's."""
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.swept = []
+        self.closed = False
+
+    @property
+    def connected(self):
+        return self.transport.is_active()
+
+    def run_fleet(self, client_ips, commands, **options):
+        if not self.connected:
+            raise ConnectionError("Not connected to SSH server")
+        self.swept.append(list(client_ips))
+        for client_ip in client_ips:
+            yield FleetResult(client_ip, ["out"], "", None, 0.01)
+
+    def close(self):
+        self.closed = True
+
+def test_token_bucket_rejects_non_positive_rate():
+    with pytest.raises(ValueError):
+        TokenBucket(0, 5)
+    with pytest.raises(ValueError):
+        TokenBucket(-1, 5)
+
+def test_token_bucket_burst_is_at_least_one_token():
+    bucket = TokenBucket(1000, 0.2)
+    assert bucket.burst == 1.0
+    assert bucket.acquire()
+
+def test_token_bucket_spends_burst_then_waits():
+    bucket = TokenBucket(20, 3)
+    started = time.monotonic()
+    for _ in range(3):
+        assert bucket.acquire()
+    assert time.monotonic() - started < 0.05
+    assert bucket.acquire()
+    assert time.monotonic() - started >= 0.03
+
+def test_token_bucket_acquire_gives_up_when_stopped():
+    bucket = TokenBucket(0.01, 1)
+    assert bucket.acquire()
+    stop = threading.Event()
+    stop.set()
+    assert not bucket.acquire(stop)
+
+def test_sweep_advance_stays_on_interval_grid():
+    sweep = Sweep('ping', 'ping', 10, ['10.0.0.1'], jitter=0)
+    slot = sweep.slot
+    sweep.advance(slot + 25)
+    assert sweep.slot == slot + 30
+    assert sweep.next_run == sweep.slot
+
+def test_sweep_validates_its_fields():
+    with pytest.raises(ValueError):
+        Sweep('x', 'no_such_command', 10, [])
+    with pytest.raises(ValueError):
+        Sweep('x', 'ping', 0, [])
+    with pytest.raises(ValueError):
+        Sweep('x', 'ping', 10, [], overrun='queue')
+
+def sweep_records(out):
+    return [json.loads(line) for line in out.getvalue().splitlines()]
+
+def test_sweep_reconnects_when_the_transport_died():
+    lost, fresh = FakeRunner(), FakeRunner()
+    lost.transport.active = False
+    sweep = Sweep('ping', 'ping', 60, ['10.0.0.1', '10.0.0.2'], jitter=0)
+    out = io.StringIO()
+    scheduler = Scheduler(lost, [sweep], out, session_rate=1000, connect=lambda: (fresh, None))
+    scheduler._run_sweep(sweep)
+    assert scheduler.runner is fresh
+    assert lost.closed and lost.swept == []
+    assert fresh.swept == [['10.0.0.1', '10.0.0.2']]
+    assert [record['ip'] for record in sweep_records(out)] == ['10.0.0.1', '10.0.0.2']
+
+def test_sweep_keeps_a_live_runner():
+    runner = FakeRunner()
+    sweep = Sweep('ping', 'ping', 60, ['10.0.0.1'], jitter=0)
+    scheduler = Scheduler(runner, [sweep], io.StringIO(), session_rate=1000,
+                          connect=lambda: pytest.fail("reconnected a live runner"))
+    scheduler._run_sweep(sweep)
+    assert scheduler.runner is runner and runner.swept == [['10.0.0.1']]
+
+def test_failed_reconnect_is_retried_next_sweep():
+    lost, fresh = FakeRunner(), FakeRunner()
+    lost.transport.active = False
+    attempts = []
+
+    def connect():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise OSError("proxy unreachable")
+        return fresh, None
+
+    sweep = Sweep('ping', 'ping', 60, ['10.0.0.1'], jitter=0)
+    scheduler = Scheduler(lost, [sweep], io.StringIO(), session_rate=1000, connect=connect)
+    scheduler._run_sweep(sweep)
+    assert scheduler.runner is lost and sweep.runs == 1
+    scheduler._run_sweep(sweep)
+    assert scheduler.runner is fresh and fresh.swept == [['10.0.0.1']]